@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+BENCHMARKS DOS CAMINHOS QUENTES DO BOT
+Roda offline: o banco é um SQLite temporário em RAM (/dev/shm quando existe)
+e as chamadas à API do Mercado Livre são substituídas por respostas sintéticas.
+
+Uso:
+    python benchmarks/run_benchmarks.py                      # resultados em JSON no stdout
+    python benchmarks/run_benchmarks.py --quick              # menos repetições
+    python benchmarks/run_benchmarks.py --output out.json    # grava o JSON em arquivo
+    python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json --fail-on-regression
+    python benchmarks/run_benchmarks.py --save-baseline      # atualiza benchmarks/baseline.json
+
+Cada resultado é o tempo por chamada em microssegundos (mediana e melhor de N rodadas).
+Na comparação, um benchmark só é marcado como regressão quando até a melhor
+rodada atual passa de mediana do baseline * --threshold. O ruído de uma
+máquina compartilhada mexe na mediana, mas raramente deixa todas as rodadas
+lentas; uma piora real desloca também a melhor.
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+KEYWORD_COUNTS = (10, 100, 1000, 10000)
+KEYWORDS_PER_RULE = 5
+ABSENCE_CONFIG_COUNTS = (2, 50)
+PIPELINE_QUESTIONS = 50  # tamanho de uma página do polling
+
+SYLLABLES = ['ba', 'ca', 'de', 'fi', 'go', 'lu', 'ma', 'ne', 'po', 'ra', 'se', 'ti', 'vo', 'xa', 'ze']
+
+
+def _prepare_environment():
+    """Isola o bot num diretório temporário antes de importar main.py"""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    data_dir = tempfile.mkdtemp(prefix='botml-bench-', dir=base)
+    os.environ['DATA_DIR'] = data_dir
+    os.environ['LOG_LEVEL'] = 'INFO'
+    for name in ('DATABASE_URL', 'REDIS_URL'):
+        os.environ.pop(name, None)
+    sys.path.insert(0, REPO_ROOT)
+    return data_dir
+
+
+def make_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+
+
+def make_rules(rng, keyword_count):
+    """Regras sintéticas com KEYWORDS_PER_RULE palavras-chave cada"""
+    keywords = set()
+    while len(keywords) < keyword_count:
+        keywords.add(make_word(rng) + make_word(rng))
+    keywords = sorted(keywords)
+    rng.shuffle(keywords)
+    return [keywords[i:i + KEYWORDS_PER_RULE] for i in range(0, len(keywords), KEYWORDS_PER_RULE)]
+
+
+def make_questions(rng, rules, count, hit_ratio):
+    """Perguntas com ~hit_ratio de acerto; a palavra-chave vem de uma regra aleatória"""
+    questions = []
+    for _ in range(count):
+        words = [make_word(rng) for _ in range(rng.randint(6, 14))]
+        if rng.random() < hit_ratio:
+            words.insert(rng.randrange(len(words)), rng.choice(rng.choice(rules)))
+        questions.append(' '.join(words) + '?')
+    return questions
+
+
+def measure(func, repeat):
+    """Tempo por chamada (us) com autorange do timeit"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    rounds = [t / number * 1e6 for t in timer.repeat(repeat=repeat, number=number)]
+    return {
+        "unit": "us",
+        "median": round(statistics.median(rounds), 3),
+        "best": round(min(rounds), 3),
+        "calls_per_round": number,
+        "rounds": repeat
+    }
+
+
+def bench_find_auto_response(main, rng, repeat, results):
+    with main.app.app_context():
+        user_id = main.User.query.filter_by(ml_user_id=main.ML_USER_ID).first().id
+        for keyword_count in KEYWORD_COUNTS:
+            main.AutoResponse.query.delete()
+            rules = make_rules(rng, keyword_count)
+            main.db.session.add_all(
+                main.AutoResponse(user_id=user_id, keywords=', '.join(keywords),
+                                  response_text=f"Resposta {i}", is_active=True)
+                for i, keywords in enumerate(rules)
+            )
+            main.db.session.commit()
+            for label, hit_ratio in (('hit', 1.0), ('miss', 0.0)):
+                corpus = make_questions(rng, rules, 200, hit_ratio)
+                cycle = itertools.cycle(corpus)
+                results[f"find_auto_response[{keyword_count}kw,{label}]"] = measure(
+                    lambda: main.find_auto_response(next(cycle)), repeat
+                )
+        # Volta às regras padrão para o pipeline
+        main.AutoResponse.query.delete()
+        main.db.session.commit()
+    main.create_default_data()
+
+
+def bench_is_absence_time(main, rng, repeat, results):
+    with main.app.app_context():
+        user_id = main.User.query.filter_by(ml_user_id=main.ML_USER_ID).first().id
+        for config_count in ABSENCE_CONFIG_COUNTS:
+            main.AbsenceConfig.query.delete()
+            for i in range(config_count):
+                start = rng.randint(0, 22)
+                main.db.session.add(main.AbsenceConfig(
+                    user_id=user_id, name=f"Config {i}", message=f"Ausente {i}",
+                    start_time=f"{start:02d}:00", end_time=f"{start + 1:02d}:00",
+                    days_of_week=','.join(sorted(rng.sample('0123456', 3))), is_active=True
+                ))
+            main.db.session.commit()
+            results[f"is_absence_time[{config_count}cfg]"] = measure(main.is_absence_time, repeat)
+        main.AbsenceConfig.query.delete()
+        main.db.session.commit()
+    main.create_default_data()
+
+
+def bench_extract_code(main, repeat, results):
+    inputs = {
+        'url': 'https://bot.exemplo.com/api/ml/webhook?code=TG-65a1b2c3d4e5f6a7b8c9d0e1-180617463&state=x',
+        'param': 'code=TG-65a1b2c3d4e5f6a7b8c9d0e1-180617463&state=x',
+        'plain': '  TG-65a1b2c3d4e5f6a7b8c9d0e1-180617463  ',
+    }
+    for label, value in inputs.items():
+        results[f"extract_code_from_input[{label}]"] = measure(lambda: main.extract_code_from_input(value), repeat)
+
+
+def bench_add_debug_log(main, repeat, results):
+    results["add_debug_log[filtered]"] = measure(
+        lambda: main.add_debug_log("Pergunta %s", 123, level=main.LOG_DEBUG), repeat
+    )
+    results["add_debug_log[enabled]"] = measure(lambda: main.add_debug_log("📩 Pergunta %s", 123), repeat)
+    # O lote de logs do benchmark acima é grande: espera a gravação inteira antes do próximo
+    main.log_writer.flush(timeout=600)
+
+
+def bench_pipeline(main, rng, repeat, results):
+    """Um ciclo completo do polling (classificação, reivindicação, histórico e trace) por pergunta"""
+    next_id = [10 ** 9]
+    now = datetime.now(timezone.utc).isoformat()
+
+    def fake_fetch(access_token, limit=50, ml_user_id=None):
+        page = []
+        for _ in range(PIPELINE_QUESTIONS):
+            next_id[0] += 1
+            text = rng.choice(['Qual o prazo de entrega?', 'Tem garantia?', 'Aceita pix?', 'Qual a cor?'])
+            page.append({'id': next_id[0], 'text': text, 'item_id': 'MLB123', 'date_created': now})
+        return page
+
+    main.fetch_unanswered_questions_with_token = fake_fetch
+    main.answer_question_ml_with_token = lambda access_token, question_id, text, ml_user_id=None: True
+
+    def one_pass():
+        main.monitor_once()
+        main.db_writer.flush(timeout=60)
+
+    one_pass()  # aquecimento (credenciais, caches do SQLAlchemy)
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        one_pass()
+        rounds.append((time.perf_counter() - start) / PIPELINE_QUESTIONS * 1e6)
+    results[f"pipeline_pass[{PIPELINE_QUESTIONS}q]"] = {
+        "unit": "us",
+        "median": round(statistics.median(rounds), 3),
+        "best": round(min(rounds), 3),
+        "calls_per_round": PIPELINE_QUESTIONS,
+        "rounds": repeat
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Razão melhor rodada atual / mediana do baseline por benchmark"""
+    report = {}
+    for name, result in results.items():
+        reference = baseline.get('results', {}).get(name)
+        if not reference or not reference.get('median'):
+            continue
+        ratio = result['best'] / reference['median']
+        report[name] = {
+            "baseline": reference['median'],
+            "current": result['median'],
+            "current_best": result['best'],
+            "ratio": round(ratio, 3),
+            "regression": ratio > threshold
+        }
+    return report
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks dos caminhos quentes do bot")
+    parser.add_argument('--quick', action='store_true', help="3 rodadas em vez de 7")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="grava o JSON neste arquivo em vez do stdout")
+    parser.add_argument('--compare', metavar='BASELINE', help="compara com um JSON de baseline")
+    parser.add_argument('--threshold', type=float, default=1.25, help="razão melhor atual / mediana do baseline a partir da qual é regressão")
+    parser.add_argument('--fail-on-regression', action='store_true')
+    parser.add_argument('--save-baseline', action='store_true', help=f"grava em {BASELINE_PATH}")
+    args = parser.parse_args()
+
+    data_dir = _prepare_environment()
+    repeat = 3 if args.quick else 7
+    rng = random.Random(args.seed)
+    results = {}
+    # Os logs do bot (stdout da thread de escrita) não se misturam com o JSON
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        main.initialize_database()
+        main.create_default_data()
+        try:
+            bench_find_auto_response(main, rng, repeat, results)
+            bench_is_absence_time(main, rng, repeat, results)
+            bench_extract_code(main, repeat, results)
+            bench_add_debug_log(main, repeat, results)
+            bench_pipeline(main, rng, repeat, results)
+        finally:
+            main.db_writer.flush()
+            main.log_writer.flush()
+
+    output = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "rounds": repeat
+        },
+        "results": results
+    }
+    exit_code = 0
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            output["comparison"] = compare(results, json.load(f), args.threshold)
+        regressions = [name for name, item in output["comparison"].items() if item["regression"]]
+        output["regressions"] = regressions
+        if regressions and args.fail_on_regression:
+            exit_code = 1
+
+    text = json.dumps(output, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
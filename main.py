@@ -21,11 +21,40 @@ import time
 import threading
 import json
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, jsonify, redirect, url_for, render_template_string
+from flask import Flask, Response, request, jsonify, redirect, url_for, render_template_string
+import click
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 import requests
 import sqlite3
+import gzip
+import shutil
+import queue
+import atexit
+import base64
+import html
+import heapq
+import random
+import re
+import bisect
+import math
+import itertools
+import sys
+import uuid
+from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, namedtuple, deque
+import socket
+from sqlalchemy import event, inspect, text, and_, or_
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+
+try:
+    import redis  # opcional: estado compartilhado via REDIS_URL
+except ImportError:
+    redis = None
 
 # ========== CONFIGURAÇÃO DA APLICAÇÃO ==========
 app = Flask(__name__)
@@ -35,13 +64,129 @@ CORS(app)
 # Fuso horário de São Paulo (UTC-3)
 SAO_PAULO_TZ = timezone(timedelta(hours=-3))
 
+# ========== RELÓGIO (REAL OU SIMULADO) ==========
+# Horários de negócio (ausência, expiração de tokens, agendamentos, TTLs e
+# tarefas periódicas) passam por `clock`. Em produção é o relógio de parede;
+# em simulação (tools/simulate_week.py) o tempo é virtual e só avança de
+# evento em evento, então uma semana inteira roda em segundos.
+
+class SystemClock:
+    """Relógio de parede: sleep bloqueia a thread"""
+
+    simulated = False
+
+    def time(self):
+        return time.time()
+
+    def now(self, tz=None):
+        return datetime.now(tz)
+
+    def utcnow(self):
+        return datetime.utcnow()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class SimulatedClock:
+    """
+    Tempo virtual: não passa sozinho. Temporizadores e tarefas periódicas
+    entram num heap e run_until() salta direto para o próximo evento,
+    executando tudo na thread chamadora (sem threads de background).
+    """
+
+    simulated = True
+
+    def __init__(self, start=None):
+        self._now = time.time() if start is None else float(start)
+        self._heap = []
+        self._seq = itertools.count()
+        self.events_run = 0
+        self.errors = 0
+
+    def time(self):
+        return self._now
+
+    def now(self, tz=None):
+        return datetime.fromtimestamp(self._now, tz)
+
+    def utcnow(self):
+        return datetime.fromtimestamp(self._now, timezone.utc).replace(tzinfo=None)
+
+    def sleep(self, seconds):
+        # Pausas dentro de um evento (ex.: entre lotes) só avançam o tempo virtual
+        self._now += max(0.0, seconds)
+
+    def call_at(self, when, callback):
+        heapq.heappush(self._heap, (when, next(self._seq), callback))
+        return when
+
+    def call_later(self, delay, callback):
+        return self.call_at(self._now + max(0.0, delay), callback)
+
+    def every(self, interval, callback, first=None):
+        """Repete callback a cada `interval` segundos virtuais (primeira vez em `first`)"""
+        def tick():
+            try:
+                callback()
+            finally:
+                self.call_later(interval, tick)
+        return self.call_at(self._now + interval if first is None else first, tick)
+
+    def next_event(self):
+        return self._heap[0][0] if self._heap else None
+
+    def run_until(self, end, after_event=None):
+        """Executa em ordem os eventos até `end` e deixa o relógio em `end`"""
+        while self._heap and self._heap[0][0] <= end:
+            when, _, callback = heapq.heappop(self._heap)
+            self._now = max(self._now, when)
+            try:
+                callback()
+            except Exception as e:
+                self.errors += 1
+                add_debug_log(f"❌ Erro em evento simulado: {e}")
+            self.events_run += 1
+            if after_event:
+                after_event()
+        self._now = max(self._now, end)
+
+clock = SystemClock()
+
+def set_clock(new_clock):
+    """Troca o relógio global (simulações); retorna o novo relógio"""
+    global clock
+    clock = new_clock
+    return clock
+
+def run_periodically(name, interval, task, initial_delay=None):
+    """
+    Executa `task` a cada `interval` segundos: numa thread daemon com o
+    relógio real ou como evento recorrente no relógio simulado.
+    """
+    initial_delay = interval if initial_delay is None else initial_delay
+    if clock.simulated:
+        clock.every(interval, task, first=clock.time() + initial_delay)
+        return None
+
+    def loop():
+        clock.sleep(initial_delay)
+        while True:
+            try:
+                task()
+            except Exception as e:
+                add_debug_log(f"❌ Erro em {name}: {e}")
+            clock.sleep(interval)
+    thread = threading.Thread(target=loop, name=name, daemon=True)
+    thread.start()
+    return thread
+
 def get_local_time():
     """Retorna o horário atual no fuso horário de São Paulo"""
-    return datetime.now(SAO_PAULO_TZ)
+    return clock.now(SAO_PAULO_TZ)
 
 def get_local_time_utc():
     """Retorna o horário atual em UTC para salvar no banco"""
-    return datetime.utcnow()
+    return clock.utcnow()
 
 def format_local_time(utc_datetime):
     """Converte UTC para horário local para exibição"""
@@ -63,16 +208,78 @@ DATABASE_PATH = os.path.join(DATA_DIR, 'bot_ml.db')
 LOGS_PATH = os.path.join(DATA_DIR, 'logs')
 BACKUP_PATH = os.path.join(DATA_DIR, 'backups')
 
+ARCHIVE_PATH = os.path.join(BACKUP_PATH, 'archive')
+SNAPSHOT_PATH = os.path.join(BACKUP_PATH, 'snapshots')
+
 # Garantir que diretórios existam
-for directory in [DATA_DIR, LOGS_PATH, BACKUP_PATH]:
+for directory in [DATA_DIR, LOGS_PATH, BACKUP_PATH, ARCHIVE_PATH, SNAPSHOT_PATH]:
     if not os.path.exists(directory):
         os.makedirs(directory, exist_ok=True)
 
-# ========== CONFIGURAÇÃO DO BANCO SQLITE ==========
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DATABASE_PATH}'
+# ========== CONFIGURAÇÃO DO BANCO (SQLITE OU POSTGRESQL) ==========
+# Padrão: SQLite local. Com DATABASE_URL=postgresql://... vários nós compartilham o banco.
+DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{DATABASE_PATH}')
+if DATABASE_URL.startswith('postgres://'):
+    # Render/Heroku ainda entregam o esquema antigo
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
+if DATABASE_URL.startswith('postgresql://'):
+    # Driver fixado em requirements.txt
+    DATABASE_URL = 'postgresql+psycopg2://' + DATABASE_URL[len('postgresql://'):]
+IS_SQLITE = DATABASE_URL.startswith('sqlite')
+if IS_SQLITE and DATABASE_URL.startswith('sqlite:///') and len(DATABASE_URL) > len('sqlite:///'):
+    DATABASE_PATH = DATABASE_URL[len('sqlite:///'):]
+
+# Identificador deste processo para reivindicar perguntas entre nós.
+# Calculado sob demanda: com gunicorn --preload os workers herdam o módulo
+# importado pelo master e precisam de ids distintos após o fork.
+_node_id = (None, None)  # (pid, id)
+
+def node_id():
+    """Id do nó/processo atual (NODE_ID do ambiente ou host:pid)"""
+    global _node_id
+    pid = os.getpid()
+    if _node_id[0] != pid:
+        _node_id = (pid, os.getenv('NODE_ID') or f"{socket.gethostname()}:{pid}")
+    return _node_id[1]
+
+if IS_SQLITE:
+    DB_ENGINE_OPTIONS = {'connect_args': {'timeout': 30}}
+else:
+    DB_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '10')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', '10')),
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    }
+
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = DB_ENGINE_OPTIONS
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 
+def dialect_insert(bind, table):
+    """INSERT com suporte a ON CONFLICT conforme o dialeto (SQLite ou PostgreSQL)"""
+    if bind.dialect.name == 'postgresql':
+        return postgresql_insert(table)
+    return sqlite_insert(table)
+
+def questions_tsvector_sql(alias=''):
+    """Expressão indexada pelo GIN de busca textual no PostgreSQL"""
+    prefix = f'{alias}.' if alias else ''
+    return (
+        f"to_tsvector('portuguese', coalesce({prefix}question_text, '') || ' ' || "
+        f"coalesce({prefix}response_text, ''))"
+    )
+
+def scalar_min(bind, a, b):
+    """Menor de dois valores (escalar) conforme o dialeto"""
+    return db.func.least(a, b) if bind.dialect.name == 'postgresql' else db.func.min(a, b)
+
+def scalar_max(bind, a, b):
+    """Maior de dois valores (escalar) conforme o dialeto"""
+    return db.func.greatest(a, b) if bind.dialect.name == 'postgresql' else db.func.max(a, b)
+
 # ========== CREDENCIAIS ATUALIZADAS DO MERCADO LIVRE ==========
 ML_ACCESS_TOKEN = os.getenv('ML_ACCESS_TOKEN', 'APP_USR-5510376630479325-072518-5543447b8156889e3edf9c10f3bf19e8-180617463')
 ML_CLIENT_ID = os.getenv('ML_CLIENT_ID', '5510376630479325')
@@ -80,6 +287,10 @@ ML_CLIENT_SECRET = os.getenv('ML_CLIENT_SECRET', 'jlR4As2x8uFY3RTpysLpuPhzC9yM9d
 ML_USER_ID = os.getenv('ML_USER_ID', '180617463')
 ML_REFRESH_TOKEN = os.getenv('ML_REFRESH_TOKEN', '')
 
+# Endereços da API e da autorização (apontar para tools/fake_ml_server.py em testes de carga)
+ML_API_BASE_URL = os.getenv('ML_API_BASE_URL', 'https://api.mercadolibre.com').rstrip('/')
+ML_AUTH_BASE_URL = os.getenv('ML_AUTH_BASE_URL', 'https://auth.mercadolivre.com.br').rstrip('/')
+
 # URLs de redirect para renovação de tokens (webhook como padrão)
 REDIRECT_URIS = [
     "https://bot-mercadolivre-dettech.onrender.com/api/ml/webhook",
@@ -95,19 +306,166 @@ REDIRECT_URIS = [
 import threading
 import time
 
+TOKEN_REFRESH_WORKERS = int(os.getenv('TOKEN_REFRESH_WORKERS', '4'))
+TOKEN_REFRESH_JITTER = int(os.getenv('TOKEN_REFRESH_JITTER', '300'))  # segundos (máximo)
+TOKEN_DEFAULT_EXPIRES_IN = 21600  # 6 horas, quando o ML não informa
+TOKEN_STALE_MARGIN = int(os.getenv('TOKEN_STALE_MARGIN', '600'))  # abaixo disso, renovar já no boot
+TOKEN_RECOVERY_SPREAD = int(os.getenv('TOKEN_RECOVERY_SPREAD', '60'))  # janela para espalhar renovações no boot
+
+class TokenRefreshScheduler:
+    """
+    Agendador central de renovações: uma única thread com fila de prioridade
+    (due_time, conta) e um pool pequeno de workers executando as renovações.
+    Reagendar uma conta invalida a entrada anterior (remoção preguiçosa do heap).
+    """
+
+    def __init__(self, workers=TOKEN_REFRESH_WORKERS, jitter=TOKEN_REFRESH_JITTER):
+        self.jitter = jitter
+        self.workers = workers
+        self._heap = []
+        self._entries = {}  # conta -> (due_time, seq, job)
+        self._running = set()
+        self._last_results = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        """Inicia a thread do agendador (idempotente; no relógio simulado não há thread)"""
+        if clock.simulated:
+            return
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='token-refresh-worker')
+            self._thread = threading.Thread(target=self._run, name='token-refresh', daemon=True)
+            self._thread.start()
+
+    def schedule(self, key, delay, job, jitter=True):
+        """
+        Agenda (ou reagenda) a renovação da conta daqui a `delay` segundos.
+        O jitter só antecipa: nunca deixa a renovação passar do prazo pedido.
+        Retorna: timestamp previsto
+        """
+        if jitter and self.jitter and delay > 0:
+            delay -= random.uniform(0, min(self.jitter, delay * 0.1))
+        due = clock.time() + max(0, delay)
+        with self._cond:
+            self._seq += 1
+            self._entries[key] = (due, self._seq, job)
+            heapq.heappush(self._heap, (due, self._seq, key))
+            self._cond.notify()
+        if clock.simulated:
+            clock.call_at(due, self.run_pending)
+        else:
+            self.start()
+        return due
+
+    def cancel(self, key):
+        """Remove a conta do agendamento"""
+        with self._cond:
+            self._entries.pop(key, None)
+            self._cond.notify()
+
+    def depth(self):
+        """Contas com renovação agendada"""
+        return len(self._entries)
+
+    def next_due(self, key):
+        """Timestamp da próxima renovação da conta (ou None)"""
+        with self._cond:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def status(self):
+        """Próxima renovação e último resultado por conta"""
+        now = clock.time()
+        with self._cond:
+            keys = set(self._entries) | set(self._last_results) | self._running
+            result = {}
+            for key in sorted(keys, key=str):
+                entry = self._entries.get(key)
+                result[str(key)] = {
+                    'next_due': datetime.fromtimestamp(entry[0], SAO_PAULO_TZ).isoformat() if entry else None,
+                    'next_due_in': int(max(0, entry[0] - now)) if entry else None,
+                    'running': key in self._running,
+                    'last_result': self._last_results.get(key)
+                }
+            return result
+
+    def _discard_stale(self):
+        """Descarta do topo do heap entradas canceladas ou reagendadas"""
+        while self._heap and self._entries.get(self._heap[0][2], (None, None))[1] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+
+    def _run(self):
+        """Loop do agendador: dorme até a próxima entrada vencida e a despacha"""
+        while True:
+            with self._cond:
+                while True:
+                    self._discard_stale()
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    due, seq, key = self._heap[0]
+                    wait = due - clock.time()
+                    if wait > 0:
+                        self._cond.wait(timeout=wait)
+                        continue
+                    heapq.heappop(self._heap)
+                    job = self._entries.pop(key)[2]
+                    if key in self._running:
+                        # Renovação anterior ainda rodando: tentar de novo em breve
+                        self._seq += 1
+                        self._entries[key] = (clock.time() + 5, self._seq, job)
+                        heapq.heappush(self._heap, (clock.time() + 5, self._seq, key))
+                        continue
+                    self._running.add(key)
+                    break
+            self._pool.submit(self._execute, key, job)
+
+    def run_pending(self):
+        """Executa na thread atual as renovações vencidas (relógio simulado)"""
+        while True:
+            with self._cond:
+                self._discard_stale()
+                if not self._heap or self._heap[0][0] > clock.time():
+                    return
+                due, seq, key = heapq.heappop(self._heap)
+                job = self._entries.pop(key)[2]
+                self._running.add(key)
+            self._execute(key, job)
+
+    def _execute(self, key, job):
+        """Executa a renovação no pool e registra o resultado"""
+        started = time.time()
+        try:
+            success = job()
+            outcome = {'success': bool(success), 'error': None}
+        except Exception as e:
+            outcome = {'success': False, 'error': str(e)}
+        finally:
+            with self._cond:
+                self._running.discard(key)
+        outcome['at'] = get_local_time().isoformat()
+        outcome['duration'] = round(time.time() - started, 3)
+        with self._cond:
+            self._last_results[key] = outcome
+
+token_scheduler = TokenRefreshScheduler()
+
 class AutoTokenRefresh:
     """Sistema de renovação automática de tokens baseado em tempo (multi-conta-ready)."""
 
     def __init__(self):
         self.ml_user_id = None  # identifica o usuário dono do token
-        self.refresh_timer = None
-        self.is_refreshing = False
         self.token_created_at = None
         self.token_expires_at = None
         self.auto_refresh_enabled = True
         self.refresh_interval = 5 * 3600  # 5 horas em segundos
 
-    def start_auto_refresh(self, expires_in=21600):
+    def start_auto_refresh(self, expires_in=TOKEN_DEFAULT_EXPIRES_IN):
         """
         Inicia sistema de renovação automática.
         :param expires_in: Tempo de expiração do access token em segundos (padrão: 6 horas).
@@ -116,60 +474,53 @@ class AutoTokenRefresh:
             add_debug_log("🔄 Auto-renovação desabilitada")
             return
 
-        # Cancelar timer anterior se existir
-        if self.refresh_timer:
-            self.refresh_timer.cancel()
-            add_debug_log("⏹️ Timer anterior cancelado")
-
         # Calcular quando renovar (5 horas = 18000 segundos)
         refresh_delay = min(self.refresh_interval, max(expires_in - 3600, 300))  # mínimo 5 minutos
 
         # Atualizar timestamps
-        self.token_created_at = time.time()
+        self.token_created_at = clock.time()
         self.token_expires_at = self.token_created_at + expires_in
 
-        # Agendar renovação
-        self.refresh_timer = threading.Timer(refresh_delay, self.auto_refresh)
-        self.refresh_timer.start()
+        # Agendar renovação (substitui agendamento anterior desta conta)
+        due = self.schedule_refresh(refresh_delay)
 
         # Log detalhado
-        refresh_time = datetime.fromtimestamp(self.token_created_at + refresh_delay)
-        expires_time = datetime.fromtimestamp(self.token_expires_at)
-        add_debug_log(f"🕐 Auto-renovação agendada para {refresh_delay}s ({refresh_time.strftime('%H:%M:%S')})")
+        refresh_time = datetime.fromtimestamp(due, SAO_PAULO_TZ)
+        expires_time = datetime.fromtimestamp(self.token_expires_at, SAO_PAULO_TZ)
+        add_debug_log(f"🕐 Auto-renovação agendada para {int(due - clock.time())}s ({refresh_time.strftime('%H:%M:%S')})")
         add_debug_log(f"⏰ Token expira em: {expires_time.strftime('%H:%M:%S')}")
 
-    def auto_refresh(self):
-        """Executa renovação automática do token."""
-        if self.is_refreshing:
-            add_debug_log("⚠️ Renovação já em andamento, ignorando")
-            return
+    @property
+    def schedule_key(self):
+        """Chave desta conta no agendador central"""
+        return self.ml_user_id or 'default'
 
-        self.is_refreshing = True
-        try:
-            add_debug_log("🔄 Iniciando renovação automática de token...")
-            success, result = self.process_refresh_token_internal()
-
-            if success:
-                self.update_system_tokens_internal(
-                    result['access_token'],
-                    result.get('refresh_token', ''),
-                    result.get('user_id')
-                )
-                self.start_auto_refresh(result.get('expires_in', 21600))
-                add_debug_log("✅ Renovação automática concluída com sucesso")
-            else:
-                retry_delay = 600  # 10 min
-                self.refresh_timer = threading.Timer(retry_delay, self.auto_refresh)
-                self.refresh_timer.start()
-                add_debug_log(f"❌ Falha na renovação automática, tentando novamente em {retry_delay//60} min")
-        except Exception as e:
-            add_debug_log(f"❌ Erro na renovação automática: {e}")
-            retry_delay = 300  # 5 min
-            self.refresh_timer = threading.Timer(retry_delay, self.auto_refresh)
-            self.refresh_timer.start()
-            add_debug_log(f"🔄 Reagendando tentativa em {retry_delay//60} min")
-        finally:
-            self.is_refreshing = False
+    @property
+    def is_refreshing(self):
+        """Há renovação em andamento para a conta (agendada, forçada ou por 401)"""
+        return self.schedule_key in _token_refresh_inflight
+
+    def schedule_refresh(self, delay, jitter=True):
+        """Agenda a próxima renovação no agendador central"""
+        return token_scheduler.schedule(self.schedule_key, delay, self.auto_refresh, jitter=jitter)
+
+    def auto_refresh(self):
+        """
+        Executa renovação automática do token. Retorna True se renovou.
+        Passa pelo single-flight de refresh_account_token: se um 401 ou uma
+        renovação forçada já estiver renovando a conta, espera por ela.
+        """
+        add_debug_log("🔄 Iniciando renovação automática de token...")
+        credentials = credential_registry.get(self.schedule_key)
+        stale_token = credentials.access_token if credentials else None
+        # Em sucesso, update_system_tokens já reagenda a próxima renovação
+        if refresh_account_token(self.schedule_key, stale_token, reason='renovação agendada'):
+            add_debug_log("✅ Renovação automática concluída com sucesso")
+            return True
+        retry_delay = 600  # 10 min
+        self.schedule_refresh(retry_delay)
+        add_debug_log(f"❌ Falha na renovação automática, tentando novamente em {retry_delay//60} min")
+        return False
 
     def process_refresh_token_internal(self):
         """Processa renovação usando refresh token do usuário configurado (ou global como fallback)."""
@@ -190,7 +541,7 @@ class AutoTokenRefresh:
             if not rt:
                 return False, {'error': 'Refresh token não disponível'}
 
-            url = "https://api.mercadolibre.com/oauth/token"
+            url = f"{ML_API_BASE_URL}/oauth/token"
             data = {
                 'grant_type': 'refresh_token',
                 'client_id': ML_CLIENT_ID,
@@ -199,7 +550,10 @@ class AutoTokenRefresh:
             }
 
             add_debug_log("🔄 Enviando requisição de renovação...")
+            start = time.perf_counter()
             response = requests.post(url, data=data, timeout=30)
+            ML_REQUEST_SECONDS.labels('/oauth/token', 'POST', str(response.status_code)).observe(time.perf_counter() - start)
+            traffic_capture.record_ml('POST', url, {'data': data}, response, time.perf_counter() - start)
 
             if response.status_code == 200:
                 token_data = response.json()
@@ -208,7 +562,7 @@ class AutoTokenRefresh:
                     'access_token': token_data['access_token'],
                     'refresh_token': token_data.get('refresh_token', ''),
                     'user_id': str(token_data.get('user_id', uid)),
-                    'expires_in': token_data.get('expires_in', 21600)
+                    'expires_in': token_data.get('expires_in', TOKEN_DEFAULT_EXPIRES_IN)
                 }
                 add_debug_log("✅ Renovação via refresh token bem-sucedida")
                 return True, result
@@ -221,27 +575,29 @@ class AutoTokenRefresh:
             add_debug_log(f"❌ Erro na requisição de renovação: {e}")
             return False, {'error': str(e)}
 
-    def update_system_tokens_internal(self, access_token, refresh_token, user_id):
-        """Atualiza tokens no sistema"""
-        global ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, ML_USER_ID
+    def update_system_tokens_internal(self, access_token, refresh_token, user_id, expires_in=TOKEN_DEFAULT_EXPIRES_IN):
+        """Atualiza tokens no sistema, gravando a expiração real informada pelo ML"""
+        global ML_ACCESS_TOKEN, ML_REFRESH_TOKEN
 
-        # Atualizar variáveis globais
-        ML_ACCESS_TOKEN = access_token
-        ML_REFRESH_TOKEN = refresh_token
-        ML_USER_ID = user_id
+        # Variáveis globais refletem só a conta principal
+        if str(user_id) == str(ML_USER_ID):
+            ML_ACCESS_TOKEN = access_token
+            ML_REFRESH_TOKEN = refresh_token
 
-        # Atualizar no banco de dados
+        # Atualizar no banco de dados (chamado também das threads de renovação)
         try:
-            user = User.query.filter_by(ml_user_id=user_id).first()
-            if user:
-                user.access_token = access_token
-                user.refresh_token = refresh_token
-                user.token_expires_at = datetime.utcnow() + timedelta(hours=6)
-                user.updated_at = get_local_time_utc()
-                db.session.commit()
-                add_debug_log("💾 Tokens atualizados no banco de dados")
-            else:
-                add_debug_log("⚠️ Usuário não encontrado no banco para atualizar tokens")
+            with app.app_context():
+                user = User.query.filter_by(ml_user_id=user_id).first()
+                if user:
+                    user.access_token = access_token
+                    user.refresh_token = refresh_token
+                    user.token_expires_at = get_local_time_utc() + timedelta(seconds=int(expires_in))
+                    user.updated_at = get_local_time_utc()
+                    db.session.commit()
+                    credential_registry.update(user_id, access_token, refresh_token, user.token_expires_at, user.id)
+                    add_debug_log("💾 Tokens atualizados no banco de dados")
+                else:
+                    add_debug_log("⚠️ Usuário não encontrado no banco para atualizar tokens")
 
         except Exception as e:
             add_debug_log(f"❌ Erro ao atualizar tokens no banco: {e}")
@@ -258,12 +614,12 @@ class AutoTokenRefresh:
                 'is_refreshing': getattr(self, 'is_refreshing', False)
             }
 
-        current_time = time.time()
+        current_time = clock.time()
         time_remaining = max(0, self.token_expires_at - current_time)
 
-        # Calcular próxima renovação
-        next_refresh_time = self.token_created_at + self.refresh_interval
-        next_refresh = max(0, next_refresh_time - current_time)
+        # Próxima renovação segundo o agendador central
+        next_refresh_time = token_scheduler.next_due(self.schedule_key)
+        next_refresh = max(0, next_refresh_time - current_time) if next_refresh_time else 0
 
         # Determinar status
         if time_remaining <= 0:
@@ -287,9 +643,8 @@ class AutoTokenRefresh:
 
     def stop_auto_refresh(self):
         """Para o sistema de renovação automática"""
-        if self.refresh_timer:
-            self.refresh_timer.cancel()
-            self.refresh_timer = None
+        if token_scheduler.next_due(self.schedule_key):
+            token_scheduler.cancel(self.schedule_key)
             add_debug_log("⏹️ Sistema de auto-renovação parado")
 
     def enable_auto_refresh(self):
@@ -321,74 +676,531 @@ class AutoTokenRefreshManager:
 multi_refresh = AutoTokenRefreshManager()
 
 
+# A instância global passa a ser a da conta principal (um único agendamento por conta)
+auto_refresh_manager.ml_user_id = str(ML_USER_ID)
+multi_refresh.instances[str(ML_USER_ID)] = auto_refresh_manager
+
+def token_seconds_remaining(credentials):
+    """Segundos até a expiração salva no banco (None se desconhecida)"""
+    if not credentials.expires_at:
+        return None
+    expires_at = credentials.expires_at.replace(tzinfo=timezone.utc).timestamp()
+    return expires_at - clock.time()
+
 def initialize_auto_refresh():
-    """Inicializa sistema de renovação automática baseado no token atual"""
+    """
+    (Re)agenda a renovação de todas as contas a partir da expiração salva.
+    Contas vencidas ou quase vencidas são renovadas já, espalhadas em
+    TOKEN_RECOVERY_SPREAD segundos e limitadas pelo pool do agendador.
+    """
     try:
-        # Verificar se temos refresh token
-        if not ML_REFRESH_TOKEN:
-            add_debug_log("⚠️ Refresh token não disponível, auto-renovação não iniciada")
-            return False
-        
-        # Calcular tempo restante do token atual (assumindo 6 horas de validade)
-        # Em produção, isso seria obtido do banco de dados
-        current_time = time.time()
-        
-        # Verificar se temos informação de quando o token foi criado
-        user = User.query.filter_by(ml_user_id=ML_USER_ID).first()
-        if user and user.token_expires_at:
-            # Usar informação do banco
-            expires_at = user.token_expires_at.timestamp()
-            time_remaining = max(0, expires_at - current_time)
-        else:
-            # Assumir token recém-criado (6 horas de validade)
-            time_remaining = 21600  # 6 horas
-        
-        if time_remaining > 0:
-            auto_refresh_manager.start_auto_refresh(int(time_remaining))
-            add_debug_log(f"🚀 Sistema de auto-renovação inicializado com {int(time_remaining//3600)}h restantes")
-            return True
-        else:
-            add_debug_log("⚠️ Token já expirado, auto-renovação não iniciada")
-            return False
-            
+        scheduled = 0
+        stale = 0
+        for credentials in credential_registry.all():
+            if not (credentials.refresh_token or (str(credentials.ml_user_id) == str(ML_USER_ID) and ML_REFRESH_TOKEN)):
+                continue
+            inst = multi_refresh.get(credentials.ml_user_id)
+            if not inst.auto_refresh_enabled:
+                continue
+            remaining = token_seconds_remaining(credentials)
+            if remaining is not None and remaining > TOKEN_STALE_MARGIN:
+                inst.start_auto_refresh(int(remaining))
+                scheduled += 1
+            else:
+                inst.token_created_at = clock.time()
+                inst.token_expires_at = clock.time() + max(0, remaining or 0)
+                inst.schedule_refresh(random.uniform(0, TOKEN_RECOVERY_SPREAD), jitter=False)
+                stale += 1
+        add_debug_log(f"🚀 Auto-renovação inicializada: {scheduled} conta(s) agendada(s), {stale} renovando agora")
+        return scheduled + stale > 0
     except Exception as e:
         add_debug_log(f"❌ Erro ao inicializar auto-renovação: {e}")
         return False
 
 # ========== SISTEMA DE DEBUG E LOGS ==========
 # Baseado no módulo modulo_debug_logs_tempo_real.py
-DEBUG_LOGS = []
-MAX_DEBUG_LOGS = 100
-debug_lock = threading.Lock()
+# Registros estruturados em um buffer circular (deque) em memória. A formatação
+# da mensagem é adiada até a leitura e descartada se o nível estiver filtrado;
+# stdout e arquivo ficam com uma thread própria, fora do caminho quente.
+LOG_DEBUG, LOG_INFO, LOG_WARNING, LOG_ERROR = 10, 20, 30, 40
+LOG_LEVEL_NAMES = {LOG_DEBUG: 'DEBUG', LOG_INFO: 'INFO', LOG_WARNING: 'WARNING', LOG_ERROR: 'ERROR'}
+LOG_LEVELS = {name: level for level, name in LOG_LEVEL_NAMES.items()}
+LOG_LEVEL = LOG_LEVELS.get(os.getenv('LOG_LEVEL', 'INFO').upper(), LOG_INFO)
+MAX_DEBUG_LOGS = int(os.getenv('LOG_BUFFER_SIZE', '1000'))
+LOG_FILE = os.path.join(LOGS_PATH, 'bot_ml.log')
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES', str(5 * 1024 * 1024)))
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS', '5'))
+LOG_FLUSH_INTERVAL = 0.5  # segundos
+LOG_STREAM_MAX_CLIENTS = int(os.getenv('LOG_STREAM_MAX_CLIENTS', '10'))
+LOG_STREAM_HEARTBEAT = 15  # segundos
+
+_log_seq = itertools.count(1)  # next() é atômico no CPython
+
+class LogRecord:
+    """Registro de log; a mensagem só é montada quando alguém a lê"""
+
+    __slots__ = ('seq', 'created', 'level', 'thread', 'msg', 'args', '_message')
+
+    def __init__(self, level, msg, args):
+        self.seq = next(_log_seq)
+        self.created = time.time()
+        self.level = level
+        self.thread = threading.current_thread().name
+        self.msg = msg
+        self.args = args
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None:
+            try:
+                self._message = self.msg % self.args if self.args else str(self.msg)
+            except Exception:
+                self._message = f"{self.msg} {self.args}"
+        return self._message
 
-def add_debug_log(message):
-    """Adiciona log de debug com timestamp"""
-    global DEBUG_LOGS
-    
-    with debug_lock:
-        timestamp = get_local_time().strftime("%H:%M:%S")
-        log_entry = f"[{timestamp}] {message}"
-        DEBUG_LOGS.append(log_entry)
-        
-        if len(DEBUG_LOGS) > MAX_DEBUG_LOGS:
-            DEBUG_LOGS.pop(0)
-        
-        print(log_entry)
+    def format(self):
+        """Linha legível, no formato histórico [HH:MM:SS] mensagem"""
+        timestamp = datetime.fromtimestamp(self.created, SAO_PAULO_TZ).strftime("%H:%M:%S")
+        return f"[{timestamp}] {self.message}"
+
+    def to_dict(self):
+        return {
+            "seq": self.seq,
+            "time": datetime.fromtimestamp(self.created, SAO_PAULO_TZ).isoformat(),
+            "level": LOG_LEVEL_NAMES.get(self.level, str(self.level)),
+            "thread": self.thread,
+            "message": self.message
+        }
+
+DEBUG_LOGS = deque(maxlen=MAX_DEBUG_LOGS)
+
+def _infer_log_level(message):
+    """Nível pelo prefixo usado nas mensagens (❌ erro, ⚠️ aviso)"""
+    if isinstance(message, str):
+        if message.startswith('❌'):
+            return LOG_ERROR
+        if message.startswith('⚠️'):
+            return LOG_WARNING
+    return LOG_INFO
+
+class BatchWriter:
+    """
+    Base das threads de escrita em lote: a thread acumula itens por `interval`
+    segundos e chama write(). flush() entrega um marcador à própria thread e
+    espera por ele, então nenhum item fica retido fora do alcance do flush
+    (nem o lote que a thread está acumulando) e as gravações nunca se cruzam.
+    """
+
+    def __init__(self, thread_name, interval, label):
+        self.thread_name = thread_name
+        self.interval = interval
+        self.label = label
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        """Inicia a thread de escrita (idempotente)"""
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self.thread.start()
+
+    def put(self, item):
+        if self.thread is None:
+            self.start()
+        self.queue.put(item)
+
+    def _drain(self):
+        batch = []
+        try:
+            while True:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            return batch
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if not isinstance(first, threading.Event):
+                self.wake.wait(self.interval)  # acumula o lote (um flush acorda antes)
+            self.wake.clear()
+            self._process([first] + self._drain())
+
+    def _process(self, items):
+        """Grava os itens e libera os marcadores de flush que vieram junto"""
+        markers = [item for item in items if isinstance(item, threading.Event)]
+        batch = [item for item in items if not isinstance(item, threading.Event)]
+        try:
+            if batch:
+                with self.write_lock:
+                    self.write(batch)
+        except Exception as e:
+            print(f"⚠️ Falha ao gravar {self.label}: {e}")
+        finally:
+            for marker in markers:
+                marker.set()
+
+    def flush(self, timeout=5):
+        """Grava tudo o que já foi enfileirado e espera a gravação (usado no encerramento)"""
+        thread = self.thread
+        if thread is None or not thread.is_alive() or thread is threading.current_thread():
+            self._process(self._drain())
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        self.wake.set()
+        done.wait(timeout)
+
+    def write(self, batch):
+        raise NotImplementedError
+
+class LogWriter(BatchWriter):
+    """Thread que grava os registros em lote no stdout e em arquivos rotativos (NDJSON)"""
+
+    def __init__(self, path=LOG_FILE, max_bytes=LOG_FILE_MAX_BYTES, backups=LOG_FILE_BACKUPS):
+        super().__init__('log-writer', LOG_FLUSH_INTERVAL, 'logs')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, batch):
+        log_stream.notify()
+        print('\n'.join(record.format() for record in batch), flush=True)
+        try:
+            self._rotate_if_needed()
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(record.to_dict(), ensure_ascii=False) + '\n' for record in batch))
+        except OSError as e:
+            print(f"⚠️ Falha ao gravar arquivo de log {self.path}: {e}")
+
+    def _rotate_if_needed(self):
+        """bot_ml.log -> bot_ml.log.1 -> ... -> bot_ml.log.N (descarta o mais antigo)"""
+        try:
+            if os.path.getsize(self.path) < self.max_bytes:
+                return
+        except OSError:
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+class LogStream:
+    """
+    Avisa os clientes SSE de que há registros novos. Quem acorda é a thread
+    log-writer, a cada lote; add_debug_log não toca em locks.
+    """
+
+    def __init__(self, max_clients=LOG_STREAM_MAX_CLIENTS):
+        self.max_clients = max_clients
+        self.clients = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        if self.clients:
+            with self.condition:
+                self.condition.notify_all()
+
+    def wait_for_new(self, after_seq, timeout):
+        """Bloqueia até existir registro com seq > after_seq (ou até o timeout)"""
+        with self.condition:
+            self.condition.wait_for(lambda: last_log_seq() > after_seq, timeout)
+
+    def acquire(self):
+        with self.condition:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.clients -= 1
+
+log_stream = LogStream()
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
+
+def add_debug_log(message, *args, level=None):
+    """
+    Registra log. Use args para formatação preguiçosa:
+    add_debug_log("Pergunta %s", qid, level=LOG_DEBUG)
+    """
+    if level is None:
+        level = _infer_log_level(message)
+    if level < LOG_LEVEL:
+        return
+    record = LogRecord(level, message, args)
+    DEBUG_LOGS.append(record)
+    log_writer.put(record)
+
+def get_debug_records(limit=None, min_level=None, since=None):
+    """Registros do buffer (mais antigos primeiro), filtrados por nível e por seq > since"""
+    if since:
+        records = []
+        for record in reversed(DEBUG_LOGS.copy()):
+            if record.seq <= since:
+                break
+            records.append(record)
+        records.reverse()
+    else:
+        records = list(DEBUG_LOGS)
+    if min_level:
+        records = [r for r in records if r.level >= min_level]
+    return records[-limit:] if limit else records
 
 def get_debug_logs(limit=None):
     """Retorna os logs de debug"""
-    with debug_lock:
-        if limit:
-            return DEBUG_LOGS[-limit:] if DEBUG_LOGS else ["Nenhum log ainda"]
-        return DEBUG_LOGS.copy() if DEBUG_LOGS else ["Nenhum log ainda"]
+    records = get_debug_records(limit)
+    return [r.format() for r in records] if records else ["Nenhum log ainda"]
+
+def last_log_seq():
+    """Seq do registro mais recente do buffer (0 se vazio)"""
+    try:
+        return DEBUG_LOGS[-1].seq
+    except IndexError:
+        return 0
+
+def is_stale_log_cursor(cursor):
+    """
+    Cursor à frente do buffer veio de outro processo: o seq recomeça em 1 a
+    cada reinício/deploy, então o cliente deve recomeçar do registro mais antigo
+    """
+    return bool(cursor) and cursor > last_log_seq()
 
 def clear_debug_logs():
     """Limpa todos os logs de debug"""
-    global DEBUG_LOGS
-    
-    with debug_lock:
-        DEBUG_LOGS.clear()
-        add_debug_log("🗑️ Logs de debug limpos")
+    DEBUG_LOGS.clear()
+    add_debug_log("🗑️ Logs de debug limpos")
+
+# ========== MÉTRICAS (FORMATO PROMETHEUS) ==========
+# Métricas em memória expostas em /metrics. Cada série tem seu próprio lock
+# (incremento é leitura-modificação-escrita e perderia valores entre threads);
+# o lock da métrica é usado apenas ao criar ou remover séries de labels.
+
+METRICS_REGISTRY = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SLOW_LATENCY_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """Formata {k="v",...} com o escape do formato de texto do Prometheus"""
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+class _Metric:
+    """Base das métricas: séries por combinação de labels"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS_REGISTRY.append(self)
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Série para os valores de labels (criada uma única vez)"""
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.get(values)
+                if series is None:
+                    series = self._series[values] = self._new_series()
+        return series
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, series in list(self._series.items()):
+            lines.extend(self._render_series(_format_labels(self.labelnames, values), values, series))
+        return lines
+
+class _CounterSeries:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_series(self):
+        return _CounterSeries()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def _render_series(self, labels, values, series):
+        return [f"{self.name}_total{labels} {series.value}"]
+
+class _GaugeSeries(_CounterSeries):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+class Gauge(_Metric):
+    """Gauge; com `collect`, os valores são lidos na hora da coleta: collect() -> [(labels, valor)]"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.collect = collect
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _GaugeSeries()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def render(self):
+        if self.collect:
+            try:
+                seen = set()
+                for values, value in self.collect():
+                    values = tuple(values)
+                    seen.add(values)
+                    self.labels(*values).set(value)
+                # Séries que sumiram da coleta (ex.: grupo de threads encerrado) saem da exposição
+                with self._lock:
+                    for values in [v for v in self._series if v not in seen]:
+                        del self._series[values]
+            except Exception as e:
+                add_debug_log(f"⚠️ Erro ao coletar métrica {self.name}: {e}")
+        return super().render()
+
+    def _render_series(self, labels, values, series):
+        return [f"{self.name}{labels} {series.value}"]
+
+class _HistogramSeries:
+    __slots__ = ('buckets', 'counts', 'sum', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # último = +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """(contagens, soma) consistentes entre si"""
+        with self.lock:
+            return list(self.counts), self.sum
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_series(self):
+        return _HistogramSeries(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _render_series(self, labels, values, series):
+        counts, total = series.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, values, ('le', le))} {cumulative}")
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+def timed(histogram):
+    """Decorador: observa a duração da função no histograma (sem labels)"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def render_metrics():
+    """Texto no formato de exposição do Prometheus (0.0.4)"""
+    lines = []
+    for metric in METRICS_REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+_ML_PATH_ID = re.compile(r'/(?:\d+|MLB\d+|[A-Z]{3}\d+)(?=/|$)')
+
+def ml_endpoint_label(url):
+    """Caminho da API do ML com ids trocados por {id} (cardinalidade limitada)"""
+    path = url.split('://', 1)[-1].split('?', 1)[0]
+    path = path[path.find('/'):] if '/' in path else '/'
+    return _ML_PATH_ID.sub('/{id}', path)
+
+ML_REQUEST_SECONDS = Histogram(
+    'botml_ml_api_request_seconds', 'Latência das chamadas à API do Mercado Livre',
+    ('endpoint', 'method', 'status')
+)
+CLASSIFICATION_SECONDS = Histogram(
+    'botml_classification_seconds', 'Tempo de busca de regra por palavra-chave (find_auto_response)'
+)
+ABSENCE_LOOKUP_SECONDS = Histogram(
+    'botml_absence_lookup_seconds', 'Tempo de verificação de horário de ausência (is_absence_time)'
+)
+DB_COMMIT_SECONDS = Histogram(
+    'botml_db_commit_seconds', 'Latência de commit dos lotes da fila de escrita'
+)
+DB_COMMIT_BATCH_SIZE = Histogram(
+    'botml_db_commit_batch_size', 'Mutações por commit da fila de escrita',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+WEBHOOK_TO_ANSWER_SECONDS = Histogram(
+    'botml_webhook_to_answer_seconds', 'Tempo entre o recebimento do webhook e a resposta enviada ao ML',
+    ('response_type',), buckets=SLOW_LATENCY_BUCKETS
+)
+WEBHOOKS_RECEIVED = Counter('botml_webhooks_received', 'Notificações de webhook recebidas', ('topic',))
+QUESTIONS_ANSWERED = Counter('botml_questions_answered', 'Perguntas respondidas', ('response_type', 'source'))
+WEBHOOK_WORKERS_ACTIVE = Gauge('botml_webhook_workers_active', 'Threads de webhook em andamento')
 
 # ========== MODELOS DO BANCO DE DADOS ==========
 # Baseado nos módulos funcionais salvos
@@ -414,6 +1226,9 @@ class AutoResponse(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=get_local_time_utc)
     updated_at = db.Column(db.DateTime, default=get_local_time_utc, onupdate=get_local_time_utc)
+    __table_args__ = (
+        db.Index('ix_auto_responses_user_active', 'user_id', 'is_active'),
+    )
 
 class Question(db.Model):
     """Perguntas recebidas do Mercado Livre"""
@@ -428,6 +1243,11 @@ class Question(db.Model):
     answered_automatically = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=get_local_time_utc)
     answered_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_questions_answered', 'is_answered', 'answered_at'),
+        db.Index('ix_questions_created_at', 'created_at'),
+        db.Index('ix_questions_item', 'item_id'),
+    )
 
 class AbsenceConfig(db.Model):
     """Configurações de mensagens de ausência por horário"""
@@ -441,6 +1261,9 @@ class AbsenceConfig(db.Model):
     days_of_week = db.Column(db.String(20), nullable=False)  # 0,1,2,3,4,5,6
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=get_local_time_utc)
+    __table_args__ = (
+        db.Index('ix_absence_configs_user_active', 'user_id', 'is_active'),
+    )
 
 class ResponseHistory(db.Model):
     """Histórico de respostas enviadas"""
@@ -450,8 +1273,41 @@ class ResponseHistory(db.Model):
     question_id = db.Column(db.Integer, db.ForeignKey('questions.id'), nullable=False)
     response_type = db.Column(db.String(20), nullable=False)  # 'auto', 'absence', 'manual'
     keywords_matched = db.Column(db.String(200))
-    response_time = db.Column(db.Float)  # tempo em segundos para responder
+    response_time = db.Column(db.Float)  # segundos entre a pergunta ser vista e a resposta ser enviada
+    sla_seconds = db.Column(db.Float)  # segundos entre date_created no ML e a resposta aceita
+    trace_id = db.Column(db.String(32))  # question_traces.trace_id
     created_at = db.Column(db.DateTime, default=get_local_time_utc)
+    __table_args__ = (
+        db.Index('ix_response_history_created_id', 'created_at', 'id'),
+        db.Index('ix_response_history_type_created_id', 'response_type', 'created_at', 'id'),
+        db.Index('ix_response_history_user_created_id', 'user_id', 'created_at', 'id'),
+        db.Index('ix_response_history_keywords_created_id', 'keywords_matched', 'created_at', 'id'),
+        db.Index('ix_response_history_question', 'question_id'),
+        db.Index('ix_response_history_trace', 'trace_id'),
+    )
+
+class QuestionTrace(db.Model):
+    """Tempo de cada etapa do processamento de uma pergunta (milissegundos)"""
+    __tablename__ = 'question_traces'
+    id = db.Column(db.Integer, primary_key=True)
+    trace_id = db.Column(db.String(32), unique=True, nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey('questions.id'))
+    ml_question_id = db.Column(db.String(50))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    source = db.Column(db.String(10))   # 'webhook', 'poll'
+    outcome = db.Column(db.String(20))  # 'auto', 'absence', 'none', 'error', 'skipped', 'unavailable'
+    queue_ms = db.Column(db.Float)
+    fetch_ms = db.Column(db.Float)
+    classify_ms = db.Column(db.Float)
+    absence_ms = db.Column(db.Float)
+    send_ms = db.Column(db.Float)
+    persist_ms = db.Column(db.Float)
+    total_ms = db.Column(db.Float)
+    created_at = db.Column(db.DateTime, default=get_local_time_utc)
+    __table_args__ = (
+        db.Index('ix_question_traces_created', 'created_at'),
+        db.Index('ix_question_traces_question', 'question_id'),
+    )
 
 class TokenLog(db.Model):
     """Logs de verificação de token"""
@@ -473,26 +1329,901 @@ class WebhookLog(db.Model):
     attempts = db.Column(db.Integer, default=1)
     sent = db.Column(db.DateTime)
     received = db.Column(db.DateTime, default=get_local_time_utc)
+    __table_args__ = (
+        db.Index('ix_webhook_logs_received', 'received'),
+    )
 
+class DailyStat(db.Model):
+    """Estatísticas diárias agregadas por conta e tipo de resposta (rollup incremental)"""
+    __tablename__ = 'daily_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)  # dia no fuso de São Paulo
+    response_type = db.Column(db.String(20), nullable=False)  # 'auto', 'absence', 'manual', 'received'
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total_time = db.Column(db.Float, nullable=False, default=0.0)  # soma de response_time
+    min_time = db.Column(db.Float)
+    max_time = db.Column(db.Float)
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day', 'response_type', name='uq_daily_stats_key'),
+        db.Index('ix_daily_stats_day', 'day', 'response_type'),
+    )
 
+class SharedState(db.Model):
+    """Chaves com TTL compartilhadas entre processos (backend SQL do SharedStateStore)"""
+    __tablename__ = 'shared_state'
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.Float)  # epoch em segundos; NULL = sem expiração
+    updated_at = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        db.Index('ix_shared_state_expires', 'expires_at'),
+    )
 
-# ====== MULTI-CONTA: utilidades de tokens por usuário ======
-def get_user_tokens_by_ml_id(ml_user_id: str):
-    """Retorna (access_token, refresh_token) do usuário no banco."""
+class SchemaMigration(db.Model):
+    """Migrações de esquema já aplicadas"""
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=get_local_time_utc)
+
+# ========== MIGRAÇÕES DE ESQUEMA ==========
+# db.create_all() só cria tabelas ausentes; alterações em tabelas existentes
+# (índices, colunas novas) passam por migrações versionadas aplicadas no boot.
+
+SCHEMA_MIGRATIONS = []
+MIGRATION_LOCK_KEY = 5510376630  # chave do pg_advisory_xact_lock
+
+def schema_migration(version, name):
+    """Registra uma migração versionada (aplicadas em ordem crescente de versão)"""
+    def decorator(func):
+        if any(v == version for v, _, _ in SCHEMA_MIGRATIONS):
+            raise RuntimeError(f"Migração {version} registrada duas vezes")
+        SCHEMA_MIGRATIONS.append((version, name, func))
+        SCHEMA_MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+def column_exists(conn, table, column):
+    """Verifica se a coluna já existe na tabela"""
+    return any(c['name'] == column for c in inspect(conn).get_columns(table))
+
+def add_column_if_missing(conn, table, column, ddl):
+    """
+    Adiciona coluna de forma idempotente (ALTER TABLE ... ADD COLUMN).
+    A coluna deve ser nullable ou ter DEFAULT constante, senão o SQLite recusa.
+    """
+    if column_exists(conn, table, column):
+        return False
+    conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return True
+
+def create_index_if_missing(conn, name, table, columns):
+    """Cria índice de forma idempotente"""
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+def _acquire_migration_lock(conn):
+    """Serializa migrações entre processos (workers do gunicorn)"""
+    if conn.dialect.name == 'sqlite':
+        # Reserva o lock de escrita do arquivo até o COMMIT
+        conn.exec_driver_sql('BEGIN IMMEDIATE')
+    elif conn.dialect.name == 'postgresql':
+        # Lock consultivo liberado automaticamente no fim da transação
+        conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+
+def run_schema_migrations():
+    """
+    Aplica migrações pendentes em uma única transação, sob lock.
+    Retorna: lista de versões aplicadas
+    """
+    applied_now = []
+    with db.engine.connect() as conn:
+        _acquire_migration_lock(conn)
+        try:
+            applied = {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+            for version, name, func in SCHEMA_MIGRATIONS:
+                if version in applied:
+                    continue
+                add_debug_log(f"🧱 Aplicando migração {version:03d}: {name}")
+                func(conn)
+                conn.execute(
+                    text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)'),
+                    {'v': version, 'n': name, 't': get_local_time_utc()}
+                )
+                applied_now.append(version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    if applied_now:
+        add_debug_log(f"✅ Migrações aplicadas: {applied_now}")
+    return applied_now
+
+@schema_migration(1, 'indices_caminho_quente')
+def _migration_001_hot_path_indexes(conn):
+    """Índices para dashboard, histórico, webhooks e busca de regras"""
+    create_index_if_missing(conn, 'ix_questions_answered', 'questions', ['is_answered', 'answered_at'])
+    create_index_if_missing(conn, 'ix_questions_created_at', 'questions', ['created_at'])
+    create_index_if_missing(conn, 'ix_response_history_created_at', 'response_history', ['created_at'])
+    create_index_if_missing(conn, 'ix_response_history_type_created', 'response_history', ['response_type', 'created_at'])
+    create_index_if_missing(conn, 'ix_response_history_question', 'response_history', ['question_id'])
+    create_index_if_missing(conn, 'ix_webhook_logs_received', 'webhook_logs', ['received'])
+    create_index_if_missing(conn, 'ix_auto_responses_user_active', 'auto_responses', ['user_id', 'is_active'])
+    create_index_if_missing(conn, 'ix_absence_configs_user_active', 'absence_configs', ['user_id', 'is_active'])
+
+
+
+# ========== ROLLUP DE ESTATÍSTICAS DIÁRIAS ==========
+# Cada ResponseHistory/Question inserido incrementa daily_stats na mesma
+# transação, então dashboard, /history e /status leem O(dias) linhas.
+
+DAILY_STATS_RECEIVED = 'received'  # pseudo-tipo: perguntas recebidas
+ANSWER_RESPONSE_TYPES = ('auto', 'absence', 'manual')
+
+def local_day(utc_datetime):
+    """Dia (São Paulo) de um datetime UTC salvo no banco"""
+    return format_local_time(utc_datetime or get_local_time_utc()).date()
+
+def record_daily_stat(connection, user_id, response_type, created_at, response_time=None):
+    """Incrementa o rollup diário com upsert atômico"""
+    if user_id is None or not response_type:
+        return
+    has_time = response_time is not None
+    stmt = dialect_insert(connection, DailyStat.__table__).values(
+        user_id=user_id,
+        day=local_day(created_at),
+        response_type=response_type,
+        count=1,
+        total_time=response_time if has_time else 0.0,
+        min_time=response_time,
+        max_time=response_time
+    )
+    table = DailyStat.__table__.c
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'day', 'response_type'],
+        set_={
+            'count': table.count + 1,
+            'total_time': table.total_time + excluded.total_time,
+            'min_time': db.func.coalesce(scalar_min(connection, table.min_time, excluded.min_time), excluded.min_time) if has_time else table.min_time,
+            'max_time': db.func.coalesce(scalar_max(connection, table.max_time, excluded.max_time), excluded.max_time) if has_time else table.max_time,
+        }
+    )
+    connection.execute(stmt)
+
+@event.listens_for(ResponseHistory, 'after_insert')
+def _rollup_response_history(mapper, connection, target):
+    record_daily_stat(connection, target.user_id, target.response_type, target.created_at, target.response_time)
+
+@event.listens_for(Question, 'after_insert')
+def _rollup_question(mapper, connection, target):
+    record_daily_stat(connection, target.user_id, DAILY_STATS_RECEIVED, target.created_at)
+
+def backfill_daily_stats(connection=None):
+    """
+    Reconstrói daily_stats a partir de questions e response_history.
+    Agrega em streaming (memória proporcional a contas × dias × tipos).
+    Dias anteriores à linha viva mais antiga de cada tipo são preservados,
+    pois seus registros podem já ter sido arquivados pela retenção.
+    Retorna: número de linhas gravadas
+    """
+    def _build(conn):
+        buckets = {}
+
+        def add(user_id, response_type, created_at, response_time):
+            key = (user_id, local_day(created_at), response_type)
+            b = buckets.get(key)
+            if b is None:
+                b = buckets[key] = {'count': 0, 'total_time': 0.0, 'min_time': None, 'max_time': None}
+            b['count'] += 1
+            if response_time is not None:
+                b['total_time'] += response_time
+                b['min_time'] = response_time if b['min_time'] is None else min(b['min_time'], response_time)
+                b['max_time'] = response_time if b['max_time'] is None else max(b['max_time'], response_time)
+
+        result = conn.execute(
+            db.select(ResponseHistory.user_id, ResponseHistory.response_type,
+                      ResponseHistory.created_at, ResponseHistory.response_time)
+            .execution_options(yield_per=5000)
+        )
+        for row in result:
+            add(row.user_id, row.response_type, row.created_at, row.response_time)
+
+        result = conn.execute(
+            db.select(Question.user_id, Question.created_at).execution_options(yield_per=5000)
+        )
+        for row in result:
+            add(row.user_id, DAILY_STATS_RECEIVED, row.created_at, None)
+
+        first_live_day = {}
+        for user_id, day, response_type in buckets:
+            if response_type not in first_live_day or day < first_live_day[response_type]:
+                first_live_day[response_type] = day
+        stats = DailyStat.__table__
+        for response_type, day in first_live_day.items():
+            conn.execute(stats.delete().where(stats.c.response_type == response_type, stats.c.day >= day))
+        if buckets:
+            conn.execute(DailyStat.__table__.insert(), [
+                {'user_id': k[0], 'day': k[1], 'response_type': k[2], **v}
+                for k, v in buckets.items()
+            ])
+        return len(buckets)
+
+    if connection is not None:
+        return _build(connection)
+    with db.engine.begin() as conn:
+        return _build(conn)
+
+def get_daily_stats_summary(since_day=None, user_id=None):
+    """
+    Soma o rollup por tipo de resposta.
+    Retorna: {response_type: {'count', 'total_time', 'min_time', 'max_time', 'avg_time'}}
+    """
+    query = db.session.query(
+        DailyStat.response_type,
+        db.func.sum(DailyStat.count),
+        db.func.sum(DailyStat.total_time),
+        db.func.min(DailyStat.min_time),
+        db.func.max(DailyStat.max_time)
+    )
+    if since_day is not None:
+        query = query.filter(DailyStat.day >= since_day)
+    if user_id is not None:
+        query = query.filter(DailyStat.user_id == user_id)
+
+    summary = {}
+    for response_type, count, total_time, min_time, max_time in query.group_by(DailyStat.response_type):
+        count = int(count or 0)
+        summary[response_type] = {
+            'count': count,
+            'total_time': total_time or 0.0,
+            'min_time': min_time,
+            'max_time': max_time,
+            'avg_time': (total_time or 0.0) / count if count else 0.0
+        }
+    return summary
+
+def summarize_answers(summary):
+    """Totais agregados apenas dos tipos de resposta (exclui 'received')"""
+    count = sum(summary.get(t, {}).get('count', 0) for t in ANSWER_RESPONSE_TYPES)
+    total_time = sum(summary.get(t, {}).get('total_time', 0.0) for t in ANSWER_RESPONSE_TYPES)
+    return {
+        'count': count,
+        'avg_time': round(total_time / count, 2) if count else 0
+    }
+
+@schema_migration(2, 'backfill_daily_stats')
+def _migration_002_backfill_daily_stats(conn):
+    """Popula daily_stats para bancos que já tinham histórico"""
+    backfill_daily_stats(conn)
+
+@schema_migration(3, 'reivindicacao_de_perguntas')
+def _migration_003_question_claims(conn):
+    """
+    Sem efeito: a reivindicação de perguntas vive no estado compartilhado
+    (claim:question:*). Mantida para não renumerar as versões já aplicadas.
+    """
+
+@schema_migration(4, 'indices_paginacao_historico')
+def _migration_004_history_keyset_indexes(conn):
+    """Índices (filtro, created_at, id) para paginação por cursor do histórico"""
+    create_index_if_missing(conn, 'ix_response_history_created_id', 'response_history', ['created_at', 'id'])
+    create_index_if_missing(conn, 'ix_response_history_type_created_id', 'response_history', ['response_type', 'created_at', 'id'])
+    create_index_if_missing(conn, 'ix_response_history_user_created_id', 'response_history', ['user_id', 'created_at', 'id'])
+    create_index_if_missing(conn, 'ix_response_history_keywords_created_id', 'response_history', ['keywords_matched', 'created_at', 'id'])
+    create_index_if_missing(conn, 'ix_questions_item', 'questions', ['item_id'])
+    # Substituídos pelos índices compostos acima
+    conn.execute(text('DROP INDEX IF EXISTS ix_response_history_created_at'))
+    conn.execute(text('DROP INDEX IF EXISTS ix_response_history_type_created'))
+
+# Texto indexado para busca: pergunta e resposta (tokenizador sem acentos para português)
+QUESTIONS_FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS questions_fts_ai AFTER INSERT ON questions BEGIN
+        INSERT INTO questions_fts(rowid, question_text, response_text)
+        VALUES (new.id, new.question_text, new.response_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS questions_fts_ad AFTER DELETE ON questions BEGIN
+        INSERT INTO questions_fts(questions_fts, rowid, question_text, response_text)
+        VALUES ('delete', old.id, old.question_text, old.response_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS questions_fts_au AFTER UPDATE OF question_text, response_text ON questions BEGIN
+        INSERT INTO questions_fts(questions_fts, rowid, question_text, response_text)
+        VALUES ('delete', old.id, old.question_text, old.response_text);
+        INSERT INTO questions_fts(rowid, question_text, response_text)
+        VALUES (new.id, new.question_text, new.response_text);
+    END""",
+]
+
+@schema_migration(5, 'busca_texto_completo')
+def _migration_005_questions_fts(conn):
+    """Índice de busca textual em perguntas e respostas (FTS5 no SQLite, GIN no PostgreSQL)"""
+    if IS_SQLITE:
+        conn.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5("
+            "question_text, response_text, content='questions', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+        for ddl in QUESTIONS_FTS_TRIGGERS:
+            conn.execute(text(ddl))
+        conn.execute(text("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"))
+    else:
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_questions_fts ON questions USING GIN ({questions_tsvector_sql()})"
+        ))
+
+@schema_migration(6, 'rastreamento_de_perguntas')
+def _migration_006_question_traces(conn):
+    """Tabela question_traces e vínculo do histórico com o trace"""
+    QuestionTrace.__table__.create(conn, checkfirst=True)
+    add_column_if_missing(conn, 'response_history', 'trace_id', 'VARCHAR(32)')
+    create_index_if_missing(conn, 'ix_response_history_trace', 'response_history', ['trace_id'])
+
+@schema_migration(7, 'latencia_ponta_a_ponta')
+def _migration_007_sla_seconds(conn):
+    """Latência ponta a ponta (criação da pergunta no ML até a resposta aceita)"""
+    add_column_if_missing(conn, 'response_history', 'sla_seconds', 'FLOAT')
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Reconstrói o índice de busca textual a partir da tabela questions"""
+    if not IS_SQLITE:
+        click.echo("ℹ️ No PostgreSQL o índice GIN é mantido pelo próprio banco")
+        return
+    with db.engine.begin() as conn:
+        conn.execute(text("INSERT INTO questions_fts(questions_fts) VALUES ('rebuild')"))
+    click.echo("✅ Índice de busca reconstruído")
+
+@app.cli.command('backfill-daily-stats')
+def backfill_daily_stats_command():
+    """Reconstrói daily_stats a partir do histórico (flask --app main backfill-daily-stats)"""
     with app.app_context():
-        u = User.query.filter_by(ml_user_id=str(ml_user_id)).first()
-        if not u or not u.access_token:
-            raise RuntimeError(f"Sem tokens salvos para o user {ml_user_id}")
-        return u.access_token, u.refresh_token
+        rows = backfill_daily_stats()
+    print(f"✅ daily_stats reconstruída: {rows} linhas")
+
+# ========== SLA PONTA A PONTA (PERCENTIS EM MEMÓRIA) ==========
+# Sketches de quantis com erro relativo limitado (estilo DDSketch): cada valor
+# cai num bin logarítmico, então p50/p95/p99 saem sem guardar as amostras e
+# sem varrer o histórico. Janela móvel de SLA_WINDOW_DAYS dias, com um conjunto
+# de sketches por hora somado na leitura; horas fechadas são relidas do banco.
+SLA_SKETCH_ACCURACY = 0.01  # erro relativo máximo dos percentis
+SLA_SKETCH_MAX_BINS = 2048
+SLA_SKETCH_MIN_VALUE = 0.001  # segundos; abaixo disso conta como zero
+SLA_WINDOW_DAYS = int(os.getenv('SLA_WINDOW_DAYS', os.getenv('SLA_WARMUP_DAYS', '7')))
+SLA_SYNC_GRACE = 300  # segundos após o fim de uma hora antes de relê-la do banco
+SLA_QUANTILES = (0.5, 0.95, 0.99)
+
+class LatencySketch:
+    """Sketch de quantis com bins logarítmicos (memória limitada a max_bins)"""
+
+    def __init__(self, relative_accuracy=SLA_SKETCH_ACCURACY, max_bins=SLA_SKETCH_MAX_BINS):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        if value < SLA_SKETCH_MIN_VALUE:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > self.max_bins:
+            # Junta os dois menores bins: a precisão sacrificada é a dos valores mais baixos
+            lowest, second = sorted(self.bins)[:2]
+            self.bins[second] += self.bins.pop(lowest)
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        while len(self.bins) > self.max_bins:
+            lowest, second = sorted(self.bins)[:2]
+            self.bins[second] += self.bins.pop(lowest)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return self.max
+
+    def to_dict(self):
+        result = {"count": self.count, "avg": round(self.total / self.count, 2) if self.count else None,
+                  "max": round(self.max, 2)}
+        for q in SLA_QUANTILES:
+            value = self.quantile(q)
+            result[f"p{int(q * 100)}"] = round(value, 2) if value is not None else None
+        return result
+
+def ml_datetime_to_epoch(value):
+    """Converte datas da API do ML ('2024-01-15T10:20:30.000-04:00') em epoch; None se inválida"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+def sla_seconds_since(date_created):
+    """Segundos desde a criação da pergunta no ML até agora (None sem data válida)"""
+    created = ml_datetime_to_epoch(date_created)
+    if created is None:
+        return None
+    return max(0.0, clock.time() - created)
+
+class SLAStats:
+    """
+    Sketches por conta, tipo de resposta e hora do dia (fuso de São Paulo), mais o geral,
+    na janela dos últimos SLA_WINDOW_DAYS dias: um conjunto de sketches por hora (UTC),
+    descartado quando sai da janela. Horas fechadas há SLA_SYNC_GRACE segundos são
+    relidas do banco (respostas de todos os workers); só as horas abertas são locais.
+    """
+
+    def __init__(self, window_days=SLA_WINDOW_DAYS):
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.window_hours = window_days * 24
+        self.hours = {}  # hora UTC (epoch // 3600) -> {(dimensão, chave): LatencySketch}
+        self.synced_until = None  # horas anteriores a esta já vieram do banco
+        self.warmed_rows = 0
+
+    @staticmethod
+    def _keys(user_pk, response_type, hour):
+        return (('all', 'all'), ('account', user_pk), ('type', response_type), ('hour', hour))
+
+    @staticmethod
+    def _hour_index(utc_datetime):
+        return int(utc_datetime.replace(tzinfo=timezone.utc).timestamp() // 3600)
+
+    @staticmethod
+    def _hour_start(hour):
+        return datetime.fromtimestamp(hour * 3600, timezone.utc).replace(tzinfo=None)
+
+    @classmethod
+    def _add(cls, bucket, user_pk, response_type, seconds, answered_at):
+        for key in cls._keys(user_pk, response_type, format_local_time(answered_at).hour):
+            sketch = bucket.get(key)
+            if sketch is None:
+                sketch = bucket[key] = LatencySketch()
+            sketch.add(seconds)
+
+    def _evict(self, current_hour):
+        """Descarta as horas fora da janela (chamado com self.lock)"""
+        oldest = current_hour - self.window_hours
+        for hour in [h for h in self.hours if h <= oldest]:
+            del self.hours[hour]
+
+    def record(self, user_pk, response_type, seconds, answered_at=None):
+        """Registra uma resposta já gravada no banco (answered_at = created_at do histórico)"""
+        answered_at = answered_at or get_local_time_utc()
+        hour = self._hour_index(answered_at)
+        with self.lock:
+            if self.synced_until is not None and hour < self.synced_until:
+                return  # hora já relida do banco, que inclui esta resposta
+            bucket = self.hours.get(hour)
+            if bucket is None:
+                bucket = self.hours[hour] = {}
+                self._evict(hour)
+            self._add(bucket, user_pk, response_type, seconds, answered_at)
+
+    def _load(self, start_hour, end_hour):
+        """Sketches por hora do histórico em [start_hour, end_hour). Retorna: (horas, linhas)"""
+        buckets = {}
+        rows = 0
+        with app.app_context():
+            query = db.session.query(
+                ResponseHistory.user_id, ResponseHistory.response_type,
+                ResponseHistory.sla_seconds, ResponseHistory.created_at
+            ).filter(
+                ResponseHistory.sla_seconds.isnot(None),
+                ResponseHistory.created_at >= self._hour_start(start_hour),
+                ResponseHistory.created_at < self._hour_start(end_hour)
+            ).execution_options(yield_per=2000)
+            for user_pk, response_type, seconds, created_at in query:
+                bucket = buckets.setdefault(self._hour_index(created_at), {})
+                self._add(bucket, user_pk, response_type, seconds, created_at)
+                rows += 1
+        return buckets, rows
+
+    def sync(self):
+        """
+        Relê do banco as horas fechadas desde a última sincronização.
+        Barato fora da virada de hora (não consulta nada). Retorna: linhas lidas
+        """
+        now = clock.time()
+        closed = int((now - SLA_SYNC_GRACE) // 3600)
+        window_start = int(now // 3600) - self.window_hours + 1
+        start = window_start if self.synced_until is None else max(self.synced_until, window_start)
+        if start >= closed or not self.sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            buckets, rows = self._load(start, closed)
+            with self.lock:
+                for hour in [h for h in self.hours if start <= h < closed]:
+                    del self.hours[hour]
+                self.hours.update(buckets)
+                self.synced_until = closed
+                self._evict(int(now // 3600))
+            return rows
+        finally:
+            self.sync_lock.release()
 
-def answer_question_ml_with_token(access_token: str, question_id: str, answer_text: str) -> bool:
+    def warm_up(self):
+        """Carrega a janela a partir do histórico (boot; horas ainda abertas ficam locais)"""
+        self.synced_until = None
+        rows = self.sync()
+        self.warmed_rows = rows
+        return rows
+
+    def snapshot(self):
+        """{'all': {...}, 'by_account': {ml_user_id: {...}}, 'by_type': {...}, 'by_hour': {'00': {...}}}"""
+        try:
+            self.sync()
+        except Exception as e:
+            add_debug_log(f"⚠️ Falha ao sincronizar percentis de SLA: {e}")
+        accounts = {c.user_pk: c.ml_user_id for c in credential_registry.snapshots()}
+        result = {"all": None, "by_account": {}, "by_type": {}, "by_hour": {}}
+        merged = {}
+        with self.lock:
+            self._evict(int(clock.time() // 3600))
+            for bucket in self.hours.values():
+                for key, sketch in bucket.items():
+                    total = merged.get(key)
+                    if total is None:
+                        total = merged[key] = LatencySketch()
+                    total.merge(sketch)
+        items = [(key, sketch.to_dict()) for key, sketch in merged.items()]
+        for (dimension, key), stats in items:
+            if dimension == 'all':
+                result["all"] = stats
+            elif dimension == 'account':
+                result["by_account"][str(accounts.get(key, key))] = stats
+            elif dimension == 'type':
+                result["by_type"][key] = stats
+            else:
+                result["by_hour"][f"{key:02d}"] = stats
+        result["by_hour"] = dict(sorted(result["by_hour"].items()))
+        return result
+
+sla_stats = SLAStats()
+
+def format_duration(seconds):
+    """Duração curta para exibição (45s, 12min, 3.5h)"""
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}min"
+    return f"{seconds / 3600:.1f}h"
+
+# ====== MULTI-CONTA: registro de credenciais em memória ======
+# Cada conta tem um snapshot imutável; renovações trocam o snapshot inteiro
+# (atribuição atômica), então leitores nunca veem token e conta misturados.
+AccountCredentials = namedtuple(
+    'AccountCredentials', ['ml_user_id', 'user_pk', 'access_token', 'refresh_token', 'expires_at', 'loaded_at']
+)
+
+CREDENTIAL_RELOAD_INTERVAL = int(os.getenv('CREDENTIAL_RELOAD_INTERVAL', '300'))  # segundos
+
+class CredentialRegistry:
+    """Cache de credenciais por conta; o banco só é lido em falta ou recarga periódica"""
+
+    def __init__(self):
+        self._snapshots = {}  # ml_user_id -> AccountCredentials (dict trocado por inteiro)
+        self._lock = threading.Lock()
+        self._loaded_all_at = 0
+        self._watcher = None  # criado no primeiro uso (estado compartilhado é definido depois)
+
+    def _check_remote_invalidation(self):
+        """Descarta os snapshots se outro processo renovou alguma conta"""
+        if self._watcher is None:
+            self._watcher = CacheVersionWatcher('credentials')
+        if self._watcher.changed():
+            self.invalidate()
+
+    @staticmethod
+    def _snapshot_from_user(user):
+        return AccountCredentials(
+            ml_user_id=str(user.ml_user_id),
+            user_pk=user.id,
+            access_token=user.access_token,
+            refresh_token=user.refresh_token,
+            expires_at=user.token_expires_at,
+            loaded_at=clock.time()
+        )
+
+    def _swap(self, changes, removals=()):
+        """Publica um novo dicionário de snapshots (copy-on-write)"""
+        with self._lock:
+            snapshots = dict(self._snapshots)
+            snapshots.update(changes)
+            for key in removals:
+                snapshots.pop(key, None)
+            self._snapshots = snapshots
+
+    def get(self, ml_user_id):
+        """Snapshot da conta (carrega do banco na primeira vez); None se não existir"""
+        self._check_remote_invalidation()
+        snapshot = self._snapshots.get(str(ml_user_id))
+        if snapshot is None:
+            snapshot = self.reload(ml_user_id)
+        return snapshot
+
+    def reload(self, ml_user_id):
+        """Relê a conta do banco e publica o snapshot"""
+        key = str(ml_user_id)
+        with app.app_context():
+            user = User.query.filter_by(ml_user_id=key).first()
+            snapshot = self._snapshot_from_user(user) if user and user.access_token else None
+        if snapshot:
+            self._swap({key: snapshot})
+        else:
+            self._swap({}, removals=[key])
+        return snapshot
+
+    def all(self):
+        """Snapshots de todas as contas (recarregados do banco a cada CREDENTIAL_RELOAD_INTERVAL)"""
+        self._check_remote_invalidation()
+        if clock.time() - self._loaded_all_at > CREDENTIAL_RELOAD_INTERVAL:
+            with app.app_context():
+                users = User.query.filter(User.access_token.isnot(None)).all()
+                snapshots = {str(u.ml_user_id): self._snapshot_from_user(u) for u in users}
+            with self._lock:
+                self._snapshots = snapshots
+                self._loaded_all_at = clock.time()
+        return list(self._snapshots.values())
+
+    def snapshots(self):
+        """Snapshots já carregados (sem acessar o banco)"""
+        return list(self._snapshots.values())
+
+    def update(self, ml_user_id, access_token, refresh_token, expires_at=None, user_pk=None):
+        """Troca atomicamente o snapshot da conta após renovação"""
+        key = str(ml_user_id)
+        current = self._snapshots.get(key)
+        snapshot = AccountCredentials(
+            ml_user_id=key,
+            user_pk=user_pk if user_pk is not None else (current.user_pk if current else None),
+            access_token=access_token,
+            refresh_token=refresh_token,
+            expires_at=expires_at,
+            loaded_at=clock.time()
+        )
+        if snapshot.user_pk is None:
+            # Conta nova sem id conhecido: deixar a próxima leitura buscar no banco
+            self.invalidate(key)
+        else:
+            self._swap({key: snapshot})
+        broadcast_cache_invalidation('credentials')
+        return snapshot
+
+    def invalidate(self, ml_user_id=None):
+        """Descarta o snapshot de uma conta (ou de todas)"""
+        if ml_user_id is None:
+            with self._lock:
+                self._snapshots = {}
+                self._loaded_all_at = 0
+        else:
+            self._swap({}, removals=[str(ml_user_id)])
+
+    def primary(self):
+        """Credenciais da conta principal (ML_USER_ID), com fallback para as variáveis de ambiente"""
+        snapshot = self.get(ML_USER_ID)
+        if snapshot:
+            return snapshot
+        return AccountCredentials(ML_USER_ID, None, ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, None, clock.time())
+
+credential_registry = CredentialRegistry()
+
+def get_user_tokens_by_ml_id(ml_user_id: str):
+    """Retorna (access_token, refresh_token) do usuário (registro em memória)."""
+    credentials = credential_registry.get(ml_user_id)
+    if not credentials:
+        raise RuntimeError(f"Sem tokens salvos para o user {ml_user_id}")
+    return credentials.access_token, credentials.refresh_token
+
+# ====== RENOVAÇÃO DE TOKEN COM SINGLE-FLIGHT POR CONTA ======
+TOKEN_REFRESH_FAILURE_COOLDOWN = 60  # segundos sem nova tentativa após falha
+_token_refresh_lock = threading.Lock()
+_token_refresh_inflight = {}  # ml_user_id -> threading.Event
+_token_refresh_failed_at = {}
+
+def refresh_account_token(ml_user_id, stale_token, reason='401 recebido', force=False):
+    """
+    Renova o token da conta (401, agendador ou renovação forçada). Chamadas
+    concorrentes para a mesma conta esperam a mesma renovação em andamento
+    (single-flight). force=True ignora o cooldown de falha e o atalho de
+    "já renovado por outro".
+    Retorna: novo access token ou None
+    """
+    key = str(ml_user_id)
+    with _token_refresh_lock:
+        inflight = _token_refresh_inflight.get(key)
+        if inflight is None and not force:
+            # Outra thread (ou outro nó) já renovou desde que este token foi lido
+            try:
+                current = credential_registry.reload(key)
+                current_token = current.access_token if current else None
+            except Exception:
+                current_token = None
+            if current_token and current_token != stale_token:
+                return current_token
+            if clock.time() - _token_refresh_failed_at.get(key, 0) < TOKEN_REFRESH_FAILURE_COOLDOWN:
+                return None
+        if inflight is None:
+            inflight = _token_refresh_inflight[key] = threading.Event()
+            leader = True
+        else:
+            leader = False
+
+    if not leader:
+        inflight.wait(timeout=60)
+        try:
+            current_token = get_user_tokens_by_ml_id(key)[0]
+        except Exception:
+            return None
+        return current_token if current_token != stale_token else None
+
+    try:
+        add_debug_log(f"🔑 {reason} para conta {key}; renovando token...")
+        success, result = multi_refresh.get(key).process_refresh_token_internal()
+        if not success:
+            _token_refresh_failed_at[key] = clock.time()
+            return None
+        update_system_tokens(
+            result['access_token'], result.get('refresh_token', ''), result.get('user_id') or key,
+            make_primary=False, expires_in=result.get('expires_in', TOKEN_DEFAULT_EXPIRES_IN)
+        )
+        _token_refresh_failed_at.pop(key, None)
+        return result['access_token']
+    except Exception as e:
+        _token_refresh_failed_at[key] = clock.time()
+        add_debug_log(f"❌ Erro na renovação da conta {key} ({reason}): {e}")
+        return None
+    finally:
+        with _token_refresh_lock:
+            _token_refresh_inflight.pop(key, None)
+        inflight.set()
+
+# ========== CAPTURA DE TRÁFEGO (REPLAY) ==========
+# Com TRAFFIC_CAPTURE_PATH definido, webhooks recebidos e pares requisição/resposta
+# da API do ML são gravados (tokens e segredos removidos) em NDJSON comprimido,
+# para tools/replay_traffic.py reproduzir a mesma sequência. A gravação é feita
+# por uma thread própria, em lotes (cada lote é um membro gzip).
+TRAFFIC_CAPTURE_PATH = os.getenv('TRAFFIC_CAPTURE_PATH', '')  # diretório; vazio desliga
+TRAFFIC_CAPTURE_MAX_BODY = 65536  # caracteres de corpo de resposta não-JSON
+TRAFFIC_CAPTURE_FLUSH_INTERVAL = 1.0  # segundos
+REDACTED = '<redacted>'
+_REDACT_KEYS = {'access_token', 'refresh_token', 'client_secret', 'code', 'authorization'}
+_TOKEN_PATTERN = re.compile(r'\b(APP_USR|TG)-[A-Za-z0-9-]+')
+
+def redact(value):
+    """Remove tokens e segredos de dicts, listas e strings (para captura de tráfego)"""
+    if isinstance(value, dict):
+        return {k: REDACTED if str(k).lower() in _REDACT_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return _TOKEN_PATTERN.sub(lambda m: f"{m.group(1)}-{REDACTED}", value)
+    return value
+
+class TrafficCapture(BatchWriter):
+    """Grava tráfego de entrada (webhooks) e saída (API do ML) em NDJSON.gz"""
+
+    def __init__(self, directory):
+        super().__init__('traffic-capture', TRAFFIC_CAPTURE_FLUSH_INTERVAL, 'captura de tráfego')
+        self.enabled = bool(directory)
+        self.path = None
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            self.path = os.path.join(directory, f"traffic-{stamp}-{os.getpid()}.ndjson.gz")
+        self.seq = itertools.count(1)
+        self.records = 0
+
+    def record(self, kind, **fields):
+        if not self.enabled:
+            return
+        self.put({"seq": next(self.seq), "t": time.time(), "kind": kind, **redact(fields)})
+
+    def record_webhook(self, payload):
+        self.record('webhook', path=request.path, payload=payload)
+
+    def record_ml(self, method, url, kwargs, response=None, duration=0.0, error=None):
+        if not self.enabled:
+            return
+        body = None
+        if response is not None:
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text[:TRAFFIC_CAPTURE_MAX_BODY]
+        path = url[len(ML_API_BASE_URL):] if url.startswith(ML_API_BASE_URL) else url
+        self.record(
+            'ml', method=method, path=path.split('?', 1)[0],
+            params=dict(kwargs.get('params') or {}),
+            request=kwargs.get('json') if kwargs.get('json') is not None else kwargs.get('data'),
+            status=response.status_code if response is not None else None,
+            response=body, duration_ms=round(duration * 1000, 2), error=error
+        )
+
+    def write(self, batch):
+        data = ''.join(json.dumps(entry, ensure_ascii=False, default=str) + '\n' for entry in batch)
+        with open(self.path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(data.encode('utf-8'))
+        self.records += len(batch)
+
+traffic_capture = TrafficCapture(TRAFFIC_CAPTURE_PATH)
+atexit.register(traffic_capture.flush)
+if traffic_capture.enabled:
+    print(f"🎙️ Captura de tráfego ativa: {traffic_capture.path}")
+
+def ml_request(method, url, access_token, ml_user_id=None, headers=None, **kwargs):
+    """
+    Requisição autenticada à API do ML. Em 401, renova o token da conta
+    (single-flight) e repete a requisição uma única vez com o token novo.
+    """
+    kwargs.setdefault('timeout', 30)
+    request_headers = dict(headers or {})
+    request_headers['Authorization'] = f"Bearer {access_token}"
+    response = _timed_ml_request(method, url, request_headers, kwargs)
+    if response.status_code != 401 or not ml_user_id:
+        return response
+    new_token = refresh_account_token(ml_user_id, access_token)
+    if not new_token:
+        return response
+    add_debug_log(f"🔁 Repetindo requisição com token renovado ({method} {url.split('?')[0]})")
+    request_headers['Authorization'] = f"Bearer {new_token}"
+    return _timed_ml_request(method, url, request_headers, kwargs)
+
+def _timed_ml_request(method, url, headers, kwargs):
+    """Executa a requisição registrando a latência por endpoint/status"""
+    start = time.perf_counter()
+    status = 'error'
+    response = None
+    error = None
+    try:
+        response = requests.request(method, url, headers=headers, **kwargs)
+        status = str(response.status_code)
+        return response
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        ML_REQUEST_SECONDS.labels(ml_endpoint_label(url), method, status).observe(elapsed)
+        if traffic_capture.enabled:
+            traffic_capture.record_ml(method, url, kwargs, response, elapsed, error)
+
+def answer_question_ml_with_token(access_token: str, question_id: str, answer_text: str, ml_user_id: str = None) -> bool:
     """Variante que responde usando um access token específico (multi-conta)."""
-    url = "https://api.mercadolibre.com/answers"
-    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    url = f"{ML_API_BASE_URL}/answers"
+    headers = {"Content-Type": "application/json"}
     data = {"question_id": int(question_id), "text": answer_text}
     try:
         add_debug_log(f"📤 Enviando resposta (user token) para pergunta {question_id}")
-        r = requests.post(url, headers=headers, json=data, timeout=30)
+        r = ml_request("POST", url, access_token, ml_user_id, headers=headers, json=data)
         if r.status_code == 200:
             add_debug_log("✅ Resposta enviada com sucesso!")
             return True
@@ -501,12 +2232,11 @@ def answer_question_ml_with_token(access_token: str, question_id: str, answer_te
         add_debug_log(f"❌ Erro na requisição: {e}")
     return False
 
-def fetch_question_by_id_with_token(access_token: str, qid: str):
+def fetch_question_by_id_with_token(access_token: str, qid: str, ml_user_id: str = None):
     """Busca uma pergunta diretamente por ID (evita buracos da listagem)."""
-    url = f"https://api.mercadolibre.com/questions/{qid}"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    url = f"{ML_API_BASE_URL}/questions/{qid}"
     try:
-        r = requests.get(url, headers=headers, timeout=30)
+        r = ml_request("GET", url, access_token, ml_user_id)
         if r.status_code == 200:
             return r.json()
         add_debug_log(f"❌ Erro ao buscar pergunta {qid}: {r.status_code}: {r.text}")
@@ -514,23 +2244,548 @@ def fetch_question_by_id_with_token(access_token: str, qid: str):
         add_debug_log(f"❌ Erro ao buscar pergunta {qid}: {e}")
     return None
 
-def fetch_unanswered_questions_with_token(access_token: str, limit: int = 50):
+def fetch_unanswered_questions_with_token(access_token: str, limit: int = 50, ml_user_id: str = None):
     """Listagem de perguntas não respondidas para um token específico (multi-conta)."""
-    url = "https://api.mercadolibre.com/my/received_questions/search"
-    headers = {"Authorization": f"Bearer {access_token}"}
+    url = f"{ML_API_BASE_URL}/my/received_questions/search"
     params = {"status": "UNANSWERED", "limit": limit}
     try:
-        add_debug_log("📥 Buscando perguntas não respondidas (user token)...")
-        r = requests.get(url, headers=headers, params=params, timeout=30)
+        add_debug_log("📥 Buscando perguntas não respondidas (user token)...", level=LOG_DEBUG)
+        r = ml_request("GET", url, access_token, ml_user_id, params=params)
         if r.status_code == 200:
             qs = r.json().get("questions", [])
-            add_debug_log(f"   Encontradas: {len(qs)} perguntas")
+            add_debug_log("   Encontradas: %d perguntas", len(qs), level=LOG_DEBUG)
             return qs
         add_debug_log(f"❌ Erro na listagem: {r.status_code}: {r.text}")
     except Exception as e:
         add_debug_log(f"❌ Erro na listagem: {e}")
     return []
 
+# ========== FILA ÚNICA DE ESCRITA (GROUP COMMIT) ==========
+# Todas as escritas do pipeline (perguntas, histórico, webhooks) passam por uma
+# única thread, que acumula mutações por alguns ms (ou N itens) e faz um só COMMIT.
+# Assim as threads não disputam o lock de escrita do SQLite e cada fsync cobre o lote.
+
+DB_WRITER_MAX_BATCH = int(os.getenv('DB_WRITER_MAX_BATCH', '200'))
+DB_WRITER_MAX_DELAY = int(os.getenv('DB_WRITER_MAX_DELAY_MS', '5')) / 1000.0
+
+class DBWriter:
+    """Thread dedicada de escrita com group commit"""
+
+    def __init__(self, max_batch=DB_WRITER_MAX_BATCH, max_delay=DB_WRITER_MAX_DELAY):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        """Inicia a thread de escrita (idempotente)"""
+        with self.start_lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self.thread.start()
+
+    def submit(self, mutation):
+        """
+        Enfileira mutation(session). O retorno da função vira o resultado do Future
+        (use valores simples, não objetos ORM, pois a sessão é descartada após o commit).
+        """
+        if self.thread is None or not self.thread.is_alive():
+            self.start()
+        future = Future()
+        self.queue.put((mutation, future))
+        return future
+
+    def call(self, mutation, timeout=30):
+        """Enfileira e espera o commit, retornando o resultado da mutação"""
+        return self.submit(mutation).result(timeout=timeout)
+
+    def flush(self, timeout=5):
+        """Espera as mutações já enfileiradas serem gravadas"""
+        try:
+            self.submit(lambda session: None).result(timeout=timeout)
+        except Exception:
+            pass
+
+    def depth(self):
+        """Tamanho atual da fila"""
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
+        """Aplica o lote em uma transação; em erro, reaplica item a item para isolar o culpado"""
+        with app.app_context():
+            try:
+                results = [mutation(db.session) for mutation, _ in batch]
+                start = time.perf_counter()
+                db.session.commit()
+                DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+                DB_COMMIT_BATCH_SIZE.observe(len(batch))
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+                self.batches += 1
+                self.items += len(batch)
+                return
+            except Exception as e:
+                db.session.rollback()
+                if len(batch) == 1:
+                    add_debug_log(f"❌ Erro na escrita do banco: {e}")
+                    batch[0][1].set_exception(e)
+                    return
+            finally:
+                db.session.remove()
+
+        for item in batch:
+            self._commit_batch([item])
+
+db_writer = DBWriter()
+atexit.register(db_writer.flush)
+
+QUESTION_CLAIM_TTL = int(os.getenv('QUESTION_CLAIM_TTL', '120'))  # segundos
+
+def _upsert_question(session, user_id, qid, item_id, text):
+    """Busca ou cria a pergunta (dentro da thread de escrita)"""
+    question = session.query(Question).filter_by(ml_question_id=str(qid)).first()
+    if question:
+        return question
+    if session.get_bind().dialect.name == 'postgresql':
+        # Outro nó pode inserir a mesma pergunta ao mesmo tempo
+        stmt = dialect_insert(session.get_bind(), Question.__table__).values(
+            ml_question_id=str(qid),
+            user_id=user_id,
+            item_id=item_id or "",
+            question_text=text or "",
+            is_answered=False,
+            created_at=get_local_time_utc()
+        ).on_conflict_do_nothing(index_elements=['ml_question_id']).returning(Question.__table__.c.id)
+        new_id = session.execute(stmt).scalar()
+        if new_id is not None:
+            record_daily_stat(session.connection(), user_id, DAILY_STATS_RECEIVED, None)
+        return session.query(Question).filter_by(ml_question_id=str(qid)).one()
+    question = Question(
+        ml_question_id=str(qid),
+        user_id=user_id,
+        item_id=item_id or "",
+        question_text=text or "",
+        is_answered=False
+    )
+    session.add(question)
+    session.flush()  # Para obter o ID
+    return question
+
+def claim_questions(ml_question_ids):
+    """
+    Reivindica perguntas para este nó no estado compartilhado (SQL ou Redis).
+    Reivindicações de outro nó expiram após QUESTION_CLAIM_TTL segundos.
+    Retorna: conjunto de ml_question_id que este nó deve responder
+    """
+    ids = [str(qid) for qid in ml_question_ids]
+    if not ids:
+        return set()
+    acquired = shared_state.add_many([f"claim:question:{qid}" for qid in ids], node_id(), ttl=QUESTION_CLAIM_TTL)
+    return {key.rsplit(':', 1)[1] for key in acquired}
+
+# Perguntas sendo respondidas neste processo. A reivindicação no estado
+# compartilhado é reentrante para o mesmo nó, então duplicatas simultâneas do
+# webhook (ou webhook + polling) precisam deste filtro local.
+_questions_in_flight = set()
+_questions_in_flight_lock = threading.Lock()
+
+def begin_question(qid):
+    """Marca a pergunta como em processamento; False se outra thread já está nela"""
+    with _questions_in_flight_lock:
+        if str(qid) in _questions_in_flight:
+            return False
+        _questions_in_flight.add(str(qid))
+        return True
+
+def end_question(qid):
+    with _questions_in_flight_lock:
+        _questions_in_flight.discard(str(qid))
+
+def save_pending_question(user_id, qid, item_id, text):
+    """Registra pergunta ainda não respondida (assíncrono)"""
+    def mutation(session):
+        return _upsert_question(session, user_id, qid, item_id, text).id
+    return db_writer.submit(mutation)
+
+def save_answered_question(user_id, qid, item_id, text, reply, response_type, keywords_matched, response_time,
+                           trace=None, sla_seconds=None):
+    """
+    Marca pergunta como respondida e grava o histórico (assíncrono).
+    Com trace, a etapa 'persist' vai até o commit e o trace é gravado em seguida;
+    sla_seconds (criação no ML -> resposta aceita) alimenta os percentis em memória
+    depois do commit, como o trace.
+    """
+    answered_at = get_local_time_utc()
+
+    def mutation(session):
+        question = _upsert_question(session, user_id, qid, item_id, text)
+        question.response_text = reply
+        question.is_answered = True
+        question.answered_automatically = True
+        question.answered_at = answered_at
+        session.add(ResponseHistory(
+            user_id=user_id,
+            question_id=question.id,
+            response_type=response_type,
+            keywords_matched=keywords_matched,
+            response_time=response_time,
+            sla_seconds=sla_seconds,
+            trace_id=trace.trace_id if trace else None,
+            created_at=answered_at  # mesma hora usada pelos sketches de SLA
+        ))
+        return question.id
+    mark_recently_answered(qid)
+    future = db_writer.submit(mutation)
+    if sla_seconds is not None:
+        def on_committed(done):
+            if done.exception() is None:
+                sla_stats.record(user_id, response_type, sla_seconds, answered_at)
+        future.add_done_callback(on_committed)
+    if trace is not None:
+        submitted = time.perf_counter()
+
+        def on_persisted(done):
+            trace.add('persist', time.perf_counter() - submitted)
+            failed = done.exception() is not None
+            record_question_trace(trace, user_id, 'error' if failed else response_type,
+                                  question_pk=None if failed else done.result())
+        future.add_done_callback(on_persisted)
+    return future
+
+# ========== RASTREAMENTO POR PERGUNTA ==========
+# Cada pergunta ganha um trace_id quando é vista pela primeira vez (webhook ou
+# polling); as etapas são cronometradas em memória e gravadas em question_traces
+# numa única linha pela fila de escrita.
+TRACE_STAGES = ('queue', 'fetch', 'classify', 'absence', 'send', 'persist')
+
+class TraceContext:
+    """Cronômetro das etapas de uma pergunta"""
+
+    __slots__ = ('trace_id', 'ml_question_id', 'source', 'started', 'durations')
+
+    def __init__(self, ml_question_id, source, started=None):
+        self.trace_id = uuid.uuid4().hex
+        self.ml_question_id = str(ml_question_id)
+        self.source = source
+        self.started = time.perf_counter() if started is None else started
+        self.durations = {}
+
+    def add(self, stage, seconds):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def elapsed(self):
+        """Segundos desde que a pergunta foi vista"""
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        return ', '.join(f"{name} {self.durations[name] * 1000:.0f}ms" for name in TRACE_STAGES if name in self.durations)
+
+def record_question_trace(trace, user_pk, outcome, question_pk=None):
+    """Grava o trace (assíncrono, agrupado no próximo commit da fila de escrita)"""
+    values = {f"{name}_ms": round(trace.durations[name] * 1000, 2) for name in TRACE_STAGES if name in trace.durations}
+    values.update(
+        trace_id=trace.trace_id,
+        question_id=question_pk,
+        ml_question_id=trace.ml_question_id,
+        user_id=user_pk,
+        source=trace.source,
+        outcome=outcome,
+        total_ms=round(trace.elapsed() * 1000, 2)
+    )
+    add_debug_log("🧭 Trace %s pergunta %s (%s): %.0fms [%s]", trace.trace_id[:8], trace.ml_question_id,
+                  outcome, values['total_ms'], trace.summary(), level=LOG_DEBUG)
+    return db_writer.submit(lambda session: session.add(QuestionTrace(**values)))
+
+# IDs respondidos recentemente (evita ida ao banco nos próximos ciclos de polling)
+RECENTLY_ANSWERED_MAX = int(os.getenv('RECENTLY_ANSWERED_MAX', '5000'))
+_recently_answered = OrderedDict()
+_recently_answered_lock = threading.Lock()
+
+def mark_recently_answered(qid):
+    """Registra pergunta respondida no cache LRU em memória"""
+    with _recently_answered_lock:
+        _recently_answered[str(qid)] = True
+        _recently_answered.move_to_end(str(qid))
+        while len(_recently_answered) > RECENTLY_ANSWERED_MAX:
+            _recently_answered.popitem(last=False)
+
+def resolve_polled_questions(ml_question_ids):
+    """
+    Resolve uma página de perguntas do polling com uma única consulta IN (...)
+    Retorna: (ids já respondidos, ids já salvos mas pendentes)
+    """
+    ids = {str(qid) for qid in ml_question_ids}
+    with _recently_answered_lock:
+        answered = {qid for qid in ids if qid in _recently_answered}
+    unknown = ids - answered
+    pending = set()
+    if unknown:
+        with app.app_context():
+            rows = db.session.query(Question.ml_question_id, Question.is_answered) \
+                .filter(Question.ml_question_id.in_(unknown)).all()
+        for qid, is_answered in rows:
+            if is_answered:
+                answered.add(qid)
+                mark_recently_answered(qid)
+            else:
+                pending.add(qid)
+    return answered, pending
+
+# ========== ESTADO COMPARTILHADO ENTRE PROCESSOS ==========
+# Chaves com TTL, add atômico e compare-and-set visíveis por todos os workers/nós:
+# deduplicação de códigos OAuth, reivindicação de perguntas e avisos de invalidação
+# de cache. Backend SQL (banco da aplicação) por padrão; Redis se REDIS_URL existir.
+
+REDIS_URL = os.getenv('REDIS_URL')
+SHARED_STATE_MAX_KEYS = int(os.getenv('SHARED_STATE_MAX_KEYS', '10000'))
+SHARED_STATE_PURGE_EVERY = 100  # escritas entre limpezas de chaves expiradas
+SHARED_STATE_PROTECTED_PREFIXES = ('claim:', 'cache_version:')  # nunca removidas pelo limite
+
+class SQLStateStore:
+    """Estado compartilhado na tabela shared_state (escritas pela fila única)"""
+
+    backend = 'sql'
+
+    def __init__(self, max_keys=SHARED_STATE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        self._table = SharedState.__table__
+
+    @staticmethod
+    def _expires(ttl, now):
+        return now + ttl if ttl else None
+
+    def _alive(self, now):
+        c = self._table.c
+        return or_(c.expires_at.is_(None), c.expires_at > now)
+
+    def _write(self, mutation):
+        """Executa a escrita na thread de escrita, com limpeza periódica"""
+        with self._writes_lock:
+            self._writes += 1
+            purge = self._writes % SHARED_STATE_PURGE_EVERY == 0
+
+        def run(session):
+            result = mutation(session, clock.time())
+            if purge:
+                self._purge(session)
+            return result
+        return db_writer.call(run)
+
+    def _purge(self, session):
+        """Remove chaves expiradas e, acima do limite, as menos recentes (exceto as protegidas)"""
+        c = self._table.c
+        session.execute(self._table.delete().where(c.expires_at.isnot(None), c.expires_at <= clock.time()))
+        total = session.execute(db.select(db.func.count()).select_from(self._table)).scalar()
+        if total > self.max_keys:
+            # Reivindicações vivas e versões de cache não podem ser descartadas
+            evictable = and_(*[
+                c.key.notlike(prefix.replace('_', r'\_') + '%', escape='\\')
+                for prefix in SHARED_STATE_PROTECTED_PREFIXES
+            ])
+            oldest = db.select(c.key).where(evictable).order_by(c.updated_at).limit(total - self.max_keys)
+            session.execute(self._table.delete().where(c.key.in_(oldest.scalar_subquery())))
+
+    def get(self, key):
+        c = self._table.c
+        with app.app_context(), db.engine.connect() as conn:
+            return conn.execute(db.select(c.value).where(c.key == key, self._alive(clock.time()))).scalar()
+
+    def set(self, key, value, ttl=None):
+        def mutation(session, now):
+            stmt = dialect_insert(session.get_bind(), self._table).values(
+                key=key, value=value, expires_at=self._expires(ttl, now), updated_at=now
+            )
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={'value': stmt.excluded.value, 'expires_at': stmt.excluded.expires_at, 'updated_at': now}
+            ))
+        self._write(mutation)
+
+    def add_many(self, keys, value, ttl=None):
+        """
+        Cria as chaves ausentes ou expiradas (as que já são deste valor são renovadas).
+        Retorna: conjunto de chaves obtidas
+        """
+        def mutation(session, now):
+            acquired = set()
+            # Ordem fixa de travamento evita deadlock entre nós disputando as mesmas chaves
+            for key in sorted(set(keys)):
+                stmt = dialect_insert(session.get_bind(), self._table).values(
+                    key=key, value=value, expires_at=self._expires(ttl, now), updated_at=now
+                )
+                existing = self._table.c
+                result = session.execute(stmt.on_conflict_do_update(
+                    index_elements=['key'],
+                    set_={'value': stmt.excluded.value, 'expires_at': stmt.excluded.expires_at, 'updated_at': now},
+                    where=or_(existing.value == value, existing.expires_at <= now)
+                ))
+                if result.rowcount:
+                    acquired.add(key)
+            return acquired
+        return self._write(mutation)
+
+    def add(self, key, value, ttl=None):
+        """Cria a chave só se ausente/expirada. Retorna True se criou."""
+        def mutation(session, now):
+            stmt = dialect_insert(session.get_bind(), self._table).values(
+                key=key, value=value, expires_at=self._expires(ttl, now), updated_at=now
+            )
+            existing = self._table.c
+            result = session.execute(stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={'value': stmt.excluded.value, 'expires_at': stmt.excluded.expires_at, 'updated_at': now},
+                where=existing.expires_at <= now
+            ))
+            return bool(result.rowcount)
+        return self._write(mutation)
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """Troca o valor só se o atual for `expected` (None = ausente). Retorna True se trocou."""
+        if expected is None:
+            return self.add(key, value, ttl)
+
+        def mutation(session, now):
+            c = self._table.c
+            result = session.execute(self._table.update().where(
+                c.key == key, c.value == expected, self._alive(now)
+            ).values(value=value, expires_at=self._expires(ttl, now), updated_at=now))
+            return bool(result.rowcount)
+        return self._write(mutation)
+
+    def delete(self, key):
+        self._write(lambda session, now: session.execute(self._table.delete().where(self._table.c.key == key)))
+
+class RedisStateStore:
+    """Estado compartilhado no Redis (TTL nativo; tamanho limitado pelo maxmemory do servidor)"""
+
+    backend = 'redis'
+    CAS_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            if tonumber(ARGV[3]) > 0 then
+                redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+            else
+                redis.call('SET', KEYS[1], ARGV[2])
+            end
+            return 1
+        end
+        return 0
+    """
+
+    def __init__(self, url, prefix='botml:'):
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self._cas = self.client.register_script(self.CAS_SCRIPT)
+
+    def _key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _px(ttl):
+        return int(ttl * 1000) if ttl else None
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), value, px=self._px(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self._key(key), value, px=self._px(ttl), nx=True))
+
+    def add_many(self, keys, value, ttl=None):
+        keys = list(keys)
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.set(self._key(key), value, px=self._px(ttl), nx=True)
+        created = pipe.execute()
+        acquired = {key for key, ok in zip(keys, created) if ok}
+        # Chaves que já eram deste valor continuam obtidas (TTL renovado)
+        for key in keys:
+            if key not in acquired and self._cas(keys=[self._key(key)], args=[value, value, self._px(ttl) or 0]):
+                acquired.add(key)
+        return acquired
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        if expected is None:
+            return self.add(key, value, ttl)
+        return bool(self._cas(keys=[self._key(key)], args=[expected, value, self._px(ttl) or 0]))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+def create_shared_state_store():
+    """Redis se REDIS_URL estiver configurada (e a biblioteca instalada), senão SQL"""
+    if REDIS_URL:
+        if redis is None:
+            print("⚠️ REDIS_URL definida mas o pacote redis não está instalado; usando banco SQL")
+        else:
+            return RedisStateStore(REDIS_URL)
+    return SQLStateStore()
+
+shared_state = create_shared_state_store()
+
+# ====== Avisos de invalidação de cache entre processos ======
+CACHE_VERSION_CHECK_INTERVAL = float(os.getenv('CACHE_VERSION_CHECK_INTERVAL', '5'))  # segundos
+
+def broadcast_cache_invalidation(name):
+    """Publica nova versão do cache `name`; os outros processos descartam suas cópias"""
+    try:
+        shared_state.set(f"cache_version:{name}", f"{node_id()}:{time.time()}")
+    except Exception as e:
+        add_debug_log(f"⚠️ Falha ao publicar invalidação de cache {name}: {e}")
+
+class CacheVersionWatcher:
+    """Consulta a versão publicada de um cache no máximo a cada `interval` segundos"""
+
+    _UNSET = object()
+
+    def __init__(self, name, interval=CACHE_VERSION_CHECK_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self._checked_at = 0
+        self._version = self._UNSET
+
+    def changed(self):
+        """True se outro processo publicou versão nova desde a última verificação"""
+        now = clock.time()
+        if now - self._checked_at < self.interval:
+            return False
+        self._checked_at = now
+        try:
+            version = shared_state.get(f"cache_version:{self.name}")
+        except Exception:
+            return False
+        if version == self._version:
+            return False
+        first_check = self._version is self._UNSET
+        self._version = version
+        return not first_check and not str(version).startswith(f"{node_id()}:")
+
 # ========== VARIÁVEIS GLOBAIS DE CONTROLE ==========
 _initialized = False
 _db_lock = threading.Lock()
@@ -551,22 +2806,26 @@ def initialize_database():
                 # Criar todas as tabelas
                 db.create_all()
                 add_debug_log("✅ Tabelas criadas com sucesso")
+
+                # Evoluir esquema de bancos existentes
+                run_schema_migrations()
                 
                 # Criar usuário padrão
+                # Expiração do token do ambiente é desconhecida: fica vazia até a
+                # primeira renovação (tokens já renovados no banco são preservados)
                 user = User.query.filter_by(ml_user_id=ML_USER_ID).first()
                 if not user:
                     user = User(
                         ml_user_id=ML_USER_ID,
                         access_token=ML_ACCESS_TOKEN,
-                        token_expires_at=get_local_time_utc() + timedelta(hours=6)
+                        refresh_token=ML_REFRESH_TOKEN or None
                     )
                     db.session.add(user)
                     db.session.commit()
                     add_debug_log(f"✅ Usuário padrão criado: {ML_USER_ID}")
-                else:
-                    # Atualizar token se necessário
-                    user.access_token = ML_ACCESS_TOKEN
-                    user.token_expires_at = get_local_time_utc() + timedelta(hours=6)
+                elif not user.access_token or (ML_REFRESH_TOKEN and not user.refresh_token):
+                    user.access_token = user.access_token or ML_ACCESS_TOKEN
+                    user.refresh_token = user.refresh_token or ML_REFRESH_TOKEN
                     user.updated_at = get_local_time_utc()
                     db.session.commit()
                     add_debug_log(f"✅ Usuário atualizado: {ML_USER_ID}")
@@ -581,7 +2840,7 @@ def initialize_database():
 # ========== INICIALIZAÇÃO AUTOMÁTICA ==========
 add_debug_log("🚀 Iniciando sistema Bot ML...")
 add_debug_log(f"📁 Diretório de dados: {DATA_DIR}")
-add_debug_log(f"🗄️ Banco de dados: {DATABASE_PATH}")
+add_debug_log(f"🗄️ Banco de dados: {DATABASE_PATH if IS_SQLITE else DATABASE_URL.split('@')[-1]}")
 add_debug_log(f"🔑 Token: {ML_ACCESS_TOKEN[:20]}...")
 add_debug_log(f"👤 User ID: {ML_USER_ID}")
 
@@ -594,6 +2853,7 @@ print(f"👤 User: {ML_USER_ID}")
 # ========== SISTEMA DE AUSÊNCIA E REGRAS AUTOMÁTICAS ==========
 # Baseado no módulo modulo_ausencia_regras_sistema.py - 100% FUNCIONAL
 
+@timed(ABSENCE_LOOKUP_SECONDS)
 def is_absence_time():
     """
     Verifica se está em horário de ausência
@@ -604,35 +2864,36 @@ def is_absence_time():
         current_time = now.strftime("%H:%M")
         current_weekday = str(now.weekday())  # 0=segunda, 6=domingo
         
-        add_debug_log(f"🌙 Verificando ausência - Horário: {current_time}, Dia: {current_weekday}")
+        add_debug_log("🌙 Verificando ausência - Horário: %s, Dia: %s", current_time, current_weekday, level=LOG_DEBUG)
         
         absence_configs = AbsenceConfig.query.filter_by(is_active=True).all()
-        add_debug_log(f"   Configurações ativas: {len(absence_configs)}")
+        add_debug_log("   Configurações ativas: %d", len(absence_configs), level=LOG_DEBUG)
         
         for config in absence_configs:
             if current_weekday in config.days_of_week.split(','):
                 start_time = config.start_time
                 end_time = config.end_time
                 
-                add_debug_log(f"   Testando: {config.name} ({start_time}-{end_time})")
+                add_debug_log("   Testando: %s (%s-%s)", config.name, start_time, end_time, level=LOG_DEBUG)
                 
                 # Se start_time > end_time, significa que cruza meia-noite
                 if start_time > end_time:
                     if current_time >= start_time or current_time <= end_time:
-                        add_debug_log(f"   ✅ AUSÊNCIA ATIVA: {config.name}")
+                        add_debug_log("   ✅ AUSÊNCIA ATIVA: %s", config.name)
                         return config.message
                 else:
                     if start_time <= current_time <= end_time:
-                        add_debug_log(f"   ✅ AUSÊNCIA ATIVA: {config.name}")
+                        add_debug_log("   ✅ AUSÊNCIA ATIVA: %s", config.name)
                         return config.message
         
-        add_debug_log("   ❌ Nenhuma configuração de ausência ativa")
+        add_debug_log("   ❌ Nenhuma configuração de ausência ativa", level=LOG_DEBUG)
         return None
         
     except Exception as e:
         add_debug_log(f"❌ Erro ao verificar ausência: {e}")
         return None
 
+@timed(CLASSIFICATION_SECONDS)
 def find_auto_response(question_text):
     """
     Encontra resposta automática baseada em palavras-chave
@@ -640,35 +2901,130 @@ def find_auto_response(question_text):
     """
     try:
         question_lower = question_text.lower()
-        add_debug_log(f"🔍 Buscando resposta para: '{question_text[:30]}...'")
+        add_debug_log("🔍 Buscando resposta para: '%.30s...'", question_text, level=LOG_DEBUG)
         
         auto_responses = AutoResponse.query.filter_by(is_active=True).all()
-        add_debug_log(f"   Regras ativas: {len(auto_responses)}")
+        add_debug_log("   Regras ativas: %d", len(auto_responses), level=LOG_DEBUG)
         
         for response in auto_responses:
             keywords = [k.strip().lower() for k in response.keywords.split(',')]
             
             for keyword in keywords:
                 if keyword and keyword in question_lower:
-                    add_debug_log(f"   ✅ MATCH: '{keyword}' -> {response.response_text[:30]}...")
+                    add_debug_log("   ✅ MATCH: '%s' -> %.30s...", keyword, response.response_text)
                     return response.response_text, response.keywords
         
-        add_debug_log("   ❌ Nenhuma palavra-chave encontrada")
+        add_debug_log("   ❌ Nenhuma palavra-chave encontrada", level=LOG_DEBUG)
         return None, None
         
     except Exception as e:
         add_debug_log(f"❌ Erro ao buscar resposta: {e}")
         return None, None
 
+# ====== Cache de "sem resposta" do polling ======
+# Pendentes sem regra e fora da ausência voltam em todo ciclo. O resultado por
+# pergunta vale até mudarem as regras/ausências (neste ou em outro processo) ou
+# até a próxima fronteira de uma janela de ausência (início, fim ou meia-noite).
+NO_REPLY_CACHE_MAX = 10000
+
+def next_absence_boundary():
+    """Próximo instante (epoch) em que o resultado de is_absence_time() pode mudar"""
+    now = get_local_time()
+    candidates = [(now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)]
+    try:
+        for config in AbsenceConfig.query.filter_by(is_active=True).all():
+            # O fim é inclusivo (HH:MM): a ausência termina no minuto seguinte
+            for hhmm, extra in ((config.start_time, 0), (config.end_time, 1)):
+                hour, minute = (int(part) for part in hhmm.split(':'))
+                at = now.replace(hour=hour, minute=minute, second=0, microsecond=0) + timedelta(minutes=extra)
+                if at > now:
+                    candidates.append(at)
+    except Exception as e:
+        add_debug_log(f"⚠️ Erro ao calcular fronteira de ausência: {e}")
+        return clock.time() + 60
+    return min(candidates).timestamp()
+
+class NoReplyCache:
+    """Perguntas pendentes já classificadas sem resposta na geração atual"""
+
+    def __init__(self, max_entries=NO_REPLY_CACHE_MAX):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.qids = OrderedDict()
+        self.generation = 0
+        self.valid_until = None
+        self.watcher = CacheVersionWatcher('reply_config')
+        self.hits = 0
+
+    def invalidate(self):
+        with self.lock:
+            self.qids.clear()
+            self.generation += 1
+            self.valid_until = None
+
+    def begin(self):
+        """
+        Valida o cache para um ciclo (chamar com app_context).
+        Retorna: geração a passar para known()/add()
+        """
+        if self.watcher.changed():
+            self.invalidate()
+        with self.lock:
+            if self.valid_until is not None and clock.time() >= self.valid_until:
+                self.qids.clear()
+                self.generation += 1
+                self.valid_until = None
+            if self.valid_until is not None:
+                return self.generation
+            generation = self.generation
+        valid_until = next_absence_boundary()
+        with self.lock:
+            if self.generation == generation and self.valid_until is None:
+                self.valid_until = valid_until
+            return self.generation
+
+    def known(self, qid, generation):
+        with self.lock:
+            if generation == self.generation and qid in self.qids:
+                self.hits += 1
+                return True
+            return False
+
+    def add(self, qid, generation):
+        """Guarda o resultado só se nada mudou desde begin() (senão pode estar velho)"""
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.qids[qid] = None
+            if len(self.qids) > self.max_entries:
+                self.qids.popitem(last=False)
+
+no_reply_cache = NoReplyCache()
+
+@event.listens_for(Session, 'after_flush')
+def _track_reply_config_changes(session, flush_context):
+    if any(isinstance(obj, (AutoResponse, AbsenceConfig))
+           for obj in itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['reply_config_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_reply_config(session):
+    if session.info.pop('reply_config_changed', False):
+        no_reply_cache.invalidate()
+        broadcast_cache_invalidation('reply_config')
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_reply_config_changes(session):
+    session.info.pop('reply_config_changed', None)
+
 def answer_question_ml(question_id, answer_text):
     """
     Responde uma pergunta no Mercado Livre
     Retorna: True se sucesso, False se erro
     """
-    url = f"https://api.mercadolibre.com/answers"
+    url = f"{ML_API_BASE_URL}/answers"
     
     headers = {
-        "Authorization": f"Bearer {ML_ACCESS_TOKEN}",
         "Content-Type": "application/json"
     }
     
@@ -679,7 +3035,8 @@ def answer_question_ml(question_id, answer_text):
     
     try:
         add_debug_log(f"📤 Enviando resposta para pergunta {question_id}")
-        response = requests.post(url, headers=headers, json=data)
+        credentials = credential_registry.primary()
+        response = ml_request("POST", url, credentials.access_token, credentials.ml_user_id, headers=headers, json=data)
         
         if response.status_code == 200:
             add_debug_log(f"✅ Resposta enviada com sucesso!")
@@ -698,11 +3055,7 @@ def fetch_unanswered_questions():
     Busca perguntas não respondidas do Mercado Livre
     Retorna: lista de perguntas
     """
-    url = f"https://api.mercadolibre.com/my/received_questions/search"
-    
-    headers = {
-        "Authorization": f"Bearer {ML_ACCESS_TOKEN}"
-    }
+    url = f"{ML_API_BASE_URL}/my/received_questions/search"
     
     params = {
         "status": "UNANSWERED",
@@ -711,7 +3064,8 @@ def fetch_unanswered_questions():
     
     try:
         add_debug_log("📥 Buscando perguntas não respondidas...")
-        response = requests.get(url, headers=headers, params=params)
+        credentials = credential_registry.primary()
+        response = ml_request("GET", url, credentials.access_token, credentials.ml_user_id, params=params)
         
         if response.status_code == 200:
             questions = response.json().get("questions", [])
@@ -746,6 +3100,10 @@ def process_questions():
                     add_debug_log("❌ Usuário não encontrado")
                     return
                 
+                # Resolver a página inteira de uma vez (uma consulta em vez de uma por pergunta)
+                answered, existing_ids = resolve_polled_questions(q.get("id") for q in questions)
+                questions = [q for q in questions if str(q.get("id")) not in answered]
+                
                 for q in questions:
                     question_id = str(q.get("id"))
                     question_text = q.get("text", "")
@@ -753,41 +3111,22 @@ def process_questions():
                     
                     add_debug_log(f"📩 Pergunta #{question_id}: '{question_text[:50]}...'")
                     
-                    # Verificar se já processamos esta pergunta
-                    existing = Question.query.filter_by(ml_question_id=question_id).first()
-                    if existing and existing.is_answered:
-                        add_debug_log(f"   ⏭️ Pergunta já respondida")
-                        continue
-                    
-                    # Se pergunta existe mas não foi respondida, reprocessar
-                    if existing and not existing.is_answered:
+                    start_time = time.time()
+                    if question_id in existing_ids:
                         add_debug_log(f"   🔄 Reprocessando pergunta não respondida")
-                        question = existing
-                        start_time = time.time()  # Tempo para reprocessamento
                     else:
                         # Nova pergunta - salvar no banco
-                        start_time = time.time()
-                        question = Question(
-                            ml_question_id=question_id,
-                            user_id=user.id,
-                            item_id=item_id,
-                            question_text=question_text,
-                            is_answered=False
-                        )
-                        db.session.add(question)
-                        db.session.flush()  # Para obter o ID
+                        save_pending_question(user.id, question_id, item_id, question_text)
                     
                     response_type = None
                     keywords_matched = None
+                    reply = None
                     
                     # 1. BUSCAR RESPOSTA AUTOMÁTICA POR PALAVRAS-CHAVE PRIMEIRO
                     auto_response, matched_keywords = find_auto_response(question_text)
                     if auto_response:
                         if answer_question_ml(question_id, auto_response):
-                            question.response_text = auto_response
-                            question.is_answered = True
-                            question.answered_automatically = True
-                            question.answered_at = get_local_time_utc()
+                            reply = auto_response
                             response_type = "auto"
                             keywords_matched = matched_keywords
                             add_debug_log(f"✅ Respondida automaticamente")
@@ -796,26 +3135,16 @@ def process_questions():
                         absence_message = is_absence_time()
                         if absence_message:
                             if answer_question_ml(question_id, absence_message):
-                                question.response_text = absence_message
-                                question.is_answered = True
-                                question.answered_automatically = True
-                                question.answered_at = get_local_time_utc()
+                                reply = absence_message
                                 response_type = "absence"
                                 add_debug_log(f"✅ Respondida com mensagem de ausência")
                     
-                    # Salvar histórico de resposta
+                    # Salvar resposta e histórico
                     if response_type:
-                        response_time = time.time() - start_time
-                        history = ResponseHistory(
-                            user_id=user.id,
-                            question_id=question.id,
-                            response_type=response_type,
-                            keywords_matched=keywords_matched,
-                            response_time=response_time
+                        save_answered_question(
+                            user.id, question_id, item_id, question_text, reply,
+                            response_type, keywords_matched, time.time() - start_time
                         )
-                        db.session.add(history)
-                    
-                    db.session.commit()
                     
                 add_debug_log("✅ Processamento concluído")
                 
@@ -916,73 +3245,95 @@ def create_default_data():
         add_debug_log(f"❌ Erro ao criar dados padrão: {e}")
 
 # ========== MONITORAMENTO CONTÍNUO ==========
+MONITOR_INTERVAL = int(os.getenv('MONITOR_INTERVAL', '30'))  # segundos entre ciclos de polling
 
 
-def monitor_questions():
-    """Função de monitoramento contínuo de perguntas (multi-conta)."""
-    while True:
+def poll_account(u):
+    """Um ciclo de polling para uma conta: busca, reivindica e responde as pendentes"""
+    polled_at = time.perf_counter()
+    qs = fetch_unanswered_questions_with_token(u.access_token, limit=50, ml_user_id=u.ml_user_id)
+    if not qs:
+        return
+    fetch_seconds = time.perf_counter() - polled_at
+    answered, existing_ids = resolve_polled_questions(q.get("id") for q in qs)
+    with app.app_context():
+        generation = no_reply_cache.begin()
+    pending = []
+    for q in qs:
+        qid = str(q.get("id"))
+        if qid in answered:
+            continue
+        if qid not in existing_ids:
+            save_pending_question(u.user_pk, qid, q.get("item_id", ""), q.get("text", ""))
+        elif no_reply_cache.known(qid, generation):
+            continue  # já classificada sem resposta e nada mudou desde então
+        pending.append(q)
+
+    # Só responde o que este nó conseguiu reivindicar
+    claimed = claim_questions([q.get("id") for q in pending])
+    for q in pending:
+        qid = str(q.get("id"))
+        if qid not in claimed:
+            continue
+        if not begin_question(qid):
+            continue  # já sendo respondida por um worker de webhook
         try:
-            if _initialized:
-                with app.app_context():
-                    users = User.query.all()
-                for u in users:
-                    try:
-                        qs = fetch_unanswered_questions_with_token(u.access_token, limit=50)
-                        if not qs:
-                            continue
-                        for q in qs:
-                            qid = str(q.get("id"))
-                            text = q.get("text", "")
-                            item_id = q.get("item_id", "")
-                            with app.app_context():
-                                existing = Question.query.filter_by(ml_question_id=qid).first()
-                                if existing and existing.is_answered:
-                                    continue
-                                if not existing:
-                                    question = Question(
-                                        ml_question_id=qid,
-                                        user_id=u.id,
-                                        item_id=item_id or "",
-                                        question_text=text or "",
-                                        is_answered=False
-                                    )
-                                    db.session.add(question)
-                                    db.session.flush()
-                                else:
-                                    question = existing
-                                auto_response, matched_keywords = find_auto_response(text or "")
-                                reply = auto_response or is_absence_time()
-                                if reply:
-                                    if answer_question_ml_with_token(u.access_token, qid, reply):
-                                        question.response_text = reply
-                                        question.is_answered = True
-                                        question.answered_automatically = True
-                                        question.answered_at = get_local_time_utc()
-                                        history = ResponseHistory(
-                                            user_id=u.id,
-                                            question_id=question.id,
-                                            response_type=("auto" if auto_response else "absence"),
-                                            keywords_matched=(matched_keywords),
-                                            response_time=0.0
-                                        )
-                                        db.session.add(history)
-                                db.session.commit()
-                    except Exception as e:
-                        try:
-                            uid = getattr(u, "ml_user_id", None) or getattr(u, "id", "?")
-                        except Exception:
-                            uid = "?"
-                        add_debug_log(f"❌ monitor/{uid}: {e}")
-            time.sleep(30)
+            if qid in _recently_answered:
+                continue  # respondida por um webhook durante este ciclo
+            text = q.get("text", "")
+            item_id = q.get("item_id", "")
+            # Vista no início do polling: a busca da página conta como 'fetch'
+            # e a espera pelas perguntas anteriores da página como 'queue'
+            trace = TraceContext(qid, 'poll', started=polled_at)
+            trace.add('fetch', fetch_seconds)
+            trace.add('queue', trace.elapsed() - fetch_seconds)
+            with app.app_context():
+                with trace.stage('classify'):
+                    auto_response, matched_keywords = find_auto_response(text or "")
+                reply = auto_response
+                if not reply:
+                    with trace.stage('absence'):
+                        reply = is_absence_time()
+            if not reply:
+                # Pendentes voltam a cada ciclo: só o primeiro é rastreado
+                if qid not in existing_ids:
+                    record_question_trace(trace, u.user_pk, 'none')
+                no_reply_cache.add(qid, generation)
+                continue
+            with trace.stage('send'):
+                sent = answer_question_ml_with_token(u.access_token, qid, reply, u.ml_user_id)
+            if not sent:
+                record_question_trace(trace, u.user_pk, 'error')
+                continue
+            QUESTIONS_ANSWERED.labels("auto" if auto_response else "absence", "poll").inc()
+            save_answered_question(
+                u.user_pk, qid, item_id, text, reply,
+                "auto" if auto_response else "absence",
+                matched_keywords, trace.elapsed(), trace=trace,
+                sla_seconds=sla_seconds_since(q.get('date_created'))
+            )
+        finally:
+            end_question(qid)
+
+def monitor_once():
+    """Um ciclo de monitoramento em todas as contas (usado pelo loop e por benchmarks)"""
+    # Credenciais vêm do registro em memória (sem consulta por ciclo)
+    for u in credential_registry.all():
+        try:
+            poll_account(u)
         except Exception as e:
-            add_debug_log(f"❌ Erro no monitoramento: {e}")
-            time.sleep(30)
+            add_debug_log(f"❌ monitor/{getattr(u, 'ml_user_id', '?')}: {e}")
+
+def monitor_questions():
+    """Ciclo do monitoramento contínuo de perguntas (multi-conta), a cada MONITOR_INTERVAL"""
+    if _initialized:
+        monitor_once()
 
 # ========== SISTEMA DE RENOVAÇÃO MANUAL DE TOKENS ==========
 # Baseado no módulo modulo_renovacao_token_manual.py - 100% FUNCIONAL
 
-# Cache para evitar processamento duplicado de códigos
-processed_codes = set()
+# Códigos já usados ficam no estado compartilhado (todos os workers enxergam)
+OAUTH_CODE_TTL = 3600  # segundos
 
 def extract_code_from_input(input_str):
     """
@@ -1017,7 +3368,7 @@ def generate_auth_url():
     redirect_uri = REDIRECT_URIS[0]  # Usar webhook como padrão
     
     url = (
-        f"https://auth.mercadolivre.com.br/authorization?"
+        f"{ML_AUTH_BASE_URL}/authorization?"
         f"response_type=code&"
         f"client_id={ML_CLIENT_ID}&"
         f"redirect_uri={redirect_uri}&"
@@ -1037,8 +3388,8 @@ def process_auth_code_flexible(code):
         clean_code = extract_code_from_input(code)
         add_debug_log(f"🔄 Processando código: {clean_code}")
         
-        # CORREÇÃO: Verificar se código já foi processado
-        if clean_code in processed_codes:
+        # CORREÇÃO: Verificar se código já foi processado (add atômico entre processos)
+        if not shared_state.add(f"oauth_code:{clean_code}", node_id(), ttl=OAUTH_CODE_TTL):
             add_debug_log(f"⚠️ Código já foi processado anteriormente: {clean_code}")
             return False, {
                 'success': False,
@@ -1046,14 +3397,11 @@ def process_auth_code_flexible(code):
                 'message': 'Este código de autorização já foi usado. Gere um novo código.'
             }
         
-        # Adicionar ao cache de códigos processados
-        processed_codes.add(clean_code)
-        
         for i, redirect_uri in enumerate(REDIRECT_URIS):
             try:
                 add_debug_log(f"🔄 Tentativa {i+1}/4 com redirect_uri: {redirect_uri}")
                 
-                url = "https://api.mercadolibre.com/oauth/token"
+                url = f"{ML_API_BASE_URL}/oauth/token"
                 data = {
                     'grant_type': 'authorization_code',
                     'client_id': ML_CLIENT_ID,
@@ -1075,7 +3423,7 @@ def process_auth_code_flexible(code):
                         'access_token': token_data['access_token'],
                         'refresh_token': token_data.get('refresh_token', ''),
                         'user_id': str(token_data['user_id']),
-                        'expires_in': token_data.get('expires_in', 21600),
+                        'expires_in': token_data.get('expires_in', TOKEN_DEFAULT_EXPIRES_IN),
                         'user_info': user_info,
                         'redirect_uri_used': redirect_uri
                     }
@@ -1092,7 +3440,7 @@ def process_auth_code_flexible(code):
                 continue
         
         # Remover do cache se todas as tentativas falharam
-        processed_codes.discard(clean_code)
+        shared_state.delete(f"oauth_code:{clean_code}")
         
         add_debug_log("❌ Todas as tentativas falharam")
         return False, {
@@ -1112,7 +3460,7 @@ def process_auth_code_flexible(code):
 def get_user_info(access_token):
     """Busca informações do usuário"""
     try:
-        url = f"https://api.mercadolibre.com/users/me?access_token={access_token}"
+        url = f"{ML_API_BASE_URL}/users/me?access_token={access_token}"
         response = requests.get(url)
         
         if response.status_code == 200:
@@ -1126,14 +3474,19 @@ def get_user_info(access_token):
         return None
 
 
-def update_system_tokens(access_token, refresh_token, user_id):
-    """Atualiza tokens no sistema (globais + DB) e inicia auto-refresh por usuário"""
+def update_system_tokens(access_token, refresh_token, user_id, make_primary=True, expires_in=TOKEN_DEFAULT_EXPIRES_IN):
+    """
+    Atualiza tokens no sistema (registro + DB) e inicia auto-refresh por usuário.
+    make_primary=False (renovações) não troca a conta principal.
+    """
     try:
         add_debug_log("🔄 Atualizando tokens no sistema...")
         global ML_ACCESS_TOKEN, ML_REFRESH_TOKEN, ML_USER_ID
-        ML_ACCESS_TOKEN = access_token
-        ML_REFRESH_TOKEN = refresh_token
-        ML_USER_ID = user_id
+        if make_primary or str(user_id) == str(ML_USER_ID):
+            ML_ACCESS_TOKEN = access_token
+            ML_REFRESH_TOKEN = refresh_token
+            ML_USER_ID = user_id
+        credential_registry.invalidate(user_id)
         with app.app_context():
             user = User.query.filter_by(ml_user_id=user_id).first()
             if not user:
@@ -1141,12 +3494,12 @@ def update_system_tokens(access_token, refresh_token, user_id):
                 db.session.add(user)
             user.access_token = access_token
             user.refresh_token = refresh_token
-            user.token_expires_at = get_local_time_utc() + timedelta(hours=6)
+            user.token_expires_at = get_local_time_utc() + timedelta(seconds=int(expires_in))
             user.updated_at = get_local_time_utc()
             db.session.commit()
         inst = multi_refresh.get(str(user_id))
-        inst.update_system_tokens_internal(access_token, refresh_token, str(user_id))
-        inst.start_auto_refresh(21600)
+        inst.update_system_tokens_internal(access_token, refresh_token, str(user_id), expires_in)
+        inst.start_auto_refresh(int(expires_in))
         add_debug_log("✅ Sistema atualizado com novos tokens!")
         add_debug_log(f"🔑 Access Token: {access_token[:20]}...")
         add_debug_log(f"🔄 Refresh Token: {refresh_token[:20]}...")
@@ -1340,7 +3693,8 @@ def api_process_code_flexible():
             update_success, update_message = update_system_tokens(
                 result['access_token'],
                 result['refresh_token'],
-                result['user_id']
+                result['user_id'],
+                expires_in=result.get('expires_in', TOKEN_DEFAULT_EXPIRES_IN)
             )
             
             if update_success:
@@ -1377,7 +3731,8 @@ def webhook_ml():
                     update_system_tokens(
                         result['access_token'],
                         result['refresh_token'],
-                        result['user_id']
+                        result['user_id'],
+                        expires_in=result.get('expires_in', TOKEN_DEFAULT_EXPIRES_IN)
                     )
                     
                     return f"""
@@ -1412,99 +3767,116 @@ def webhook_ml():
             # Processar notificação do ML
             data = request.get_json()
             
+            if data:
+                WEBHOOKS_RECEIVED.labels(str(data.get('topic'))).inc()
+                traffic_capture.record_webhook(data)
             if data and data.get('topic') == 'questions':
                 add_debug_log(f"📨 Notificação de pergunta recebida: {data}")
+                received_at = time.perf_counter()
 
-                # Salvar log do webhook
-                webhook_log = WebhookLog(
+                # Salvar log do webhook (fila de escrita, sem bloquear a resposta)
+                webhook_log_values = dict(
                     topic=data.get('topic'),
                     resource=data.get('resource'),
                     user_id_ml=str(data.get('user_id')),
                     application_id=data.get('application_id'),
                     sent=datetime.fromisoformat(data.get('sent', '').replace('Z', '+00:00')) if data.get('sent') else None
                 )
-                db.session.add(webhook_log)
-                db.session.commit()
+                db_writer.submit(lambda session: session.add(WebhookLog(**webhook_log_values)))
 
                 resource = data.get('resource', '')
                 qid = resource.split('/')[-1] if resource else None
                 user_id_ml = str(data.get('user_id'))
+                trace = TraceContext(qid, 'webhook', started=received_at)
 
                 def worker():
+                    WEBHOOK_WORKERS_ACTIVE.inc()
+                    trace.add('queue', trace.elapsed())
+                    user_pk = None
+                    in_flight = False
                     try:
                         if not qid or not user_id_ml:
                             add_debug_log("⚠️ Webhook sem qid ou user_id")
+                            record_question_trace(trace, None, 'skipped')
                             return
-                        access_token, _rt = get_user_tokens_by_ml_id(user_id_ml)
-                        q = fetch_question_by_id_with_token(access_token, qid)
-                        if not q:
-                            # fallback leve: tenta via listagem do próprio usuário
-                            qs = fetch_unanswered_questions_with_token(access_token, limit=50)
-                            for x in qs:
-                                if str(x.get("id")) == str(qid):
-                                    q = x
-                                    break
+                        credentials = credential_registry.get(user_id_ml)
+                        user_pk = credentials.user_pk if credentials else None
+                        in_flight = begin_question(qid)
+                        if not in_flight:
+                            add_debug_log(f"⏭️ Pergunta {qid} já está em processamento (notificação duplicada)")
+                            record_question_trace(trace, user_pk, 'skipped')
+                            return
+                        if not credentials:
+                            raise RuntimeError(f"Sem tokens salvos para o user {user_id_ml}")
+                        access_token = credentials.access_token
+                        with trace.stage('fetch'):
+                            q = fetch_question_by_id_with_token(access_token, qid, user_id_ml)
+                            if not q:
+                                # fallback leve: tenta via listagem do próprio usuário
+                                qs = fetch_unanswered_questions_with_token(access_token, limit=50, ml_user_id=user_id_ml)
+                                for x in qs:
+                                    if str(x.get("id")) == str(qid):
+                                        q = x
+                                        break
                         if not q:
                             add_debug_log(f"⚠️ Pergunta {qid} não disponível ainda; será capturada no próximo ciclo")
+                            record_question_trace(trace, user_pk, 'unavailable')
                             return
 
                         text = q.get('text', '')
                         item_id = q.get('item_id', '')
 
+                        answered, existing_ids = resolve_polled_questions([qid])
+                        already_answered = str(qid) in answered
+
+                        if already_answered:
+                            add_debug_log("⏭️ Pergunta já respondida")
+                            record_question_trace(trace, user_pk, 'skipped')
+                            return
+                        if str(qid) not in existing_ids:
+                            save_pending_question(user_pk, qid, item_id, text)
+                        if str(qid) not in claim_questions([qid]):
+                            add_debug_log(f"⏭️ Pergunta {qid} já está sendo respondida por outro nó")
+                            record_question_trace(trace, user_pk, 'skipped')
+                            return
+
                         with app.app_context():
-                            user = User.query.filter_by(ml_user_id=user_id_ml).first()
-                            if not user:
-                                user = User(ml_user_id=user_id_ml, access_token=access_token, token_expires_at=get_local_time_utc() + timedelta(hours=6))
-                                db.session.add(user)
-                                db.session.commit()
-
-                            existing = Question.query.filter_by(ml_question_id=str(qid)).first()
-                            if existing and existing.is_answered:
-                                add_debug_log("⏭️ Pergunta já respondida")
-                                return
-
-                            question = existing or Question(
-                                ml_question_id=str(qid),
-                                user_id=user.id,
-                                item_id=item_id or "",
-                                question_text=text or "",
-                                is_answered=False
-                            )
-                            if not existing:
-                                db.session.add(question)
-                                db.session.flush()
-
-                            start_time = time.time()
-                            response_type = None
-                            keywords_matched = None
-
-                            auto_response, matched_keywords = find_auto_response(text or "")
-                            reply = auto_response or is_absence_time()
-                            if reply:
-                                if answer_question_ml_with_token(access_token, str(qid), reply):
-                                    question.response_text = reply
-                                    question.is_answered = True
-                                    question.answered_automatically = True
-                                    question.answered_at = get_local_time_utc()
-                                    response_type = "auto" if auto_response else "absence"
-                                    keywords_matched = matched_keywords
-
-                            if response_type:
-                                history = ResponseHistory(
-                                    user_id=user.id,
-                                    question_id=question.id,
-                                    response_type=response_type,
-                                    keywords_matched=keywords_matched,
-                                    response_time=time.time() - start_time
+                            with trace.stage('classify'):
+                                auto_response, matched_keywords = find_auto_response(text or "")
+                            reply = auto_response
+                            if not reply:
+                                with trace.stage('absence'):
+                                    reply = is_absence_time()
+                        if not reply:
+                            record_question_trace(trace, user_pk, 'none')
+                        else:
+                            with trace.stage('send'):
+                                sent = answer_question_ml_with_token(access_token, str(qid), reply, user_id_ml)
+                            if not sent:
+                                record_question_trace(trace, user_pk, 'error')
+                            else:
+                                response_type = "auto" if auto_response else "absence"
+                                WEBHOOK_TO_ANSWER_SECONDS.labels(response_type).observe(trace.elapsed())
+                                QUESTIONS_ANSWERED.labels(response_type, "webhook").inc()
+                                save_answered_question(
+                                    user_pk, qid, item_id, text, reply,
+                                    response_type,
+                                    matched_keywords, trace.elapsed(), trace=trace,
+                                    sla_seconds=sla_seconds_since(q.get('date_created'))
                                 )
-                                db.session.add(history)
 
-                            db.session.commit()
-                            add_debug_log("✅ Webhook processado por ID com sucesso")
+                        add_debug_log("✅ Webhook processado por ID com sucesso")
                     except Exception as e:
                         add_debug_log(f"❌ Erro ao processar webhook/ID: {e}")
-
-                threading.Thread(target=worker, daemon=True).start()
+                        record_question_trace(trace, user_pk, 'error')
+                    finally:
+                        if in_flight:
+                            end_question(qid)
+                        WEBHOOK_WORKERS_ACTIVE.dec()
+
+                # Só ids numéricos vão para o nome da thread (aparece em /metrics e no profiler)
+                thread_name = f'webhook-{qid}' if qid and qid.isdigit() else 'webhook'
+                threading.Thread(target=worker, name=thread_name, daemon=True).start()
                 return jsonify({"status": "ok", "message": "notificação processada"})
             return jsonify({"status": "ok", "message": "webhook recebido"})
         
@@ -1861,37 +4233,26 @@ def dashboard():
         initialize_database()
         
         with app.app_context():
-            # Buscar estatísticas
-            total_questions = Question.query.count()
+            # Buscar estatísticas (rollup diário, sem varrer o histórico)
             today = get_local_time().date()
-            today_start = datetime.combine(today, datetime.min.time())
-            today_start_utc = today_start.replace(tzinfo=SAO_PAULO_TZ).astimezone(timezone.utc).replace(tzinfo=None)
+            stats_all = get_daily_stats_summary()
+            stats_today = get_daily_stats_summary(since_day=today)
             
-            answered_today = Question.query.filter(
-                Question.answered_at >= today_start_utc,
-                Question.is_answered == True
-            ).count()
+            total_questions = stats_all.get(DAILY_STATS_RECEIVED, {}).get('count', 0)
+            answered_today = summarize_answers(stats_today)['count']
+            auto_responses_today = stats_today.get('auto', {}).get('count', 0)
+            absence_responses_today = stats_today.get('absence', {}).get('count', 0)
             
-            auto_responses_today = ResponseHistory.query.filter(
-                ResponseHistory.created_at >= today_start_utc,
-                ResponseHistory.response_type == 'auto'
-            ).count()
-            
-            absence_responses_today = ResponseHistory.query.filter(
-                ResponseHistory.created_at >= today_start_utc,
-                ResponseHistory.response_type == 'absence'
-            ).count()
-            
-            # Tempo médio de resposta
-            avg_response = db.session.query(db.func.avg(ResponseHistory.response_time)).scalar()
-            avg_response = round(avg_response, 2) if avg_response else 0
+            # SLA ponta a ponta (criação no ML -> resposta aceita), dos sketches em memória
+            sla = sla_stats.snapshot()
+            sla_all = sla['all'] or {}
             
             # Status do token com renovação automática
             token_valid = True
             token_message = "Token válido"
             try:
-                url = "https://api.mercadolibre.com/users/me"
-                headers = {"Authorization": f"Bearer {ML_ACCESS_TOKEN}"}
+                url = f"{ML_API_BASE_URL}/users/me"
+                headers = {"Authorization": f"Bearer {credential_registry.primary().access_token}"}
                 response = requests.get(url, headers=headers, timeout=10)
                 if response.status_code != 200:
                     token_valid = False
@@ -1952,8 +4313,8 @@ def dashboard():
                     <div>
                         <h4>📊 Status Atual</h4>
                         <p><strong>Status:</strong> <span style="color: {token_color}; font-weight: bold;">{token_status}</span></p>
-                        <p><strong>Token:</strong> {ML_ACCESS_TOKEN[:20]}...</p>
-                        <p><strong>User ID:</strong> {ML_USER_ID}</p>
+                        <p><strong>Token:</strong> {credential_registry.primary().access_token[:20]}...</p>
+                        <p><strong>User ID:</strong> {credential_registry.primary().ml_user_id}</p>
                         <p><strong>Conexão:</strong> {token_message}</p>
                     </div>
                     <div>
@@ -2089,9 +4450,36 @@ def dashboard():
             content += create_stat_card(answered_today, "Respondidas Hoje")
             content += create_stat_card(auto_responses_today, "Respostas Automáticas", "#28a745" if auto_responses_today > 0 else "#dc3545")
             content += create_stat_card(absence_responses_today, "Respostas Ausência", "#ffc107")
-            content += create_stat_card(f"{avg_response}s", "Tempo Médio")
+            content += create_stat_card(format_duration(sla_all.get('p50')), "SLA p50")
+            content += create_stat_card(format_duration(sla_all.get('p95')), "SLA p95", "#ffc107")
+            content += create_stat_card(format_duration(sla_all.get('p99')), "SLA p99", "#dc3545")
             content += '</div>'
             
+            # Percentis de SLA por tipo de resposta e por conta
+            sla_rows = [(f"Tipo: {key}", stats) for key, stats in sorted(sla['by_type'].items())]
+            if len(sla['by_account']) > 1:
+                sla_rows += [(f"Conta: {key}", stats) for key, stats in sorted(sla['by_account'].items())]
+            if sla_rows:
+                content += """
+            <div class="card">
+                <h3>⏱️ SLA: criação da pergunta → resposta aceita</h3>
+                <table class="table">
+                    <thead>
+                        <tr><th>Grupo</th><th>Respostas</th><th>p50</th><th>p95</th><th>p99</th></tr>
+                    </thead>
+                    <tbody>
+                """
+                for label, stats in sla_rows:
+                    content += f"""
+                        <tr><td>{html.escape(label)}</td><td>{stats['count']}</td><td>{format_duration(stats['p50'])}</td>
+                            <td>{format_duration(stats['p95'])}</td><td>{format_duration(stats['p99'])}</td></tr>
+                    """
+                content += """
+                    </tbody>
+                </table>
+            </div>
+                """
+            
             # Últimas perguntas
             recent_questions = Question.query.order_by(Question.created_at.desc()).limit(5).all()
             
@@ -2147,28 +4535,330 @@ def dashboard():
         return create_base_template("Erro", error_content)
 
 # ========== PÁGINA DE HISTÓRICO ==========
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+def encode_history_cursor(created_at, history_id):
+    """Cursor opaco (created_at, id) da última linha de uma página"""
+    raw = json.dumps([created_at.isoformat(), history_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_history_cursor(cursor):
+    """Inverso de encode_history_cursor; ValueError se inválido"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, history_id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        return datetime.fromisoformat(created_at), int(history_id)
+    except Exception:
+        raise ValueError("Cursor inválido")
+
+def local_day_start_utc(day):
+    """Início do dia local (São Paulo) convertido para UTC ingênuo, como salvo no banco"""
+    start = datetime.combine(day, datetime.min.time()).replace(tzinfo=SAO_PAULO_TZ)
+    return start.astimezone(timezone.utc).replace(tzinfo=None)
+
+def query_history_page(cursor=None, limit=HISTORY_PAGE_SIZE, account=None, response_type=None,
+                       rule=None, item_id=None, date_from=None, date_to=None):
+    """
+    Página de histórico ordenada por (created_at, id) desc, paginada por cursor (keyset).
+    O custo por página é constante: o cursor vira um WHERE sobre o índice, sem OFFSET.
+    Retorna: (linhas [(ResponseHistory, Question, User)], próximo cursor ou None)
+    """
+    query = db.session.query(ResponseHistory, Question, User).select_from(ResponseHistory) \
+        .join(Question, Question.id == ResponseHistory.question_id) \
+        .join(User, User.id == ResponseHistory.user_id)
+
+    if account:
+        query = query.filter(User.ml_user_id == str(account))
+    if response_type:
+        query = query.filter(ResponseHistory.response_type == response_type)
+    if rule:
+        query = query.filter(ResponseHistory.keywords_matched == rule)
+    if item_id:
+        query = query.filter(Question.item_id == item_id)
+    if date_from:
+        query = query.filter(ResponseHistory.created_at >= local_day_start_utc(date_from))
+    if date_to:
+        query = query.filter(ResponseHistory.created_at < local_day_start_utc(date_to + timedelta(days=1)))
+    if cursor:
+        cursor_created_at, cursor_id = decode_history_cursor(cursor)
+        query = query.filter(or_(
+            ResponseHistory.created_at < cursor_created_at,
+            db.and_(ResponseHistory.created_at == cursor_created_at, ResponseHistory.id < cursor_id)
+        ))
+
+    rows = query.order_by(ResponseHistory.created_at.desc(), ResponseHistory.id.desc()).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = encode_history_cursor(last.created_at, last.id)
+    return rows, next_cursor
+
+def serialize_history_row(history, question, user):
+    """Linha de histórico para a API JSON"""
+    local_time = format_local_time(history.created_at)
+    return {
+        "id": history.id,
+        "created_at": local_time.isoformat() if local_time else None,
+        "account": user.ml_user_id,
+        "response_type": history.response_type,
+        "keywords_matched": history.keywords_matched,
+        "response_time": history.response_time,
+        "trace_id": history.trace_id,
+        "question": {
+            "ml_question_id": question.ml_question_id,
+            "item_id": question.item_id,
+            "text": question.question_text,
+            "response_text": question.response_text
+        }
+    }
+
+@app.route('/api/history')
+def api_history():
+    """API de histórico com paginação por cursor e filtros"""
+    try:
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        rows, next_cursor = query_history_page(
+            cursor=request.args.get('cursor') or None,
+            limit=limit,
+            account=request.args.get('account') or None,
+            response_type=request.args.get('type') or None,
+            rule=request.args.get('rule') or None,
+            item_id=request.args.get('item') or None,
+            date_from=datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None,
+            date_to=datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+        )
+        return jsonify({
+            "success": True,
+            "items": [serialize_history_row(*row) for row in rows],
+            "next_cursor": next_cursor
+        })
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        add_debug_log(f"❌ Erro na API de histórico: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+TRACE_SUMMARY_MAX_ROWS = 5000
+
+def serialize_trace(trace):
+    """Linha de question_traces para a API JSON"""
+    local_time = format_local_time(trace.created_at)
+    return {
+        "trace_id": trace.trace_id,
+        "ml_question_id": trace.ml_question_id,
+        "source": trace.source,
+        "outcome": trace.outcome,
+        "created_at": local_time.isoformat() if local_time else None,
+        "stages_ms": {name: getattr(trace, f"{name}_ms") for name in TRACE_STAGES},
+        "total_ms": trace.total_ms
+    }
+
+def summarize_traces(traces):
+    """Média, p50, p95 e máximo por etapa; 'dominant' é a etapa com maior tempo somado"""
+    summary = {}
+    for name in TRACE_STAGES + ('total',):
+        values = sorted(v for v in (getattr(t, f"{name}_ms") for t in traces) if v is not None)
+        if not values:
+            continue
+        summary[name] = {
+            "count": len(values),
+            "avg_ms": round(sum(values) / len(values), 2),
+            "p50_ms": values[int(0.50 * (len(values) - 1))],
+            "p95_ms": values[int(0.95 * (len(values) - 1))],
+            "max_ms": values[-1],
+            "sum_ms": round(sum(values), 2)
+        }
+    stages = {name: stats['sum_ms'] for name, stats in summary.items() if name != 'total'}
+    return summary, (max(stages, key=stages.get) if stages else None)
+
+@app.route('/api/traces')
+def api_traces():
+    """
+    API de traces por pergunta (?question=<id ML>, ?trace=, ?source=webhook|poll,
+    ?outcome=, ?hours=24, ?limit=100) com resumo por etapa da janela pedida
+    """
+    try:
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        hours = min(max(request.args.get('hours', 24, type=float), 0), 24 * 90)
+        query = QuestionTrace.query
+        if request.args.get('question'):
+            query = query.filter(QuestionTrace.ml_question_id == request.args['question'])
+        if request.args.get('trace'):
+            query = query.filter(QuestionTrace.trace_id == request.args['trace'])
+        if request.args.get('source'):
+            query = query.filter(QuestionTrace.source == request.args['source'])
+        if request.args.get('outcome'):
+            query = query.filter(QuestionTrace.outcome == request.args['outcome'])
+        if hours:
+            query = query.filter(QuestionTrace.created_at >= get_local_time_utc() - timedelta(hours=hours))
+        window = query.order_by(QuestionTrace.created_at.desc(), QuestionTrace.id.desc()).limit(TRACE_SUMMARY_MAX_ROWS).all()
+        summary, dominant = summarize_traces(window)
+        return jsonify({
+            "success": True,
+            "traces": [serialize_trace(t) for t in window[:limit]],
+            "summary": summary,
+            "dominant_stage": dominant,
+            "sampled": len(window)
+        })
+    except Exception as e:
+        add_debug_log(f"❌ Erro na API de traces: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+# Marcadores de destaque dos trechos (trocados por <mark> após escapar o HTML)
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def build_fts_query(terms):
+    """Converte texto livre em consulta FTS5 segura (termos entre aspas, todos obrigatórios)"""
+    words = [w.replace('"', '""') for w in terms.split() if w.strip('"')]
+    if not words:
+        return None
+    # Último termo como prefixo para buscar enquanto digita
+    return ' '.join(f'"{w}"' for w in words[:-1]) + (' ' if len(words) > 1 else '') + f'"{words[-1]}"*'
+
+def highlight_snippet(snippet):
+    """Escapa o trecho e converte os marcadores em <mark>"""
+    if not snippet:
+        return ''
+    return html.escape(snippet).replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+def search_questions(terms, limit=HISTORY_PAGE_SIZE, account=None, item_id=None, date_from=None, date_to=None):
+    """
+    Busca textual em perguntas e respostas, ordenada por relevância
+    Retorna: lista de dicts com trechos destacados
+    """
+    params = {'limit': limit}
+    filters = []
+    if account:
+        filters.append('u.ml_user_id = :account')
+        params['account'] = str(account)
+    if item_id:
+        filters.append('q.item_id = :item_id')
+        params['item_id'] = item_id
+    if date_from:
+        filters.append('q.created_at >= :date_from')
+        params['date_from'] = local_day_start_utc(date_from)
+    if date_to:
+        filters.append('q.created_at < :date_to')
+        params['date_to'] = local_day_start_utc(date_to + timedelta(days=1))
+    extra = ''.join(f' AND {f}' for f in filters)
+
+    if IS_SQLITE:
+        params['query'] = build_fts_query(terms)
+        if not params['query']:
+            return []
+        sql = f"""
+            SELECT q.id, q.ml_question_id, q.item_id, q.created_at, q.is_answered, u.ml_user_id,
+                   snippet(questions_fts, 0, :start, :end, '…', 16) AS question_snippet,
+                   snippet(questions_fts, 1, :start, :end, '…', 16) AS response_snippet,
+                   bm25(questions_fts) AS rank
+            FROM questions_fts
+            JOIN questions q ON q.id = questions_fts.rowid
+            JOIN users u ON u.id = q.user_id
+            WHERE questions_fts MATCH :query{extra}
+            ORDER BY rank
+            LIMIT :limit
+        """
+    else:
+        params['query'] = terms
+        # Ranqueia e limita antes de gerar os trechos (ts_headline é caro)
+        sql = f"""
+            SELECT m.id, m.ml_question_id, m.item_id, m.created_at, m.is_answered, m.ml_user_id,
+                   ts_headline('portuguese', coalesce(m.question_text, ''), m.tsq, :headline) AS question_snippet,
+                   ts_headline('portuguese', coalesce(m.response_text, ''), m.tsq, :headline) AS response_snippet,
+                   -m.rank AS rank
+            FROM (
+                SELECT q.id, q.ml_question_id, q.item_id, q.created_at, q.is_answered, u.ml_user_id,
+                       q.question_text, q.response_text, tsq,
+                       ts_rank({questions_tsvector_sql('q')}, tsq) AS rank
+                FROM questions q
+                JOIN users u ON u.id = q.user_id,
+                     plainto_tsquery('portuguese', :query) AS tsq
+                WHERE {questions_tsvector_sql('q')} @@ tsq{extra}
+                ORDER BY rank DESC
+                LIMIT :limit
+            ) m
+            ORDER BY m.rank DESC
+        """
+        params['headline'] = f'StartSel={SNIPPET_START}, StopSel={SNIPPET_END}, MaxWords=30, MinWords=10'
+
+    params['start'] = SNIPPET_START
+    params['end'] = SNIPPET_END
+    rows = db.session.execute(text(sql), params).mappings().all()
+    results = []
+    for row in rows:
+        created_at = row['created_at']
+        if isinstance(created_at, str):
+            created_at = datetime.fromisoformat(created_at)
+        local_time = format_local_time(created_at)
+        results.append({
+            "id": row['id'],
+            "ml_question_id": row['ml_question_id'],
+            "item_id": row['item_id'],
+            "account": row['ml_user_id'],
+            "is_answered": bool(row['is_answered']),
+            "created_at": local_time.isoformat() if local_time else None,
+            "question_snippet": highlight_snippet(row['question_snippet']),
+            "response_snippet": highlight_snippet(row['response_snippet']),
+            "rank": row['rank']
+        })
+    return results
+
+@app.route('/api/search')
+def api_search():
+    """Busca textual em perguntas e respostas (ranqueada, com trechos destacados)"""
+    try:
+        terms = (request.args.get('q') or '').strip()
+        if not terms:
+            return jsonify({"success": False, "error": "Parâmetro q é obrigatório"}), 400
+        limit = min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), HISTORY_MAX_PAGE_SIZE)
+        date_from = request.args.get('from')
+        date_to = request.args.get('to')
+        start = time.time()
+        results = search_questions(
+            terms,
+            limit=limit,
+            account=request.args.get('account') or None,
+            item_id=request.args.get('item') or None,
+            date_from=datetime.strptime(date_from, '%Y-%m-%d').date() if date_from else None,
+            date_to=datetime.strptime(date_to, '%Y-%m-%d').date() if date_to else None
+        )
+        return jsonify({
+            "success": True,
+            "query": terms,
+            "results": results,
+            "elapsed_ms": round((time.time() - start) * 1000, 2)
+        })
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        add_debug_log(f"❌ Erro na busca: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
 @app.route('/history')
 def history_page():
-    """Página de histórico de respostas"""
+    """Página de histórico de respostas (rolagem infinita via /api/history)"""
     try:
         with app.app_context():
-            # Buscar histórico com joins - CORRIGIDO
-            history_query = db.session.query(
-                ResponseHistory,
-                Question,
-                User
-            ).select_from(ResponseHistory).join(Question).join(User).order_by(ResponseHistory.created_at.desc()).limit(100)
+            # Estatísticas do histórico (rollup diário)
+            stats = get_daily_stats_summary()
+            answers = summarize_answers(stats)
+            total_responses = answers['count']
+            auto_count = stats.get('auto', {}).get('count', 0)
+            absence_count = stats.get('absence', {}).get('count', 0)
+            manual_count = stats.get('manual', {}).get('count', 0)
             
-            history_records = history_query.all()
+            avg_time = answers['avg_time']
             
-            # Estatísticas do histórico
-            total_responses = ResponseHistory.query.count()
-            auto_count = ResponseHistory.query.filter_by(response_type='auto').count()
-            absence_count = ResponseHistory.query.filter_by(response_type='absence').count()
-            manual_count = ResponseHistory.query.filter_by(response_type='manual').count()
-            
-            avg_time = db.session.query(db.func.avg(ResponseHistory.response_time)).scalar()
-            avg_time = round(avg_time, 2) if avg_time else 0
+            # Filtro por regra: o histórico guarda as palavras-chave da regra que respondeu
+            rule_keywords = sorted({k for (k,) in db.session.query(AutoResponse.keywords).distinct() if k})
+            rule_options = ''.join(
+                f'<option value="{html.escape(k, quote=True)}">{html.escape(k[:60])}</option>' for k in rule_keywords
+            )
             
             content = create_header("📊 Histórico de Respostas", "Análise detalhada das respostas enviadas")
             content += create_navigation("history")
@@ -2182,10 +4872,59 @@ def history_page():
             content += create_stat_card(f"{avg_time}s", "Tempo Médio")
             content += '</div>'
             
-            # Tabela de histórico
+            # Busca textual, filtros e tabela de histórico (preenchida pela API)
             content += """
             <div class="card">
-                <h3>📋 Últimas 100 Respostas</h3>
+                <h3>🔍 Buscar em perguntas e respostas</h3>
+                <form id="search-form" style="display: flex; gap: 10px;">
+                    <input type="text" id="search-q" placeholder="Ex: voltagem 220v" style="flex: 1; padding: 10px; border: 1px solid #ddd; border-radius: 5px;">
+                    <button type="submit" class="btn">🔍 Buscar</button>
+                </form>
+                <p style="color: #666; font-size: 0.9em; margin-top: 8px;">Os filtros de conta, item e período abaixo também se aplicam à busca.</p>
+                <div id="search-results"></div>
+            </div>
+            
+            <div class="card">
+                <h3>🔎 Filtros</h3>
+                <form id="history-filters" style="display: grid; grid-template-columns: repeat(auto-fit, minmax(160px, 1fr)); gap: 10px; align-items: end;">
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-type">Tipo</label>
+                        <select id="f-type" name="type">
+                            <option value="">Todos</option>
+                            <option value="auto">🤖 Automática</option>
+                            <option value="absence">🌙 Ausência</option>
+                            <option value="manual">👤 Manual</option>
+                        </select>
+                    </div>
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-rule">Regra</label>
+                        <select id="f-rule" name="rule">
+                            <option value="">Todas</option>
+                            """ + rule_options + """
+                        </select>
+                    </div>
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-account">Conta (ML user id)</label>
+                        <input type="text" id="f-account" name="account">
+                    </div>
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-item">Item</label>
+                        <input type="text" id="f-item" name="item" placeholder="MLB...">
+                    </div>
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-from">De</label>
+                        <input type="date" id="f-from" name="from">
+                    </div>
+                    <div class="form-group" style="margin-bottom: 0;">
+                        <label for="f-to">Até</label>
+                        <input type="date" id="f-to" name="to">
+                    </div>
+                    <button type="submit" class="btn">🔎 Filtrar</button>
+                </form>
+            </div>
+            
+            <div class="card">
+                <h3>📋 Respostas</h3>
                 <table class="table">
                     <thead>
                         <tr>
@@ -2196,45 +4935,120 @@ def history_page():
                             <th>Tempo</th>
                         </tr>
                     </thead>
-                    <tbody>
-            """
+                    <tbody id="history-body"></tbody>
+                </table>
+                <div id="history-sentinel" style="text-align: center; padding: 15px; color: #666;">Carregando...</div>
+            </div>
             
-            for history, question, user in history_records:
-                local_time = format_local_time(history.created_at)
-                time_str = local_time.strftime("%d/%m %H:%M") if local_time else "N/A"
+            <script>
+                const typeLabels = {auto: '🤖 Automática', absence: '🌙 Ausência', manual: '👤 Manual'};
+                const typeColors = {auto: '#28a745', absence: '#ffc107', manual: '#6c757d'};
+                let nextCursor = null;
+                let loading = false;
+                let finished = false;
+                let filters = {};
+                
+                function cell(text, style) {
+                    const td = document.createElement('td');
+                    td.textContent = text;
+                    if (style) td.setAttribute('style', style);
+                    return td;
+                }
                 
-                type_colors = {
-                    'auto': '#28a745',
-                    'absence': '#ffc107',
-                    'manual': '#6c757d'
+                function formatDate(iso) {
+                    if (!iso) return 'N/A';
+                    const d = iso.slice(8, 10) + '/' + iso.slice(5, 7) + ' ' + iso.slice(11, 16);
+                    return d;
                 }
                 
-                type_labels = {
-                    'auto': '🤖 Automática',
-                    'absence': '🌙 Ausência',
-                    'manual': '👤 Manual'
+                async function loadPage() {
+                    if (loading || finished) return;
+                    loading = true;
+                    const params = new URLSearchParams(filters);
+                    if (nextCursor) params.set('cursor', nextCursor);
+                    const sentinel = document.getElementById('history-sentinel');
+                    try {
+                        const response = await fetch('/api/history?' + params.toString());
+                        const result = await response.json();
+                        if (!result.success) throw new Error(result.error);
+                        const body = document.getElementById('history-body');
+                        for (const item of result.items) {
+                            const tr = document.createElement('tr');
+                            tr.appendChild(cell(formatDate(item.created_at)));
+                            tr.appendChild(cell(item.question.text.slice(0, 40) + '...'));
+                            tr.appendChild(cell(typeLabels[item.response_type] || item.response_type,
+                                'color: ' + (typeColors[item.response_type] || '#6c757d') + '; font-weight: bold;'));
+                            tr.appendChild(cell(item.keywords_matched || '-'));
+                            tr.appendChild(cell(item.response_time ? item.response_time.toFixed(2) + 's' : '-'));
+                            body.appendChild(tr);
+                        }
+                        nextCursor = result.next_cursor;
+                        finished = !nextCursor;
+                        sentinel.textContent = finished ? (body.children.length ? 'Fim do histórico' : 'Nenhuma resposta encontrada') : 'Carregando...';
+                    } catch (error) {
+                        sentinel.textContent = 'Erro ao carregar histórico: ' + error.message;
+                        finished = true;
+                    } finally {
+                        loading = false;
+                    }
                 }
                 
-                type_color = type_colors.get(history.response_type, '#6c757d')
-                type_label = type_labels.get(history.response_type, history.response_type)
+                document.getElementById('history-filters').addEventListener('submit', function(e) {
+                    e.preventDefault();
+                    filters = {};
+                    for (const [key, value] of new FormData(this).entries()) {
+                        if (value) filters[key] = value;
+                    }
+                    document.getElementById('history-body').innerHTML = '';
+                    nextCursor = null;
+                    finished = false;
+                    loadPage();
+                });
                 
-                keywords = history.keywords_matched or "-"
-                response_time = f"{history.response_time:.2f}s" if history.response_time else "-"
+                document.getElementById('search-form').addEventListener('submit', async function(e) {
+                    e.preventDefault();
+                    const container = document.getElementById('search-results');
+                    const q = document.getElementById('search-q').value.trim();
+                    container.innerHTML = '';
+                    if (!q) return;
+                    const params = new URLSearchParams({q: q});
+                    for (const key of ['account', 'item', 'from', 'to']) {
+                        const value = document.getElementById('f-' + key).value;
+                        if (value) params.set(key, value);
+                    }
+                    try {
+                        const response = await fetch('/api/search?' + params.toString());
+                        const result = await response.json();
+                        if (!result.success) throw new Error(result.error);
+                        const summary = document.createElement('p');
+                        summary.textContent = result.results.length + ' resultado(s) em ' + result.elapsed_ms + ' ms';
+                        container.appendChild(summary);
+                        for (const item of result.results) {
+                            // Trechos já chegam escapados pelo servidor, só com <mark>
+                            const div = document.createElement('div');
+                            div.setAttribute('style', 'border-top: 1px solid #eee; padding: 10px 0;');
+                            const meta = document.createElement('small');
+                            meta.textContent = formatDate(item.created_at) + ' • ' + item.item_id + ' • conta ' + item.account;
+                            const question = document.createElement('div');
+                            question.innerHTML = '<strong>P:</strong> ' + item.question_snippet;
+                            div.appendChild(meta);
+                            div.appendChild(question);
+                            if (item.response_snippet) {
+                                const answer = document.createElement('div');
+                                answer.innerHTML = '<strong>R:</strong> ' + item.response_snippet;
+                                div.appendChild(answer);
+                            }
+                            container.appendChild(div);
+                        }
+                    } catch (error) {
+                        container.textContent = 'Erro na busca: ' + error.message;
+                    }
+                });
                 
-                content += f"""
-                <tr>
-                    <td>{time_str}</td>
-                    <td>{question.question_text[:40]}...</td>
-                    <td style="color: {type_color}; font-weight: bold;">{type_label}</td>
-                    <td>{keywords}</td>
-                    <td>{response_time}</td>
-                </tr>
-                """
-            
-            content += """
-                    </tbody>
-                </table>
-            </div>
+                new IntersectionObserver(entries => {
+                    if (entries.some(entry => entry.isIntersecting)) loadPage();
+                }).observe(document.getElementById('history-sentinel'));
+            </script>
             """
             
             return create_base_template("Histórico", content)
@@ -2259,8 +5073,8 @@ def history_page():
 
 @app.route('/debug-full')
 def debug_full():
-    """Página com todos os logs de debug"""
-    all_logs = get_debug_logs()
+    """Página com todos os logs de debug (novos registros chegam pelo stream SSE)"""
+    records = get_debug_records()
     current_time = get_local_time().strftime("%H:%M:%S")
     
     content = create_header("🔍 Debug Completo", f"Logs detalhados do sistema - {current_time}")
@@ -2269,27 +5083,59 @@ def debug_full():
     content += f"""
     <div class="card">
         <h3>📋 Todos os Logs de Debug</h3>
-        <p><strong>Total de logs:</strong> {len(all_logs)}</p>
+        <p><strong>Total de logs:</strong> <span id="log-total">{len(records)}</span>
+           &nbsp; <strong>Stream:</strong> <span id="stream-status">conectando...</span></p>
         <button class="btn btn-warning" onclick="clearLogs()">🗑️ Limpar Logs</button>
-        <button class="btn" onclick="refreshPage()">🔄 Atualizar</button>
         
-        <div style="background: #000; color: #0f0; padding: 15px; border-radius: 4px; font-family: monospace; font-size: 12px; max-height: 600px; overflow-y: auto; margin-top: 20px;">
+        <div id="log-box" style="background: #000; color: #0f0; padding: 15px; border-radius: 4px; font-family: monospace; font-size: 12px; max-height: 600px; overflow-y: auto; margin-top: 20px;">
     """
     
-    for log in all_logs:
-        content += f'<div style="margin-bottom: 2px;">{log}</div>'
+    for record in records:
+        content += f'<div style="margin-bottom: 2px;">{html.escape(record.format())}</div>'
     
-    content += """
+    content += f"""
         </div>
     </div>
     
     <script>
-        function clearLogs() {
-            fetch('/api/debug/clear-logs', {method: 'POST'})
-            .then(() => window.location.reload());
-        }
-        function refreshPage() { window.location.reload(); }
-        setInterval(refreshPage, 15000); // Atualizar a cada 15 segundos
+        const MAX_LINES = {MAX_DEBUG_LOGS};
+        const box = document.getElementById('log-box');
+        const total = document.getElementById('log-total');
+        const status = document.getElementById('stream-status');
+        box.scrollTop = box.scrollHeight;
+
+        function appendLine(text) {{
+            const atBottom = box.scrollTop + box.clientHeight >= box.scrollHeight - 20;
+            const div = document.createElement('div');
+            div.style.marginBottom = '2px';
+            div.textContent = text;
+            box.appendChild(div);
+            while (box.childElementCount > MAX_LINES) box.removeChild(box.firstElementChild);
+            total.textContent = box.childElementCount;
+            if (atBottom) box.scrollTop = box.scrollHeight;
+        }}
+
+        // Reconexões automáticas reenviam Last-Event-ID e retomam de onde pararam
+        const source = new EventSource('/api/debug/stream?since={last_log_seq()}');
+        source.addEventListener('log', (e) => {{
+            const r = JSON.parse(e.data);
+            appendLine('[' + r.time.substr(11, 8) + '] ' + r.message);
+        }});
+        source.addEventListener('reset', () => {{
+            // Servidor reiniciado: o buffer recomeça e será reenviado desde o início
+            box.innerHTML = '';
+            appendLine('🔄 Servidor reiniciado; exibindo o buffer atual');
+        }});
+        source.addEventListener('gap', (e) => {{
+            appendLine('⚠️ ' + JSON.parse(e.data).missed + ' registros saíram do buffer antes de serem enviados');
+        }});
+        source.onopen = () => {{ status.textContent = '🟢 ao vivo'; }};
+        source.onerror = () => {{ status.textContent = '🟡 reconectando...'; }};
+
+        function clearLogs() {{
+            fetch('/api/debug/clear-logs', {{method: 'POST'}})
+            .then(() => {{ box.innerHTML = ''; total.textContent = 0; }});
+        }}
     </script>
     """
     
@@ -2303,10 +5149,81 @@ def api_clear_logs():
 
 @app.route('/api/debug/logs')
 def api_get_logs():
-    """API para obter logs de debug"""
+    """
+    API para obter logs de debug (?limit=N, ?level=WARNING, ?format=json para
+    registros estruturados, ?since=<seq> para receber só os registros novos).
+    Um since maior que o último seq (processo reiniciado) devolve o buffer
+    inteiro com "reset": true.
+    """
     limit = request.args.get('limit', type=int)
-    logs = get_debug_logs(limit)
-    return jsonify({"logs": logs, "total": len(DEBUG_LOGS)})
+    since = request.args.get('since', type=int)
+    min_level = LOG_LEVELS.get((request.args.get('level') or '').upper())
+    reset = is_stale_log_cursor(since)
+    if reset:
+        since = 0
+    last_seq = last_log_seq()
+    records = get_debug_records(limit, min_level, since)
+    if request.args.get('format') == 'json':
+        logs = [r.to_dict() for r in records]
+    elif since is not None:
+        logs = [r.format() for r in records]
+    else:
+        logs = [r.format() for r in records] or ["Nenhum log ainda"]
+    return jsonify({
+        "logs": logs,
+        "total": len(DEBUG_LOGS),
+        "last_seq": max([last_seq] + [r.seq for r in records[-1:]]),
+        "reset": reset,
+        "level": LOG_LEVEL_NAMES[LOG_LEVEL]
+    })
+
+def _sse_log_event(record):
+    return f"id: {record.seq}\nevent: log\ndata: {json.dumps(record.to_dict(), ensure_ascii=False)}\n\n"
+
+@app.route('/api/debug/stream')
+def api_debug_stream():
+    """
+    Stream SSE dos logs. Cada evento leva o seq como id; o cursor inicial vem do
+    header Last-Event-ID (reconexão) ou de ?since=<seq>. Sem cursor, só envia
+    registros novos. Cursor de um processo anterior (seq maior que o último)
+    gera 'event: reset' e o envio recomeça do registro mais antigo do buffer.
+    ?level=WARNING filtra por nível.
+    """
+    cursor = request.headers.get('Last-Event-ID', type=int)
+    if cursor is None:
+        cursor = request.args.get('since', type=int)
+    if cursor is None:
+        cursor = last_log_seq()
+    reset = is_stale_log_cursor(cursor)
+    if reset:
+        cursor = 0
+    min_level = LOG_LEVELS.get((request.args.get('level') or '').upper(), 0)
+    if not log_stream.acquire():
+        return jsonify({"success": False, "error": "Limite de clientes do stream atingido"}), 503
+
+    def generate(last):
+        try:
+            yield "retry: 3000\n\n"
+            if reset:
+                yield f"event: reset\ndata: {json.dumps({'last_seq': last_log_seq()})}\n\n"
+            while True:
+                records = get_debug_records(since=last)
+                if records:
+                    if last and records[0].seq > last + 1:
+                        # Registros descartados pelo buffer circular antes do envio
+                        yield f"event: gap\ndata: {json.dumps({'missed': records[0].seq - last - 1})}\n\n"
+                    last = records[-1].seq
+                    chunk = ''.join(_sse_log_event(r) for r in records if r.level >= min_level)
+                    if chunk:
+                        yield chunk
+                else:
+                    yield ": ping\n\n"
+                log_stream.wait_for_new(last, LOG_STREAM_HEARTBEAT)
+        finally:
+            log_stream.release()
+
+    return Response(generate(cursor), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # ========== PÁGINA DE EDIÇÃO DE REGRAS ==========
 @app.route('/edit-rules')
@@ -2768,9 +5685,10 @@ def api_token_status():
         token_message = "Token válido"
         user_info = None
         
+        credentials = credential_registry.primary()
         try:
-            url = "https://api.mercadolibre.com/users/me"
-            headers = {"Authorization": f"Bearer {ML_ACCESS_TOKEN}"}
+            url = f"{ML_API_BASE_URL}/users/me"
+            headers = {"Authorization": f"Bearer {credentials.access_token}"}
             response = requests.get(url, headers=headers, timeout=10)
             if response.status_code == 200:
                 user_info = response.json()
@@ -2790,8 +5708,8 @@ def api_token_status():
             "token": {
                 "valid": token_valid,
                 "message": token_message,
-                "access_token": ML_ACCESS_TOKEN[:20] + "..." if ML_ACCESS_TOKEN else "N/A",
-                "user_id": ML_USER_ID,
+                "access_token": credentials.access_token[:20] + "..." if credentials.access_token else "N/A",
+                "user_id": credentials.ml_user_id,
                 "user_info": user_info
             },
             "auto_refresh": refresh_status,
@@ -2836,43 +5754,31 @@ def api_force_refresh():
     try:
         add_debug_log("🔄 Renovação forçada via API iniciada...")
         
-        # Verificar se já está renovando
-        if auto_refresh_manager.is_refreshing:
-            return jsonify({
-                "success": False,
-                "error": "Renovação já em andamento"
-            }), 400
-        
-        # Executar renovação
-        success, result = auto_refresh_manager.process_refresh_token_internal()
+        # Mesmo single-flight do agendador e do 401: se já houver renovação, espera por ela
+        key = auto_refresh_manager.schedule_key
+        credentials = credential_registry.get(key)
+        new_token = refresh_account_token(key, credentials.access_token if credentials else None,
+                                          reason='renovação forçada', force=True)
         
-        if success:
-            # Atualizar tokens no sistema
-            auto_refresh_manager.update_system_tokens_internal(
-                result['access_token'],
-                result['refresh_token'],
-                result['user_id']
-            )
-            
-            # Reiniciar auto-renovação com novo token
-            auto_refresh_manager.start_auto_refresh(result.get('expires_in', 21600))
-            
+        if new_token:
             add_debug_log("✅ Renovação forçada concluída com sucesso")
+            credentials = credential_registry.get(key)
+            remaining = token_seconds_remaining(credentials) if credentials else None
             
             return jsonify({
                 "success": True,
                 "message": "Token renovado com sucesso",
                 "token_info": {
-                    "access_token": result['access_token'][:20] + "...",
-                    "user_id": result['user_id'],
-                    "expires_in": result.get('expires_in', 21600)
+                    "access_token": new_token[:20] + "...",
+                    "user_id": key,
+                    "expires_in": int(remaining) if remaining is not None else TOKEN_DEFAULT_EXPIRES_IN
                 }
             })
         else:
-            add_debug_log(f"❌ Falha na renovação forçada: {result.get('error', 'Erro desconhecido')}")
+            add_debug_log("❌ Falha na renovação forçada")
             return jsonify({
                 "success": False,
-                "error": result.get('error', 'Erro na renovação')
+                "error": "Erro na renovação (ver logs de debug)"
             }), 400
             
     except Exception as e:
@@ -2890,7 +5796,7 @@ def api_refresh_info():
             "refresh_interval_hours": auto_refresh_manager.refresh_interval / 3600,
             "has_refresh_token": bool(ML_REFRESH_TOKEN),
             "system_time": get_local_time().isoformat(),
-            "uptime_seconds": time.time() - (auto_refresh_manager.token_created_at or time.time())
+            "uptime_seconds": clock.time() - (auto_refresh_manager.token_created_at or clock.time())
         }
         
         return jsonify({
@@ -2903,6 +5809,457 @@ def api_refresh_info():
         add_debug_log(f"❌ Erro ao obter info de renovação: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+@app.route('/api/tokens/schedule', methods=['GET'])
+def api_token_schedule():
+    """API com a próxima renovação e o último resultado de cada conta"""
+    try:
+        return jsonify({
+            "success": True,
+            "workers": token_scheduler.workers,
+            "accounts": token_scheduler.status()
+        })
+    except Exception as e:
+        add_debug_log(f"❌ Erro ao obter agenda de renovação: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+# ========== RETENÇÃO E ARQUIVAMENTO FRIO ==========
+# Linhas antigas saem do banco vivo em lotes pequenos para arquivos NDJSON
+# comprimidos, particionados por dia: BACKUP_PATH/archive/<tabela>/<AAAA-MM-DD>.ndjson.gz
+# Cada lote é gravado (e sincronizado) no arquivo antes de ser apagado do banco,
+# então uma falha no meio só gera duplicatas no arquivo, nunca perda de dados.
+
+def _env_days(name, default):
+    """Lê número de dias de retenção do ambiente (0 desabilita)"""
+    try:
+        return max(0, int(os.getenv(name, default)))
+    except ValueError:
+        return int(default)
+
+RETENTION_DAYS = {
+    'webhook_logs': _env_days('RETENTION_WEBHOOK_LOGS_DAYS', '30'),
+    'response_history': _env_days('RETENTION_RESPONSE_HISTORY_DAYS', '180'),
+    'question_traces': _env_days('RETENTION_QUESTION_TRACES_DAYS', '30'),
+    'questions': _env_days('RETENTION_QUESTIONS_DAYS', '180'),
+}
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '500'))
+RETENTION_BATCH_PAUSE = 0.05  # segundos entre lotes para liberar o lock de escrita
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL_SECONDS', '3600'))
+
+# Ordem importa: histórico e traces antes das perguntas que eles referenciam
+RETENTION_TABLES = [
+    ('webhook_logs', WebhookLog, WebhookLog.received),
+    ('response_history', ResponseHistory, ResponseHistory.created_at),
+    ('question_traces', QuestionTrace, QuestionTrace.created_at),
+    ('questions', Question, Question.created_at),
+]
+
+_retention_lock = threading.Lock()
+retention_status = {
+    'running': False,
+    'last_run_at': None,
+    'last_duration': None,
+    'last_result': {},
+    'last_error': None
+}
+
+def _retention_filter(table_name, model, date_column, cutoff):
+    """Condição de linhas frias elegíveis para arquivamento"""
+    conditions = [date_column < cutoff]
+    if table_name == 'questions':
+        # Perguntas pendentes ou ainda referenciadas pelo histórico ficam no banco
+        conditions.append(Question.is_answered == True)
+        conditions.append(~db.exists().where(ResponseHistory.question_id == Question.id))
+    return conditions
+
+def _serialize_row(row, columns):
+    """Converte linha em dict serializável (datas em ISO 8601)"""
+    data = {}
+    for column in columns:
+        value = getattr(row, column.name)
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        data[column.name] = value
+    return data
+
+def _deserialize_row(data, columns):
+    """Converte dict do arquivo de volta para valores do banco"""
+    row = {}
+    for column in columns:
+        if column.name not in data:
+            continue
+        value = data[column.name]
+        if value is not None and isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(value)
+        row[column.name] = value
+    return row
+
+def _archive_file(table_name, day):
+    """Caminho da partição diária de uma tabela"""
+    directory = os.path.join(ARCHIVE_PATH, table_name)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{day.isoformat()}.ndjson.gz")
+
+def _write_archive_batch(table_name, rows, columns, date_column_name):
+    """Acrescenta um lote às partições diárias (um membro gzip por lote)"""
+    partitions = {}
+    for row in rows:
+        day = (getattr(row, date_column_name) or get_local_time_utc()).date()
+        partitions.setdefault(day, []).append(_serialize_row(row, columns))
+
+    for day, records in partitions.items():
+        path = _archive_file(table_name, day)
+        with open(path, 'ab') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='ab') as gz:
+                for record in records:
+                    gz.write(json.dumps(record, ensure_ascii=False, default=str).encode('utf-8'))
+                    gz.write(b'\n')
+            raw.flush()
+            os.fsync(raw.fileno())
+
+def archive_table(table_name, model, date_column, days, batch_size=None, max_batches=None):
+    """
+    Arquiva e remove linhas mais antigas que `days` dias, em lotes curtos.
+    Retorna: número de linhas arquivadas
+    """
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    cutoff = get_local_time_utc() - timedelta(days=days)
+    columns = list(model.__table__.columns)
+    conditions = _retention_filter(table_name, model, date_column, cutoff)
+    archived = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        with app.app_context():
+            rows = model.query.filter(*conditions).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            _write_archive_batch(table_name, rows, columns, date_column.key)
+            ids = [row.id for row in rows]
+            db.session.execute(model.__table__.delete().where(model.__table__.c.id.in_(ids)))
+            db.session.commit()
+        archived += len(ids)
+        batches += 1
+        if len(ids) < batch_size:
+            break
+        clock.sleep(RETENTION_BATCH_PAUSE)
+
+    if archived:
+        add_debug_log(f"🗄️ Retenção: {archived} linhas de {table_name} arquivadas")
+    return archived
+
+def run_retention(max_batches=None):
+    """Executa uma passada de retenção em todas as tabelas configuradas"""
+    if not _retention_lock.acquire(blocking=False):
+        add_debug_log("⚠️ Retenção já em andamento, ignorando")
+        return None
+
+    started = time.time()
+    result = {}
+    retention_status['running'] = True
+    try:
+        for table_name, model, date_column in RETENTION_TABLES:
+            days = RETENTION_DAYS.get(table_name, 0)
+            if not days:
+                continue
+            result[table_name] = archive_table(table_name, model, date_column, days, max_batches=max_batches)
+        retention_status['last_error'] = None
+    except Exception as e:
+        retention_status['last_error'] = str(e)
+        add_debug_log(f"❌ Erro na retenção: {e}")
+    finally:
+        retention_status['running'] = False
+        retention_status['last_run_at'] = get_local_time().isoformat()
+        retention_status['last_duration'] = round(time.time() - started, 3)
+        retention_status['last_result'] = result
+        _retention_lock.release()
+    return result
+
+def restore_archived_rows(table_name, start_day, end_day):
+    """
+    Restaura linhas arquivadas de um intervalo de dias (inclusive).
+    Linhas cujo id já existe no banco são ignoradas, então é seguro repetir.
+    Retorna: número de linhas restauradas
+    """
+    models = {name: model for name, model, _ in RETENTION_TABLES}
+    if table_name not in models:
+        raise ValueError(f"Tabela sem arquivamento: {table_name}")
+    table = models[table_name].__table__
+    columns = list(table.columns)
+    directory = os.path.join(ARCHIVE_PATH, table_name)
+    if not os.path.isdir(directory):
+        return 0
+
+    restored = 0
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.ndjson.gz'):
+            continue
+        try:
+            day = datetime.strptime(filename[:10], '%Y-%m-%d').date()
+        except ValueError:
+            continue
+        if day < start_day or day > end_day:
+            continue
+
+        with gzip.open(os.path.join(directory, filename), 'rt', encoding='utf-8') as fh:
+            batch = {}
+            for line in fh:
+                if line.strip():
+                    record = _deserialize_row(json.loads(line), columns)
+                    batch[record['id']] = record
+                if len(batch) >= RETENTION_BATCH_SIZE:
+                    restored += _insert_missing_rows(table, batch)
+                    batch = {}
+            if batch:
+                restored += _insert_missing_rows(table, batch)
+
+    add_debug_log(f"♻️ {restored} linhas restauradas em {table_name} ({start_day} a {end_day})")
+    return restored
+
+def _insert_missing_rows(table, records_by_id):
+    """Insere (via Core, sem reprocessar o rollup) apenas ids ausentes"""
+    with db.engine.begin() as conn:
+        existing = {row[0] for row in conn.execute(
+            db.select(table.c.id).where(table.c.id.in_(list(records_by_id)))
+        )}
+        missing = [r for rid, r in records_by_id.items() if rid not in existing]
+        if missing:
+            conn.execute(table.insert(), missing)
+    return len(missing)
+
+def retention_worker():
+    """Ciclo de retenção em background, a cada RETENTION_INTERVAL"""
+    if _initialized:
+        run_retention()
+
+@app.route('/api/retention/status', methods=['GET'])
+def api_retention_status():
+    """API para consultar configuração e última execução da retenção"""
+    return jsonify({
+        "success": True,
+        "retention_days": RETENTION_DAYS,
+        "batch_size": RETENTION_BATCH_SIZE,
+        "archive_path": ARCHIVE_PATH,
+        "status": retention_status
+    })
+
+@app.route('/api/retention/run', methods=['POST'])
+def api_retention_run():
+    """API para disparar uma passada de retenção em background"""
+    if retention_status['running']:
+        return jsonify({"success": False, "error": "Retenção já em andamento"}), 400
+    threading.Thread(target=run_retention, name='retention', daemon=True).start()
+    return jsonify({"success": True, "message": "Retenção iniciada"}), 202
+
+@app.route('/api/retention/restore', methods=['POST'])
+def api_retention_restore():
+    """API para restaurar linhas arquivadas: {"table", "start": "AAAA-MM-DD", "end": "AAAA-MM-DD"}"""
+    try:
+        data = request.get_json() or {}
+        start_day = datetime.strptime(data['start'], '%Y-%m-%d').date()
+        end_day = datetime.strptime(data.get('end') or data['start'], '%Y-%m-%d').date()
+        restored = restore_archived_rows(data['table'], start_day, end_day)
+        return jsonify({"success": True, "restored": restored})
+    except (KeyError, ValueError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        add_debug_log(f"❌ Erro ao restaurar arquivo: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+# ========== BACKUP ONLINE DO SQLITE ==========
+# Usa a API de backup online do SQLite copiando poucas páginas por passo,
+# liberando o banco entre os passos para que escritores nunca esperem muito.
+
+BACKUP_INTERVAL = int(os.getenv('BACKUP_INTERVAL_SECONDS', str(6 * 3600)))
+BACKUP_KEEP = max(1, int(os.getenv('BACKUP_KEEP', '7')))
+BACKUP_COMPRESS = os.getenv('BACKUP_COMPRESS', '1') != '0'
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '256'))
+BACKUP_STEP_SLEEP = 0.01  # segundos de pausa entre passos (e antes de repetir um passo BUSY/LOCKED)
+BACKUP_PREFIX = 'bot_ml-'
+BACKUP_REQUIRED_TABLES = ('users', 'questions', 'response_history', 'schema_migrations')
+
+_backup_lock = threading.Lock()
+backup_status = {
+    'running': False,
+    'last_backup_at': None,
+    'last_duration': None,
+    'last_file': None,
+    'last_size': None,
+    'last_error': None
+}
+
+def _online_copy(source_path, target_path, pages=None):
+    """Copia um banco SQLite para outro arquivo com a API de backup incremental"""
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    def pause(status, remaining, total):
+        # backup() só dorme sozinho após BUSY/LOCKED; a pausa entre passos fica aqui
+        if remaining:
+            time.sleep(BACKUP_STEP_SLEEP)
+
+    try:
+        source.backup(target, pages=pages or BACKUP_PAGES_PER_STEP, progress=pause, sleep=BACKUP_STEP_SLEEP)
+    finally:
+        target.close()
+        source.close()
+
+def list_backups():
+    """Snapshots existentes, do mais recente para o mais antigo"""
+    files = [f for f in os.listdir(SNAPSHOT_PATH) if f.startswith(BACKUP_PREFIX)]
+    return sorted(files, reverse=True)
+
+def _rotate_backups():
+    """Mantém apenas os BACKUP_KEEP snapshots mais recentes"""
+    for filename in list_backups()[BACKUP_KEEP:]:
+        try:
+            os.remove(os.path.join(SNAPSHOT_PATH, filename))
+            add_debug_log(f"🗑️ Backup antigo removido: {filename}")
+        except OSError as e:
+            add_debug_log(f"⚠️ Erro ao remover backup {filename}: {e}")
+
+def run_backup():
+    """
+    Gera um snapshot consistente do banco em BACKUP_PATH/snapshots.
+    Retorna: caminho do snapshot ou None se falhou/já em andamento
+    """
+    if not IS_SQLITE:
+        add_debug_log("⚠️ Backup online só se aplica ao SQLite (use pg_dump no PostgreSQL)")
+        return None
+    if not _backup_lock.acquire(blocking=False):
+        add_debug_log("⚠️ Backup já em andamento, ignorando")
+        return None
+
+    started = time.time()
+    backup_status['running'] = True
+    stamp = get_local_time().strftime('%Y%m%d-%H%M%S')
+    tmp_path = os.path.join(SNAPSHOT_PATH, f".{BACKUP_PREFIX}{stamp}.tmp")
+    final_path = os.path.join(SNAPSHOT_PATH, f"{BACKUP_PREFIX}{stamp}.db")
+    try:
+        _online_copy(DATABASE_PATH, tmp_path)
+
+        if BACKUP_COMPRESS:
+            final_path += '.gz'
+            with open(tmp_path, 'rb') as src, gzip.open(final_path, 'wb', compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, final_path)
+
+        backup_status.update({
+            'last_backup_at': get_local_time().isoformat(),
+            'last_duration': round(time.time() - started, 3),
+            'last_file': os.path.basename(final_path),
+            'last_size': os.path.getsize(final_path),
+            'last_error': None
+        })
+        add_debug_log(f"💾 Backup concluído: {os.path.basename(final_path)} ({backup_status['last_duration']}s)")
+        _rotate_backups()
+        return final_path
+
+    except Exception as e:
+        backup_status['last_error'] = str(e)
+        add_debug_log(f"❌ Erro no backup: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    finally:
+        backup_status['running'] = False
+        _backup_lock.release()
+
+def validate_snapshot(path):
+    """
+    Valida um snapshot (integrity_check + tabelas obrigatórias).
+    Retorna: (ok: bool, mensagem)
+    """
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchone()
+            if not result or result[0] != 'ok':
+                return False, f"integrity_check falhou: {result}"
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            missing = [t for t in BACKUP_REQUIRED_TABLES if t not in tables]
+            if missing:
+                return False, f"Tabelas ausentes: {', '.join(missing)}"
+            return True, "Snapshot válido"
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        return False, f"Arquivo inválido: {e}"
+
+def restore_backup(filename):
+    """
+    Restaura um snapshot sobre o banco vivo após validá-lo.
+    A cópia é feita pela API de backup (não troca o arquivo por baixo das conexões abertas).
+    Retorna: (success: bool, mensagem)
+    """
+    if not IS_SQLITE:
+        return False, "Restauração de snapshot só se aplica ao SQLite"
+    path = os.path.join(SNAPSHOT_PATH, os.path.basename(filename))
+    if not os.path.exists(path):
+        return False, f"Snapshot não encontrado: {filename}"
+
+    tmp_path = None
+    try:
+        if path.endswith('.gz'):
+            tmp_path = os.path.join(SNAPSHOT_PATH, f".restore-{int(time.time())}.tmp")
+            with gzip.open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            source_path = tmp_path
+        else:
+            source_path = path
+
+        ok, message = validate_snapshot(source_path)
+        if not ok:
+            add_debug_log(f"❌ Snapshot rejeitado: {message}")
+            return False, message
+
+        with _db_lock:
+            # Fecha conexões do pool para que nenhuma transação fique aberta durante a cópia
+            with app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+            _online_copy(source_path, DATABASE_PATH, pages=-1)
+
+        add_debug_log(f"♻️ Banco restaurado a partir de {os.path.basename(path)}")
+        return True, "Backup restaurado com sucesso"
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def backup_worker():
+    """Ciclo de backups agendados, a cada BACKUP_INTERVAL"""
+    if _initialized:
+        run_backup()
+
+@app.route('/api/backup/status', methods=['GET'])
+def api_backup_status():
+    """API para consultar último backup e snapshots disponíveis"""
+    return jsonify({
+        "success": True,
+        "status": backup_status,
+        "interval_seconds": BACKUP_INTERVAL,
+        "keep": BACKUP_KEEP,
+        "compress": BACKUP_COMPRESS,
+        "snapshots": list_backups()
+    })
+
+@app.route('/api/backup/run', methods=['POST'])
+def api_backup_run():
+    """API para disparar um backup imediato em background"""
+    if backup_status['running']:
+        return jsonify({"success": False, "error": "Backup já em andamento"}), 400
+    threading.Thread(target=run_backup, name='backup', daemon=True).start()
+    return jsonify({"success": True, "message": "Backup iniciado"}), 202
+
+@app.cli.command('restore-backup')
+@click.argument('filename')
+def restore_backup_command(filename):
+    """Valida e restaura um snapshot (flask --app main restore-backup <arquivo>)"""
+    success, message = restore_backup(filename)
+    print(("✅ " if success else "❌ ") + message)
+
 
 # ========== INICIALIZAÇÃO E MONITORAMENTO DO SISTEMA ==========
 
@@ -2917,21 +6274,33 @@ def start_background_tasks():
         # Criar dados padrão se necessário
         create_default_data()
         
-        # Inicializar sistema de renovação automática
-        if ML_REFRESH_TOKEN:
-            initialize_auto_refresh()
+        # Reagendar renovação de todas as contas a partir da expiração salva
+        if initialize_auto_refresh():
             add_debug_log("🔄 Sistema de renovação automática inicializado")
         else:
-            add_debug_log("⚠️ Refresh token não disponível - renovação automática não iniciada")
+            add_debug_log("⚠️ Nenhuma conta com refresh token - renovação automática não iniciada")
         
-        # Iniciar monitoramento de perguntas em thread separada
-        monitor_thread = threading.Thread(target=monitor_questions, daemon=True)
-        monitor_thread.start()
+        # Percentis de SLA a partir do histórico recente (janela móvel; horas fechadas vêm do banco)
+        warmed = sla_stats.warm_up()
+        add_debug_log(f"⏱️ Percentis de SLA aquecidos com {warmed} respostas dos últimos {SLA_WINDOW_DAYS} dias")
+        
+        # Tarefas periódicas: threads no relógio real, eventos no simulado
+        # Monitoramento de perguntas (primeiro ciclo imediato)
+        run_periodically('monitor', MONITOR_INTERVAL, monitor_questions, initial_delay=0)
         add_debug_log("✅ Thread de monitoramento iniciada")
         
+        # Retenção/arquivamento de linhas frias
+        run_periodically('retention', RETENTION_INTERVAL, retention_worker)
+        add_debug_log("✅ Thread de retenção iniciada")
+        
+        # Backups agendados (SQLite)
+        if IS_SQLITE:
+            run_periodically('backup', BACKUP_INTERVAL, backup_worker)
+            add_debug_log(f"✅ Backups agendados a cada {BACKUP_INTERVAL // 3600}h (mantendo {BACKUP_KEEP})")
+        
         add_debug_log("✅ Sistema Bot ML iniciado com sucesso!")
         add_debug_log("🔍 Debug ativo - todos os logs serão registrados")
-        add_debug_log("🤖 Monitoramento de perguntas ativo (30s)")
+        add_debug_log(f"🤖 Monitoramento de perguntas ativo ({MONITOR_INTERVAL}s)")
         add_debug_log("🌙 Sistema de ausência configurado")
         add_debug_log("🔄 Renovação manual de tokens disponível")
         add_debug_log("🔄 Renovação automática de tokens ativa (5h)")
@@ -2949,15 +6318,18 @@ def status():
         # Verificar banco de dados
         with app.app_context():
             user_count = User.query.count()
-            question_count = Question.query.count()
             rule_count = AutoResponse.query.filter_by(is_active=True).count()
             absence_count = AbsenceConfig.query.filter_by(is_active=True).count()
+            stats_all = get_daily_stats_summary()
+            stats_today = get_daily_stats_summary(since_day=get_local_time().date())
+            question_count = stats_all.get(DAILY_STATS_RECEIVED, {}).get('count', 0)
         
         # Verificar token
         token_valid = True
+        credentials = credential_registry.primary()
         try:
-            url = "https://api.mercadolibre.com/users/me"
-            headers = {"Authorization": f"Bearer {ML_ACCESS_TOKEN}"}
+            url = f"{ML_API_BASE_URL}/users/me"
+            headers = {"Authorization": f"Bearer {credentials.access_token}"}
             response = requests.get(url, headers=headers, timeout=5)
             token_valid = response.status_code == 200
         except:
@@ -2972,9 +6344,16 @@ def status():
                 "active_rules": rule_count,
                 "active_absence_configs": absence_count
             },
+            "responses": {
+                "total": summarize_answers(stats_all),
+                "today": summarize_answers(stats_today),
+                "by_type": {t: stats_all.get(t, {}).get('count', 0) for t in ANSWER_RESPONSE_TYPES}
+            },
+            "sla_seconds": sla_stats.snapshot(),
             "token": {
                 "valid": token_valid,
-                "user_id": ML_USER_ID
+                "user_id": credentials.ml_user_id,
+                "accounts": len(credential_registry.all())
             },
             "system": {
                 "data_dir": DATA_DIR,
@@ -2992,6 +6371,189 @@ def status():
             "timestamp": get_local_time().isoformat()
         }), 500
 
+# ========== ROTA DE MÉTRICAS ==========
+def _process_rss_bytes():
+    """Memória residente do processo (Linux: /proc/self/statm)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _token_expiry_samples():
+    now = time.time()
+    return [
+        ((c.ml_user_id,), c.expires_at.replace(tzinfo=timezone.utc).timestamp() - now)
+        for c in credential_registry.snapshots() if c.expires_at
+    ]
+
+def _thread_samples():
+    counts = {}
+    for thread in threading.enumerate():
+        # Agrupa por prefixo do nome (ex.: webhook-123 -> webhook)
+        group = re.sub(r'[-_]?\d+$', '', thread.name.split(' ')[0]) or 'unnamed'
+        counts[group] = counts.get(group, 0) + 1
+    return [((name,), count) for name, count in counts.items()]
+
+Gauge('botml_db_writer_queue_depth', 'Mutações aguardando a fila de escrita',
+      collect=lambda: [((), db_writer.depth())])
+Gauge('botml_token_refresh_queue_depth', 'Contas no agendador de renovação de tokens',
+      collect=lambda: [((), token_scheduler.depth())])
+Gauge('botml_token_seconds_to_expiry', 'Segundos até a expiração do access token', ('account',),
+      collect=_token_expiry_samples)
+Gauge('botml_threads', 'Threads do processo por grupo', ('group',), collect=_thread_samples)
+Gauge('botml_process_resident_memory_bytes', 'Memória residente do processo',
+      collect=lambda: [((), _process_rss_bytes())])
+
+@app.route('/metrics')
+def metrics():
+    """Métricas no formato de texto do Prometheus"""
+    return app.response_class(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ========== PROFILER POR AMOSTRAGEM ==========
+# Amostra as pilhas de todas as threads via sys._current_frames() e agrega em
+# "collapsed stacks" (formato do flamegraph.pl / speedscope). Uma execução por
+# vez, duração limitada e número máximo de pilhas distintas: memória constante.
+PROFILER_MAX_SECONDS = int(os.getenv('PROFILER_MAX_SECONDS', '60'))
+PROFILER_MAX_HZ = 250
+PROFILER_MAX_STACKS = int(os.getenv('PROFILER_MAX_STACKS', '5000'))
+PROFILER_MAX_DEPTH = 64
+_COLLAPSED_UNSAFE = re.compile(r'[;\r\n\t]')
+
+class SamplingProfiler:
+    """Profiler de parede (wall-clock): threads bloqueadas também aparecem"""
+
+    def __init__(self, max_stacks=PROFILER_MAX_STACKS, max_depth=PROFILER_MAX_DEPTH):
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.last_run = None
+        self._labels = {}  # code object -> rótulo do frame
+
+    def _frame_label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            if len(self._labels) < 50000:
+                self._labels[code] = label
+        return label
+
+    def _stack(self, frame):
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._frame_label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return labels
+
+    def run(self, seconds, hz=100, thread_prefixes=None):
+        """
+        Amostra por `seconds` segundos a `hz` amostras/s.
+        Retorna dict com as pilhas agregadas ou None se já houver uma execução.
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            own_ident = threading.get_ident()
+            interval = 1.0 / hz
+            stacks = {}
+            thread_samples = {}
+            dropped = 0
+            samples = 0
+            sampling_time = 0.0
+            started = time.perf_counter()
+            deadline = started + seconds
+            while True:
+                tick = time.perf_counter()
+                if tick >= deadline:
+                    break
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    name = names.get(ident, f'thread-{ident}')
+                    if thread_prefixes and not name.startswith(thread_prefixes):
+                        continue
+                    key = (name, *self._stack(frame))
+                    if key in stacks:
+                        stacks[key] += 1
+                    elif len(stacks) < self.max_stacks:
+                        stacks[key] = 1
+                    else:
+                        dropped += 1
+                        overflow = (name, '[pilhas descartadas]')
+                        stacks[overflow] = stacks.get(overflow, 0) + 1
+                    thread_samples[name] = thread_samples.get(name, 0) + 1
+                samples += 1
+                now = time.perf_counter()
+                sampling_time += now - tick
+                time.sleep(max(0.0, interval - (now - tick)))
+            elapsed = time.perf_counter() - started
+            result = {
+                "seconds": round(elapsed, 3),
+                "hz": hz,
+                "samples": samples,
+                "distinct_stacks": len(stacks),
+                "dropped_samples": dropped,
+                "overhead_pct": round(sampling_time / elapsed * 100, 2) if elapsed else 0,
+                "threads": thread_samples,
+                "stacks": stacks,
+                "finished_at": get_local_time().isoformat()
+            }
+            self.last_run = {k: v for k, v in result.items() if k != 'stacks'}
+            return result
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def collapsed(stacks):
+        """Uma linha por pilha: thread;frame;...;frame contagem"""
+        # Nome de thread com ';' ou quebra de linha partiria a pilha
+        lines = [f"{';'.join((_COLLAPSED_UNSAFE.sub('_', key[0]),) + key[1:])} {count}" for key, count in stacks.items()]
+        lines.sort()
+        return '\n'.join(lines) + '\n'
+
+sampling_profiler = SamplingProfiler()
+
+@app.route('/api/debug/profile', methods=['POST'])
+def api_debug_profile():
+    """
+    Executa o profiler e responde ao final (a requisição fica aberta pelo tempo pedido).
+    ?seconds=10&hz=100&threads=monitor,webhook&format=collapsed|json
+    """
+    try:
+        seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILER_MAX_SECONDS)
+        hz = min(max(request.args.get('hz', 100, type=int), 1), PROFILER_MAX_HZ)
+        threads = tuple(p.strip() for p in (request.args.get('threads') or '').split(',') if p.strip())
+        add_debug_log(f"🔬 Profiler iniciado: {seconds}s a {hz}Hz")
+        result = sampling_profiler.run(seconds, hz, threads or None)
+        if result is None:
+            return jsonify({"success": False, "error": "Já existe um profiling em andamento"}), 409
+        add_debug_log(f"🔬 Profiler concluído: {result['samples']} amostras, {result['distinct_stacks']} pilhas, "
+                      f"overhead {result['overhead_pct']}%")
+        if request.args.get('format') == 'json':
+            top = sorted(result['stacks'].items(), key=lambda item: item[1], reverse=True)[:50]
+            result['stacks'] = [{"thread": key[0], "stack": list(key[1:]), "count": count} for key, count in top]
+            return jsonify({"success": True, "profile": result})
+        filename = f"profile-{get_local_time().strftime('%Y%m%d-%H%M%S')}.folded"
+        return app.response_class(
+            SamplingProfiler.collapsed(result['stacks']),
+            content_type='text/plain; charset=utf-8',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+    except Exception as e:
+        add_debug_log(f"❌ Erro no profiler: {e}")
+        return jsonify({"success": False, "error": str(e)}), 500
+
+@app.route('/api/debug/profile/status')
+def api_debug_profile_status():
+    """API de status do profiler (em execução e resumo da última execução)"""
+    return jsonify({
+        "running": sampling_profiler.lock.locked(),
+        "last_run": sampling_profiler.last_run
+    })
+
 # ========== ROTA DE SAÚDE PARA RENDER ==========
 @app.route('/health')
 def health():
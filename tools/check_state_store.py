@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+VERIFICAÇÃO DO ESTADO COMPARTILHADO
+Exercita o contrato de SQLStateStore/RedisStateStore usado por reivindicação
+de perguntas, deduplicação OAuth e avisos de cache: add com TTL, add_many
+reentrante para o mesmo dono (renova o TTL), compare-and-set (script Lua no
+Redis) e disputa entre threads com donos diferentes.
+
+Uso:
+    python tools/check_state_store.py                  # SQL; Redis também se REDIS_URL existir
+    REDIS_URL=redis://localhost:6379/0 python tools/check_state_store.py --backend redis
+
+O backend SQL usa um DATA_DIR temporário (se não houver um definido). No
+Redis as chaves ficam sob o prefixo 'botml-check:<id>:' e são apagadas no fim.
+Sai com código 1 se alguma verificação falhar.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+TTL = 1.0  # segundos; as verificações de expiração esperam um pouco mais
+
+
+class Checker:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.run_id = uuid.uuid4().hex[:8]
+        self.keys = set()
+        self.failures = 0
+
+    def key(self, name):
+        key = f"check:{self.run_id}:{name}"
+        self.keys.add(key)
+        return key
+
+    def expect(self, label, condition):
+        print(f"  {'✅' if condition else '❌'} {label}")
+        if not condition:
+            self.failures += 1
+
+    def check_add(self):
+        k = self.key('add')
+        self.expect("add cria chave ausente", self.store.add(k, 'a', ttl=TTL) is True)
+        self.expect("add recusa chave viva (mesmo valor)", self.store.add(k, 'a', ttl=TTL) is False)
+        self.expect("add recusa chave viva (outro valor)", self.store.add(k, 'b', ttl=TTL) is False)
+        self.expect("get devolve o valor", self.store.get(k) == 'a')
+        time.sleep(TTL + 0.3)
+        self.expect("get ignora chave expirada", self.store.get(k) is None)
+        self.expect("add reaproveita chave expirada", self.store.add(k, 'b', ttl=TTL) is True)
+
+    def check_add_many(self):
+        keys = [self.key(f"many:{i}") for i in range(5)]
+        self.expect("add_many obtém chaves ausentes", self.store.add_many(keys[:3], 'n1', ttl=TTL) == set(keys[:3]))
+        self.expect("add_many é reentrante para o mesmo dono",
+                    self.store.add_many(keys, 'n1', ttl=TTL) == set(keys))
+        self.expect("add_many recusa chaves de outro dono", self.store.add_many(keys, 'n2', ttl=TTL) == set())
+        # Renovação: após 0.6 TTL renova; depois de passar do TTL original a chave continua do n1
+        time.sleep(TTL * 0.6)
+        self.store.add_many(keys[:1], 'n1', ttl=TTL)
+        time.sleep(TTL * 0.6)
+        acquired = self.store.add_many(keys, 'n2', ttl=TTL)
+        self.expect("reentrada renova o TTL", keys[0] not in acquired and set(keys[1:]) <= acquired)
+        self.expect("chave renovada mantém o dono", self.store.get(keys[0]) == 'n1')
+
+    def check_compare_and_set(self):
+        k = self.key('cas')
+        self.expect("CAS com expected=None cria", self.store.compare_and_set(k, None, 'v1', ttl=TTL) is True)
+        self.expect("CAS com expected=None recusa chave viva", self.store.compare_and_set(k, None, 'x') is False)
+        self.expect("CAS recusa valor divergente", self.store.compare_and_set(k, 'outro', 'x') is False)
+        self.expect("CAS troca valor esperado", self.store.compare_and_set(k, 'v1', 'v2', ttl=TTL) is True)
+        self.expect("valor trocado", self.store.get(k) == 'v2')
+        self.expect("CAS sem TTL troca", self.store.compare_and_set(k, 'v2', 'v3') is True)
+        time.sleep(TTL + 0.3)
+        self.expect("CAS sem TTL deixa a chave permanente", self.store.get(k) == 'v3')
+        k2 = self.key('cas-expired')
+        self.store.add(k2, 'old', ttl=TTL)
+        time.sleep(TTL + 0.3)
+        self.expect("CAS não troca chave expirada", self.store.compare_and_set(k2, 'old', 'new') is False)
+
+    def check_contention(self, threads=8, rounds=20):
+        keys = [self.key(f"race:{i}") for i in range(rounds)]
+        owners = {}
+        lock = threading.Lock()
+        barrier = threading.Barrier(threads)
+
+        def worker(owner):
+            barrier.wait()
+            for key in keys:
+                if self.store.add_many([key], owner, ttl=30):
+                    with lock:
+                        owners.setdefault(key, []).append(owner)
+
+        pool = [threading.Thread(target=worker, args=(f"node-{i}",)) for i in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+        self.expect(f"{threads} threads disputando {rounds} chaves: um dono por chave",
+                    len(owners) == rounds and all(len(v) == 1 for v in owners.values()))
+        self.expect("dono gravado é o que obteve a chave",
+                    all(self.store.get(key) == v[0] for key, v in owners.items()))
+
+    def check_delete(self):
+        k = self.key('delete')
+        self.store.set(k, 'x')
+        self.store.delete(k)
+        self.expect("delete remove a chave", self.store.get(k) is None)
+
+    def run(self):
+        print(f"🔎 {self.name}")
+        try:
+            self.check_add()
+            self.check_add_many()
+            self.check_compare_and_set()
+            self.check_contention()
+            self.check_delete()
+        finally:
+            for key in self.keys:
+                try:
+                    self.store.delete(key)
+                except Exception:
+                    pass
+        return self.failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verifica o contrato do estado compartilhado")
+    parser.add_argument('--backend', choices=('sql', 'redis', 'all'), default='all',
+                        help="'all' testa SQL e, se REDIS_URL existir, Redis")
+    args = parser.parse_args()
+
+    redis_url = os.getenv('REDIS_URL')
+    if args.backend == 'redis' and not redis_url:
+        print("❌ --backend redis exige REDIS_URL")
+        return 2
+    if not os.getenv('DATA_DIR') and not os.getenv('DATABASE_URL'):
+        os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix='botml-state-check-')
+
+    import main as bot
+    failures = 0
+    if args.backend in ('sql', 'all'):
+        bot.initialize_database()
+        failures += Checker(bot.SQLStateStore(), f"SQLStateStore ({bot.DATABASE_URL.split('://')[0]})").run()
+    if args.backend in ('redis', 'all'):
+        if not redis_url:
+            print("ℹ️ REDIS_URL não definida; Redis não verificado")
+        elif bot.redis is None:
+            print("❌ REDIS_URL definida mas o pacote redis não está instalado")
+            failures += 1
+        else:
+            store = bot.RedisStateStore(redis_url, prefix=f"botml-check:{uuid.uuid4().hex[:8]}:")
+            failures += Checker(store, "RedisStateStore").run()
+
+    print(f"{'✅ Tudo certo' if not failures else f'❌ {failures} verificação(ões) falharam'}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SERVIDOR FALSO DA API DO MERCADO LIVRE (TESTES DE CARGA E DE FALHAS)
+Implementa só o que o bot usa, em memória e sem dependências externas:
+
+    GET  /questions/{id}
+    GET  /my/received_questions/search?status=UNANSWERED&limit=50
+    POST /answers                      {"question_id": 123, "text": "..."}
+    POST /oauth/token                  grant_type=refresh_token | authorization_code
+    GET  /users/me
+
+Administração (fora da API real):
+
+    GET  /_admin/stats                 contagem por rota e status
+    GET  /_admin/questions?ids=1,2     instantes (epoch) de criação e resposta das perguntas
+    POST /_admin/config                altera latência/falhas em tempo real (mesmas chaves da CLI)
+    POST /_admin/questions             cria pergunta {"user_id", "text", "item_id"} (e avisa o webhook)
+    POST /_admin/expire-tokens         expira todos os access tokens emitidos
+
+Uso:
+    python tools/fake_ml_server.py --port 8081 --question-rate 2 --latency lognormal:40,0.5 \\
+        --error-rate 0.02 --rate-limit-rate 0.01 --token-ttl 600
+    ML_API_BASE_URL=http://localhost:8081 python main.py
+
+Distribuições de latência (milissegundos): fixed:20, uniform:10,80, normal:40,10,
+lognormal:40,0.5 (mediana, sigma), pareto:20,1.5 (mínimo, alfa).
+Use --latency-for /answers=lognormal:120,0.8 para sobrescrever por rota.
+"""
+
+import argparse
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+ML_TZ = timezone(timedelta(hours=-4))  # a API devolve datas em -04:00
+QUESTION_TEXTS = [
+    "Qual o prazo de entrega para o meu CEP?",
+    "Tem garantia?",
+    "Aceita pagamento via pix?",
+    "Emite nota fiscal?",
+    "Qual o valor do frete?",
+    "Tem disponível em estoque?",
+    "Serve no modelo 2019?",
+    "Qual a voltagem?",
+]
+ROUTES = {
+    ('GET', re.compile(r'^/questions/(\d+)$')): 'question',
+    ('GET', re.compile(r'^/my/received_questions/search$')): 'search',
+    ('POST', re.compile(r'^/answers$')): 'answer',
+    ('POST', re.compile(r'^/oauth/token$')): 'token',
+    ('GET', re.compile(r'^/users/me$')): 'users_me',
+}
+
+
+def parse_latency(spec):
+    """'lognormal:40,0.5' -> função que sorteia a latência em segundos"""
+    name, _, raw = spec.partition(':')
+    args = [float(x) for x in raw.split(',') if x] if raw else []
+    if name == 'fixed':
+        return lambda rng: args[0] / 1000
+    if name == 'uniform':
+        return lambda rng: rng.uniform(args[0], args[1]) / 1000
+    if name == 'normal':
+        return lambda rng: max(0.0, rng.gauss(args[0], args[1])) / 1000
+    if name == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(args[0]), args[1]) / 1000
+    if name == 'pareto':
+        return lambda rng: args[0] * rng.paretovariate(args[1]) / 1000
+    if name in ('none', '0'):
+        return lambda rng: 0.0
+    raise ValueError(f"Distribuição de latência desconhecida: {spec}")
+
+
+class FakeMercadoLivre:
+    """Estado em memória: contas, tokens, perguntas e configuração de falhas"""
+
+    def __init__(self, args):
+        self.lock = threading.Lock()
+        self.rng = random.Random(args.seed)
+        self.user_ids = [u.strip() for u in args.users.split(',') if u.strip()]
+        self.token_ttl = args.token_ttl
+        self.accept_unknown_tokens = not args.strict_tokens
+        self.webhook_url = args.webhook_url
+        self.max_pending = args.max_pending
+        self.question_rate = args.question_rate
+        self.configure({
+            'latency': args.latency,
+            'latency_for': dict(item.split('=', 1) for item in args.latency_for),
+            'error_rate': args.error_rate,
+            'rate_limit_rate': args.rate_limit_rate,
+            'rate_limit_rps': args.rate_limit_rps,
+        })
+        self.tokens = {}          # access_token -> (user_id, expira_em)
+        self.refresh_tokens = {}  # refresh_token -> user_id
+        self.questions = {}       # id -> dict
+        self.timings = {}         # id -> [criada_em, respondida_em] (epoch, para medir ponta a ponta)
+        self.pending = {u: [] for u in self.user_ids}  # ids não respondidos por conta (ordem de chegada)
+        self.buckets = {}         # access_token -> (tokens disponíveis, último instante)
+        self.ids = itertools.count(int(time.time()) * 1000)
+        self.stats = {}
+        self.started = time.time()
+
+    # ----- configuração e falhas -----
+    def configure(self, values):
+        with self.lock:
+            if 'latency' in values:
+                self.latency_spec = values['latency']
+                self.latency = parse_latency(values['latency'])
+            if 'latency_for' in values:
+                self.latency_for_spec = dict(values['latency_for'])
+                self.latency_for = {path: parse_latency(spec) for path, spec in self.latency_for_spec.items()}
+            for key in ('error_rate', 'rate_limit_rate', 'rate_limit_rps', 'question_rate', 'token_ttl'):
+                if key in values:
+                    setattr(self, key, float(values[key]))
+
+    def config(self):
+        return {
+            'latency': self.latency_spec,
+            'latency_for': self.latency_for_spec,
+            'error_rate': self.error_rate,
+            'rate_limit_rate': self.rate_limit_rate,
+            'rate_limit_rps': self.rate_limit_rps,
+            'question_rate': self.question_rate,
+            'token_ttl': self.token_ttl,
+        }
+
+    def delay_for(self, path):
+        sampler = next((s for prefix, s in self.latency_for.items() if path.startswith(prefix)), self.latency)
+        with self.lock:
+            return sampler(self.rng)
+
+    def injected_fault(self, token):
+        """(status, corpo) de uma falha sorteada ou do limite por token; None se não houver"""
+        with self.lock:
+            if self.rate_limit_rps > 0 and token:
+                available, last = self.buckets.get(token, (self.rate_limit_rps, time.monotonic()))
+                now = time.monotonic()
+                available = min(self.rate_limit_rps, available + (now - last) * self.rate_limit_rps)
+                if available < 1:
+                    self.buckets[token] = (available, now)
+                    return 429, {"message": "Too Many Requests", "error": "local_rate_limited", "status": 429}
+                self.buckets[token] = (available - 1, now)
+            roll = self.rng.random()
+            if roll < self.rate_limit_rate:
+                return 429, {"message": "Too Many Requests", "error": "local_rate_limited", "status": 429}
+            if roll < self.rate_limit_rate + self.error_rate:
+                status = self.rng.choice((500, 502, 503))
+                return status, {"message": "Injected failure", "error": "internal_error", "status": status}
+        return None
+
+    def record(self, route, status):
+        with self.lock:
+            key = f"{route} {status}"
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    # ----- tokens -----
+    def issue_token(self, user_id):
+        suffix = f"{next(self.ids)}-{user_id}"
+        access_token = f"APP_USR-fake-{suffix}"
+        refresh_token = f"TG-fake-{suffix}"
+        with self.lock:
+            self.tokens[access_token] = (user_id, time.time() + self.token_ttl)
+            self.refresh_tokens[refresh_token] = user_id
+        return {
+            "access_token": access_token,
+            "token_type": "Bearer",
+            "expires_in": int(self.token_ttl),
+            "scope": "offline_access read write",
+            "user_id": int(user_id) if user_id.isdigit() else user_id,
+            "refresh_token": refresh_token,
+        }
+
+    def user_for_token(self, token):
+        """user_id do token válido; None se ausente, expirado ou desconhecido (modo estrito)"""
+        if not token:
+            return None
+        with self.lock:
+            entry = self.tokens.get(token)
+            if entry is None:
+                if not self.accept_unknown_tokens:
+                    return None
+                # Tokens reais (APP_USR-...-<user_id>) passam a valer a partir de agora
+                owner = token.rsplit('-', 1)[-1]
+                entry = (owner if owner in self.pending else self.user_ids[0], time.time() + self.token_ttl)
+                self.tokens[token] = entry
+            user_id, expires_at = entry
+            return user_id if expires_at > time.time() else None
+
+    def expire_tokens(self):
+        with self.lock:
+            self.tokens = {token: (user_id, 0) for token, (user_id, _) in self.tokens.items()}
+            return len(self.tokens)
+
+    # ----- perguntas -----
+    def create_question(self, user_id=None, text=None, item_id=None, notify=True):
+        user_id = str(user_id or self.rng.choice(self.user_ids))
+        with self.lock:
+            if user_id not in self.pending:
+                self.pending[user_id] = []
+            if len(self.pending[user_id]) >= self.max_pending:
+                return None
+            qid = next(self.ids)
+            question = {
+                "id": qid,
+                "seller_id": int(user_id) if user_id.isdigit() else user_id,
+                "item_id": item_id or f"MLB{self.rng.randint(1000000, 9999999)}",
+                "text": text or self.rng.choice(QUESTION_TEXTS),
+                "status": "UNANSWERED",
+                "date_created": datetime.now(ML_TZ).isoformat(timespec='milliseconds'),
+                "from": {"id": self.rng.randint(10 ** 8, 10 ** 9)},
+                "answer": None,
+            }
+            self.questions[qid] = question
+            self.timings[qid] = [time.time(), None]
+            self.pending[user_id].append(qid)
+        if notify and self.webhook_url:
+            threading.Thread(target=self.notify_webhook, args=(question,), daemon=True).start()
+        return question
+
+    def notify_webhook(self, question):
+        body = json.dumps({
+            "resource": f"/questions/{question['id']}",
+            "user_id": question['seller_id'],
+            "topic": "questions",
+            "application_id": 1,
+            "attempts": 1,
+            "sent": datetime.now(timezone.utc).isoformat(),
+            "received": datetime.now(timezone.utc).isoformat(),
+        }).encode()
+        try:
+            urlopen(Request(self.webhook_url, data=body, headers={'Content-Type': 'application/json'}), timeout=10).read()
+        except Exception as e:
+            print(f"⚠️ Falha ao notificar webhook: {e}")
+
+    def answer(self, qid, text):
+        with self.lock:
+            question = self.questions.get(qid)
+            if question is None:
+                return 404, {"message": f"Question {qid} not found", "error": "not_found", "status": 404}
+            if question['status'] != 'UNANSWERED':
+                return 400, {"message": "Question already answered", "error": "bad_request", "status": 400}
+            question['status'] = 'ANSWERED'
+            self.timings[qid][1] = time.time()
+            question['answer'] = {
+                "text": text,
+                "status": "ACTIVE",
+                "date_created": datetime.now(ML_TZ).isoformat(timespec='milliseconds'),
+            }
+            pending = self.pending.get(str(question['seller_id']), [])
+            if qid in pending:
+                pending.remove(qid)
+            return 200, {"question_id": qid, "text": text, "status": "ANSWERED"}
+
+    def search(self, user_id, limit):
+        with self.lock:
+            ids = list(self.pending.get(user_id, []))
+            return {
+                "total": len(ids),
+                "limit": limit,
+                "questions": [dict(self.questions[qid]) for qid in ids[:limit]],
+            }
+
+    def question_generator(self):
+        """Chegada de perguntas como processo de Poisson (question_rate por segundo, somando as contas)"""
+        while True:
+            if self.question_rate <= 0:
+                time.sleep(0.5)
+                continue
+            time.sleep(self.rng.expovariate(self.question_rate))
+            self.create_question()
+
+    def snapshot(self):
+        with self.lock:
+            answered = sum(1 for q in self.questions.values() if q['status'] == 'ANSWERED')
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "questions": len(self.questions),
+                "answered": answered,
+                "pending": {user_id: len(ids) for user_id, ids in self.pending.items()},
+                "tokens": len(self.tokens),
+                "requests": dict(sorted(self.stats.items())),
+                "config": self.config(),
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "FakeML/1.0"
+    protocol_version = "HTTP/1.1"
+    fake = None  # FakeMercadoLivre, definido em main()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        if 'application/json' in (self.headers.get('Content-Type') or ''):
+            return json.loads(raw or b'{}')
+        return {key: values[0] for key, values in parse_qs(raw.decode('utf-8')).items()}
+
+    def access_token(self, query):
+        auth = self.headers.get('Authorization') or ''
+        if auth.startswith('Bearer '):
+            return auth[len('Bearer '):].strip()
+        return query.get('access_token', [None])[0]
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def dispatch(self, method):
+        parsed = urlparse(self.path)
+        path, query = parsed.path, parse_qs(parsed.query)
+        if path.startswith('/_admin/'):
+            return self.admin(method, path)
+        for (route_method, pattern), route in ROUTES.items():
+            match = pattern.match(path)
+            if route_method == method and match:
+                break
+        else:
+            self.fake.record('unknown', 404)
+            return self.send_json(404, {"message": "resource not found", "error": "not_found", "status": 404})
+
+        body = self.read_body() if method == 'POST' else {}
+        time.sleep(self.fake.delay_for(path))
+        token = self.access_token(query)
+        fault = self.fake.injected_fault(token)
+        if fault:
+            status, payload = fault
+            self.fake.record(route, status)
+            return self.send_json(status, payload, {'Retry-After': '1'} if status == 429 else None)
+
+        if route == 'token':
+            status, payload = self.oauth_token(body)
+        else:
+            user_id = self.fake.user_for_token(token)
+            if user_id is None:
+                status, payload = 401, {"message": "invalid access token", "error": "unauthorized", "status": 401}
+            elif route == 'question':
+                question = self.fake.questions.get(int(match.group(1)))
+                status, payload = (200, question) if question else (404, {"message": "not found", "status": 404})
+            elif route == 'search':
+                limit = int(query.get('limit', ['50'])[0])
+                status, payload = 200, self.fake.search(user_id, limit)
+            elif route == 'answer':
+                status, payload = self.fake.answer(int(body.get('question_id', 0)), body.get('text', ''))
+            else:
+                status, payload = 200, {"id": int(user_id) if user_id.isdigit() else user_id,
+                                        "nickname": f"VENDEDOR_{user_id}", "site_id": "MLB"}
+        self.fake.record(route, status)
+        self.send_json(status, payload)
+
+    def oauth_token(self, body):
+        grant_type = body.get('grant_type')
+        if grant_type == 'refresh_token':
+            user_id = self.fake.refresh_tokens.get(body.get('refresh_token'))
+            if user_id is None:
+                if not self.fake.accept_unknown_tokens:
+                    return 400, {"message": "invalid refresh token", "error": "invalid_grant", "status": 400}
+                user_id = self.fake.user_ids[0]
+            return 200, self.fake.issue_token(user_id)
+        if grant_type == 'authorization_code' and body.get('code'):
+            return 200, self.fake.issue_token(self.fake.user_ids[0])
+        return 400, {"message": "invalid grant", "error": "invalid_grant", "status": 400}
+
+    def admin(self, method, path):
+        if method == 'GET' and path == '/_admin/stats':
+            return self.send_json(200, self.fake.snapshot())
+        if method == 'GET' and path == '/_admin/questions':
+            raw = parse_qs(urlparse(self.path).query).get('ids', [''])[0]
+            with self.fake.lock:
+                ids = [int(x) for x in raw.split(',') if x.strip().isdigit()] if raw else list(self.fake.timings)
+                timings = {str(qid): self.fake.timings[qid] for qid in ids if qid in self.fake.timings}
+            return self.send_json(200, {"questions": timings})
+        if method == 'POST' and path == '/_admin/config':
+            try:
+                self.fake.configure(self.read_body())
+            except (ValueError, IndexError) as e:
+                return self.send_json(400, {"error": str(e)})
+            return self.send_json(200, self.fake.config())
+        if method == 'POST' and path == '/_admin/questions':
+            body = self.read_body()
+            question = self.fake.create_question(body.get('user_id'), body.get('text'), body.get('item_id'),
+                                                 notify=body.get('notify', True))
+            if question is None:
+                return self.send_json(409, {"error": "limite de perguntas pendentes atingido"})
+            return self.send_json(201, question)
+        if method == 'POST' and path == '/_admin/expire-tokens':
+            return self.send_json(200, {"expired": self.fake.expire_tokens()})
+        return self.send_json(404, {"error": "rota de administração desconhecida"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor falso da API do Mercado Livre")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--users', default='180617463', help="user_ids das contas, separados por vírgula")
+    parser.add_argument('--question-rate', type=float, default=0.0, help="perguntas novas por segundo (Poisson)")
+    parser.add_argument('--max-pending', type=int, default=1000, help="limite de pendentes por conta")
+    parser.add_argument('--latency', default='fixed:0', help="distribuição padrão (ms)")
+    parser.add_argument('--latency-for', action='append', default=[], metavar='ROTA=DIST',
+                        help="latência por prefixo de rota, ex.: /answers=lognormal:120,0.8")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fração de respostas 500/502/503")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fração de respostas 429")
+    parser.add_argument('--rate-limit-rps', type=float, default=0.0, help="limite por token (0 = sem limite)")
+    parser.add_argument('--token-ttl', type=float, default=21600, help="validade dos access tokens (s)")
+    parser.add_argument('--strict-tokens', action='store_true', help="recusa tokens que não foram emitidos aqui")
+    parser.add_argument('--webhook-url', help="notifica o bot a cada pergunta criada, ex.: http://localhost:5000/api/ml/webhook")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--verbose', action='store_true', help="loga cada requisição")
+    args = parser.parse_args()
+
+    Handler.fake = FakeMercadoLivre(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.verbose = args.verbose
+    threading.Thread(target=Handler.fake.question_generator, name='question-generator', daemon=True).start()
+    print(f"🧪 API falsa do Mercado Livre em http://{args.host}:{args.port} (contas: {', '.join(Handler.fake.user_ids)})")
+    print(f"   Use ML_API_BASE_URL=http://{args.host}:{args.port} no bot")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+REPRODUTOR DE TRÁFEGO CAPTURADO
+Lê capturas gravadas com TRAFFIC_CAPTURE_PATH (traffic-*.ndjson.gz) e leva o
+bot pela mesma sequência: os webhooks são reenviados nos instantes gravados
+(divididos por --speed) e as chamadas do bot à API do ML são atendidas por um
+servidor embutido com as respostas gravadas, na ordem em que aconteceram.
+
+Preparação (o bot aponta para o reprodutor em vez do ML):
+    ML_API_BASE_URL=http://127.0.0.1:8092 python main.py
+
+Uso:
+    python tools/replay_traffic.py capturas/traffic-*.ndjson.gz --speed 10 --output replay.json
+    python tools/replay_traffic.py captura.ndjson.gz --speed max --ml-latency none
+
+--speed aceita 1, 10 (ou qualquer fator) e 'max' (sem espera entre webhooks).
+--ml-latency: 'recorded' repete a duração gravada de cada resposta, 'scaled' a
+divide por --speed e 'none' responde na hora.
+
+Respostas são casadas por (método, caminho, parâmetros); quando as gravadas para
+uma chave acabam, a última é repetida. Chamadas sem nenhuma gravação recebem uma
+resposta vazia (busca sem perguntas, 200 nas respostas, 404 no resto) e aparecem
+em "unmatched" no relatório.
+
+A listagem de pendentes (/my/received_questions/search) não é consumida em
+ordem: o polling do bot roda no relógio real, independente de --speed. Cada
+busca recebe a página gravada mais recente no instante equivalente da captura
+(tempo decorrido x --speed; em 'max', o instante do último webhook enviado),
+somada às páginas gravadas desde a busca anterior, então polling e webhooks
+continuam na mesma sequência em qualquer velocidade. Para reproduzir também a
+cadência do polling, rode o bot com MONITOR_INTERVAL dividido por --speed.
+"""
+
+import argparse
+import bisect
+import glob
+import gzip
+import json
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+_local = threading.local()
+IGNORED_PARAMS = {'access_token'}
+NUMERIC_SEGMENT = re.compile(r'/\d+')
+TIMELINE_SUFFIXES = ('/received_questions/search',)  # respostas que dependem do instante, não da ordem
+
+
+def session():
+    """Uma sessão HTTP (keep-alive) por thread"""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentiles(values, quantiles=(0.5, 0.95, 0.99)):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {f"p{int(q * 100)}": round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2) for q in quantiles}
+    result["max"] = round(ordered[-1], 2)
+    result["avg"] = round(sum(ordered) / len(ordered), 2)
+    return result
+
+
+def load_capture(patterns):
+    """Registros de um ou mais arquivos (aceita globs), em ordem de tempo"""
+    paths = sorted({path for pattern in patterns for path in (glob.glob(pattern) or [pattern])})
+    entries = []
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    entries.append(json.loads(line))
+    entries.sort(key=lambda e: (e['t'], e.get('seq', 0)))
+    return paths, entries
+
+
+def route_label(method, path):
+    """Rótulo agregado para o relatório (/questions/123 -> /questions/{id})"""
+    return f"{method.upper()} {NUMERIC_SEGMENT.sub('/{id}', path)}"
+
+
+def request_key(method, path, params, body):
+    """Chave de casamento entre uma chamada do bot e uma resposta gravada"""
+    params = tuple(sorted((str(k), str(v)) for k, v in (params or {}).items() if k not in IGNORED_PARAMS))
+    if path == '/answers' and isinstance(body, dict):
+        # Várias respostas no mesmo caminho: separa por pergunta
+        params += (('question_id', str(body.get('question_id'))),)
+    return method.upper(), path, params
+
+
+class RecordedML:
+    """Respostas gravadas da API do ML: em ordem por chave, ou pelo instante gravado (buscas)"""
+
+    def __init__(self, entries, latency_mode, speed, recorded_now=None):
+        self.lock = threading.Lock()
+        self.responses = defaultdict(deque)
+        self.timelines = defaultdict(list)  # chave -> registros em ordem de tempo gravado
+        self.served = defaultdict(set)
+        self.before_first = defaultdict(int)
+        self.recorded_now = recorded_now
+        self.timeline_times = {}
+        self.last = {}
+        self.latency_mode = latency_mode
+        self.speed = speed
+        self.matched = defaultdict(int)
+        self.repeated = defaultdict(int)
+        self.unmatched = defaultdict(int)
+        self.recorded = defaultdict(int)
+        for entry in entries:
+            if entry['kind'] != 'ml' or entry.get('status') is None:
+                continue
+            key = request_key(entry['method'], entry['path'], entry.get('params'), entry.get('request'))
+            if entry['path'].endswith(TIMELINE_SUFFIXES):
+                self.timelines[key].append(entry)
+            else:
+                self.responses[key].append(entry)
+            self.recorded[route_label(entry['method'], entry['path'])] += 1
+        self.timeline_times = {key: [entry['t'] for entry in timeline] for key, timeline in self.timelines.items()}
+
+    def take(self, method, path, params, body):
+        key = request_key(method, path, params, body)
+        label = route_label(method, path)
+        with self.lock:
+            timeline = self.timelines.get(key)
+            if timeline and self.recorded_now:
+                # Página gravada mais recente até o instante equivalente da captura
+                index = bisect.bisect_right(self.timeline_times[key], self.recorded_now()) - 1
+                if index < 0:
+                    self.before_first[label] += 1
+                    return {'status': 200, 'response': fallback(path)[1]}
+                served = self.served[key]
+                if index in served:
+                    self.repeated[label] += 1
+                    return timeline[index]
+                # Páginas puladas desde a última busca entram junto: perguntas que
+                # o polling gravado viu (e respondeu) entre uma busca e outra
+                skipped = [i for i in range(index + 1) if i not in served]
+                served.update(skipped)
+                self.matched[label] += 1
+                return merge_pages([timeline[i] for i in skipped])
+            pending = self.responses.get(key)
+            if pending:
+                entry = pending.popleft()
+                self.last[key] = entry
+                self.matched[label] += 1
+            elif key in self.last:
+                entry = self.last[key]
+                self.repeated[label] += 1
+            else:
+                self.unmatched[label] += 1
+                return None
+        return entry
+
+    def delay(self, entry):
+        if self.latency_mode == 'none' or not entry.get('duration_ms'):
+            return 0
+        seconds = entry['duration_ms'] / 1000
+        return seconds / self.speed if self.latency_mode == 'scaled' and self.speed else seconds
+
+    def report(self):
+        with self.lock:
+            leftover = {}
+            for (method, path, _), pending in self.responses.items():
+                if pending:
+                    label = route_label(method, path)
+                    leftover[label] = leftover.get(label, 0) + len(pending)
+            for key, timeline in self.timelines.items():
+                skipped = len(timeline) - len(self.served[key])
+                if skipped:
+                    label = route_label(key[0], key[1])
+                    leftover[label] = leftover.get(label, 0) + skipped
+            return {
+                "recorded": dict(self.recorded),
+                "matched": dict(self.matched),
+                "repeated_last": dict(self.repeated),
+                "unmatched": dict(self.unmatched),
+                "before_first_recorded": dict(self.before_first),
+                "not_requested": leftover,
+            }
+
+
+def merge_pages(entries):
+    """Junta páginas de busca gravadas (sem repetir perguntas); a mais recente vale para o resto"""
+    latest = entries[-1]
+    if len(entries) == 1 or not isinstance(latest.get('response'), dict):
+        return latest
+    questions = {}
+    for entry in entries:
+        for question in (entry.get('response') or {}).get('questions', []):
+            questions[question.get('id')] = question
+    response = dict(latest['response'], questions=list(questions.values()), total=len(questions))
+    return dict(latest, response=response)
+
+
+def fallback(path):
+    """Resposta para uma chamada que a captura não tem"""
+    if path.endswith('/received_questions/search'):
+        return 200, {"questions": [], "total": 0}
+    if path == '/answers':
+        return 200, {"status": "ANSWERED"}
+    return 404, {"message": "not recorded", "error": "not_found", "status": 404}
+
+
+def make_handler(recorded):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw = self.rfile.read(length) if length else b''
+            if not raw:
+                return None
+            if 'json' in (self.headers.get('Content-Type') or ''):
+                try:
+                    return json.loads(raw)
+                except ValueError:
+                    return None
+            return dict(parse_qsl(raw.decode('utf-8', 'replace')))
+
+        def _serve(self):
+            parts = urlsplit(self.path)
+            params = dict(parse_qsl(parts.query))
+            body = self._body()
+            entry = recorded.take(self.command, parts.path, params, body)
+            if entry is None:
+                status, payload = fallback(parts.path)
+            else:
+                time.sleep(recorded.delay(entry))
+                status, payload = entry['status'], entry.get('response')
+            data = (payload if isinstance(payload, str) else json.dumps(payload)).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+    return Handler
+
+
+class Replay:
+    def __init__(self, args, entries):
+        self.args = args
+        self.entries = entries
+        self.webhooks = [e for e in entries if e['kind'] == 'webhook']
+        self.t0 = entries[0]['t'] if entries else 0
+        self.started = None
+        self.last_sent_t = self.t0
+        self.lock = threading.Lock()
+        self.ack_ms = []
+        self.errors = {}
+        self.sent = 0
+        self.acked = 0
+        self.late_ms = []
+
+    def count_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def post_webhook(self, entry):
+        start = time.perf_counter()
+        try:
+            r = session().post(self.args.app + entry.get('path', '/api/ml/webhook'),
+                               json=entry['payload'], timeout=self.args.timeout)
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.sent += 1
+                if r.status_code == 200:
+                    self.acked += 1
+                    self.ack_ms.append(elapsed)
+            if r.status_code != 200:
+                self.count_error(f"http_{r.status_code}")
+        except requests.Timeout:
+            with self.lock:
+                self.sent += 1
+            self.count_error('timeout')
+        except requests.ConnectionError:
+            with self.lock:
+                self.sent += 1
+            self.count_error('connection')
+
+    def recorded_now(self):
+        """Instante da captura equivalente ao momento atual do replay"""
+        if self.started is None:
+            return self.t0
+        if not self.args.speed:
+            return self.last_sent_t
+        return self.t0 + (time.monotonic() - self.started) * self.args.speed
+
+    def run(self):
+        speed = self.args.speed
+        t0 = self.t0
+        self.started = started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for entry in self.webhooks:
+                if speed:
+                    at = started + (entry['t'] - t0) / speed
+                    delay = at - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        self.late_ms.append(-delay * 1000)
+                self.last_sent_t = entry['t']
+                pool.submit(self.post_webhook, entry)
+            send_seconds = time.monotonic() - started
+        time.sleep(self.args.drain)
+        recorded_seconds = self.webhooks[-1]['t'] - t0 if self.webhooks else 0
+        return recorded_seconds, send_seconds
+
+
+def recorded_answers(entries):
+    return sum(1 for e in entries if e['kind'] == 'ml' and e['path'] == '/answers' and e.get('status') in (200, 201))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproduz tráfego capturado contra o bot")
+    parser.add_argument('captures', nargs='+', help="arquivos traffic-*.ndjson.gz (aceita glob)")
+    parser.add_argument('--app', default='http://127.0.0.1:5000', help="URL base do bot")
+    parser.add_argument('--host', default='127.0.0.1', help="endereço do servidor de respostas gravadas")
+    parser.add_argument('--port', type=int, default=8092, help="porta do servidor de respostas gravadas")
+    parser.add_argument('--speed', default='1', help="fator de aceleração (1, 10, ...) ou 'max'")
+    parser.add_argument('--ml-latency', choices=('recorded', 'scaled', 'none'), default='scaled')
+    parser.add_argument('--concurrency', type=int, default=16, help="conexões simultâneas")
+    parser.add_argument('--timeout', type=float, default=10, help="timeout do POST do webhook")
+    parser.add_argument('--drain', type=float, default=10, help="segundos servindo o bot depois do último webhook")
+    parser.add_argument('--output', help="grava o relatório JSON neste arquivo")
+    args = parser.parse_args()
+    args.speed = 0 if args.speed == 'max' else float(args.speed)
+    if args.speed < 0:
+        parser.error("--speed deve ser positivo ou 'max'")
+
+    paths, entries = load_capture(args.captures)
+    replay = Replay(args, entries)
+    recorded = RecordedML(entries, args.ml_latency, args.speed, recorded_now=replay.recorded_now)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(recorded))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    label = 'max' if not args.speed else f"{args.speed:g}x"
+    print(f"⏯️ {len(replay.webhooks)} webhooks de {len(paths)} captura(s) a {label} contra {args.app}; "
+          f"respostas do ML em http://{args.host}:{args.port}", file=sys.stderr)
+    recorded_seconds, send_seconds = replay.run()
+    server.shutdown()
+
+    ml_report = recorded.report()
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "capture": {
+            "files": paths,
+            "records": len(entries),
+            "webhooks": len(replay.webhooks),
+            "ml_requests": sum(1 for e in entries if e['kind'] == 'ml'),
+            "answers": recorded_answers(entries),
+        },
+        "timing": {
+            "recorded_seconds": round(recorded_seconds, 3),
+            "intended_seconds": round(recorded_seconds / args.speed, 3) if args.speed else 0,
+            "actual_seconds": round(send_seconds, 3),
+            "late_webhooks": len(replay.late_ms),
+            "lateness_ms": percentiles(replay.late_ms),
+        },
+        "notifications": {
+            "sent": replay.sent,
+            "acked": replay.acked,
+            "errors": replay.errors,
+            "error_rate": round(1 - replay.acked / replay.sent, 4) if replay.sent else 0,
+        },
+        "ack_latency_ms": percentiles(replay.ack_ms),
+        "answers": {
+            "recorded": recorded_answers(entries),
+            "replayed": sum(ml_report[group].get('POST /answers', 0)
+                            for group in ("matched", "repeated_last", "unmatched")),
+        },
+        "ml_requests": ml_report,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
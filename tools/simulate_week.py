@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SIMULAÇÃO EM TEMPO VIRTUAL
+Roda o bot com o relógio simulado (main.SimulatedClock): polling a cada
+MONITOR_INTERVAL, renovações de token do agendador central, retenção e
+backups viram eventos num heap e o tempo salta direto de um para o outro.
+Uma semana de tráfego roda milhares de vezes mais rápido que o relógio real
+(o custo é o do próprio bot a cada ciclo de polling).
+
+A API do ML é simulada em processo (como nos benchmarks): perguntas chegam
+num processo de Poisson com perfil por hora do dia, tokens expiram em
+--token-ttl segundos virtuais e a renovação pode falhar (--refresh-failure-rate).
+O banco é um SQLite temporário com as regras e ausências padrão.
+
+Uso:
+    python tools/simulate_week.py                       # 7 dias, 1 conta
+    python tools/simulate_week.py --days 7 --accounts 5 --rate 20 --output sim.json
+    python tools/simulate_week.py --start 2026-03-06T17:00 --days 1 --refresh-failure-rate 0.2
+
+Relatório (JSON): tempo virtual x tempo real, perguntas por desfecho, latência
+(virtual) da chegada à resposta, renovações por conta e chamadas com token
+vencido, transições de ausência e divergências entre a janela de ausência
+esperada e a resposta enviada.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(TOOLS_DIR)
+
+# Chegadas relativas por hora local (pico no horário comercial)
+HOURLY_PROFILE = [0.15, 0.1, 0.05, 0.05, 0.05, 0.1, 0.2, 0.4, 0.7, 0.9, 1.0, 1.0,
+                  0.9, 0.9, 1.0, 1.0, 0.9, 0.8, 0.7, 0.7, 0.8, 0.7, 0.5, 0.3]
+HIT_TEXTS = [
+    'Qual o prazo de entrega para SP?', 'Tem garantia?', 'Aceita pix?', 'Emite nota fiscal?',
+    'Quanto custa o frete?', 'Ainda está disponível?', 'Qual o valor à vista?',
+]
+MISS_TEXTS = [
+    'Serve no modelo 2019?', 'Qual a voltagem?', 'Vocês fazem instalação?',
+    'Funciona com 220v?', 'Qual a cor do produto?', 'Vem com manual em português?',
+]
+EXTRA_ACCOUNT_BASE = 900000001
+
+
+def _prepare_environment(log_level):
+    """Isola o bot num diretório temporário antes de importar main.py"""
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    data_dir = tempfile.mkdtemp(prefix='botml-sim-', dir=base)
+    os.environ['DATA_DIR'] = data_dir
+    os.environ['LOG_LEVEL'] = log_level
+    os.environ['DB_WRITER_MAX_DELAY_MS'] = '0'  # cada evento espera a gravação: sem janela de group commit
+    for name in ('DATABASE_URL', 'REDIS_URL', 'TRAFFIC_CAPTURE_PATH'):
+        os.environ.pop(name, None)
+    sys.path.insert(0, REPO_ROOT)
+    return data_dir
+
+
+def percentiles(values, quantiles=(0.5, 0.95, 0.99)):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {f"p{int(q * 100)}": round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2) for q in quantiles}
+    result["max"] = round(ordered[-1], 2)
+    result["avg"] = round(sum(ordered) / len(ordered), 2)
+    return result
+
+
+def next_monday(tz):
+    """Próxima segunda-feira 00:00 no fuso dado"""
+    today = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today + timedelta(days=(7 - today.weekday()) % 7 or 7)
+
+
+class AbsenceWindows:
+    """Janelas de ausência configuradas, avaliadas por fora do bot (verificação)"""
+
+    def __init__(self, configs):
+        self.configs = [(c.name, c.message, c.start_time, c.end_time, c.days_of_week.split(',')) for c in configs]
+        self.messages = {c[1]: c[0] for c in self.configs}
+
+    def active(self, local_dt):
+        """Nome da janela ativa no instante (ou None), com a mesma semântica do bot"""
+        current = local_dt.strftime('%H:%M')
+        weekday = str(local_dt.weekday())
+        for name, _, start, end, days in self.configs:
+            if weekday not in days:
+                continue
+            if start > end:
+                if current >= start or current <= end:
+                    return name
+            elif start <= current <= end:
+                return name
+        return None
+
+
+class SimulatedML:
+    """API do ML em processo, no tempo do relógio simulado"""
+
+    def __init__(self, main, args, rng, accounts, start, end):
+        self.main = main
+        self.args = args
+        self.rng = rng
+        self.accounts = accounts
+        self.pending = {account: {} for account in accounts}
+        self.arrivals = self._generate(start, end)
+        self.cursor = 0
+        self.questions = {}
+        self.tokens = {}  # token -> (conta, expira_em)
+        self.refreshes = defaultdict(list)
+        self.refresh_failures = 0
+        self.expired_token_calls = 0
+        self.duplicate_answers = 0
+        self.manual = 0
+        self.windows = None
+        self.expected_absence = set()
+        self.window_state = None
+        self.transitions = defaultdict(int)
+        self.polls = 0
+
+    def _generate(self, start, end):
+        """Chegadas de Poisson não homogêneo (por afinamento) para todas as contas"""
+        peak = self.args.rate / 3600.0
+        arrivals = []
+        next_id = 10 ** 12
+        for account in self.accounts:
+            t = start
+            while True:
+                t += self.rng.expovariate(peak)
+                if t >= end:
+                    break
+                hour = datetime.fromtimestamp(t, self.main.SAO_PAULO_TZ).hour
+                if self.rng.random() > HOURLY_PROFILE[hour]:
+                    continue
+                hit = self.rng.random() < self.args.hit_ratio
+                next_id += 1
+                arrivals.append({
+                    'id': next_id, 'account': account, 't': t, 'hit': hit,
+                    'text': self.rng.choice(HIT_TEXTS if hit else MISS_TEXTS),
+                    'answered_at': None, 'answer': None,
+                })
+        arrivals.sort(key=lambda q: q['t'])
+        return arrivals
+
+    def issue_token(self, account, ttl):
+        token = f"APP_USR-sim-{account}-{len(self.tokens) + 1}"
+        self.tokens[token] = (account, self.main.clock.time() + ttl)
+        return token
+
+    def _check_token(self, token):
+        account, expires_at = self.tokens.get(token, (None, 0))
+        if self.main.clock.time() >= expires_at:
+            self.expired_token_calls += 1
+
+    def _admit(self, now):
+        while self.cursor < len(self.arrivals) and self.arrivals[self.cursor]['t'] <= now:
+            q = self.arrivals[self.cursor]
+            self.questions[q['id']] = q
+            self.pending[q['account']][q['id']] = q
+            self.cursor += 1
+
+    def fetch(self, access_token, limit=50, ml_user_id=None):
+        main = self.main
+        now = main.clock.time()
+        self._check_token(access_token)
+        self._admit(now)
+        pending = self.pending[str(ml_user_id)]
+        # Sem resposta automática, o vendedor responde à mão depois de --manual-after
+        for qid in [qid for qid, q in pending.items() if now - q['t'] > self.args.manual_after]:
+            del pending[qid]
+            self.manual += 1
+        window = self.windows.active(datetime.fromtimestamp(now, main.SAO_PAULO_TZ))
+        if str(ml_user_id) == self.accounts[0]:
+            self.polls += 1
+            if window != self.window_state:
+                self.transitions[f"{self.window_state or 'atendimento'} -> {window or 'atendimento'}"] += 1
+                self.window_state = window
+        page = list(pending.values())[:limit]
+        if window:
+            self.expected_absence.update(q['id'] for q in page if not q['hit'])
+        return [{
+            'id': q['id'], 'text': q['text'], 'item_id': 'MLB123', 'status': 'UNANSWERED',
+            'date_created': datetime.fromtimestamp(q['t'], timezone.utc).isoformat(),
+        } for q in page]
+
+    def answer(self, access_token, question_id, text, ml_user_id=None):
+        self._check_token(access_token)
+        q = self.pending[str(ml_user_id)].pop(int(question_id), None)
+        if q is None:
+            self.duplicate_answers += 1
+            return False
+        q['answered_at'] = self.main.clock.time()
+        q['answer'] = text
+        return True
+
+    def refresh(self, inst):
+        account = str(inst.ml_user_id)
+        if self.rng.random() < self.args.refresh_failure_rate:
+            self.refresh_failures += 1
+            return False, {'error': 'invalid_grant (simulado)'}
+        self.refreshes[account].append(self.main.clock.time())
+        return True, {
+            'access_token': self.issue_token(account, self.args.token_ttl),
+            'refresh_token': f"TG-sim-{account}-{len(self.refreshes[account])}",
+            'user_id': account,
+            'expires_in': self.args.token_ttl,
+        }
+
+    def report(self):
+        answered = [q for q in self.questions.values() if q['answered_at'] is not None]
+        by_kind = defaultdict(list)
+        mismatches = defaultdict(int)
+        for q in answered:
+            latency = q['answered_at'] - q['t']
+            window_name = self.windows.messages.get(q['answer'])
+            if window_name:
+                by_kind['absence'].append(latency)
+                local = datetime.fromtimestamp(q['answered_at'], self.main.SAO_PAULO_TZ)
+                if self.windows.active(local) != window_name:
+                    mismatches['absence_outside_window'] += 1
+                if q['hit']:
+                    mismatches['absence_instead_of_rule'] += 1
+            else:
+                by_kind['auto'].append(latency)
+                if not q['hit']:
+                    mismatches['auto_without_rule'] += 1
+        for qid in self.expected_absence:
+            if self.questions[qid]['answered_at'] is None:
+                mismatches['absence_missed'] += 1
+        unanswered_hits = sum(1 for q in self.questions.values() if q['hit'] and q['answered_at'] is None
+                              and q['id'] not in {p for pending in self.pending.values() for p in pending})
+        refresh_gaps = [b - a for times in self.refreshes.values() for a, b in zip(times, times[1:])]
+        return {
+            "questions": {
+                "arrived": len(self.questions),
+                "answered_auto": len(by_kind['auto']),
+                "answered_absence": len(by_kind['absence']),
+                "answered_manually": self.manual,
+                "still_pending": sum(len(p) for p in self.pending.values()),
+                "rule_hits_left_for_manual": unanswered_hits,
+                "duplicate_answer_attempts": self.duplicate_answers,
+            },
+            "latency_seconds": {kind: percentiles(values) for kind, values in by_kind.items()},
+            "tokens": {
+                "refreshes": {account: len(times) for account, times in self.refreshes.items()},
+                "refresh_failures": self.refresh_failures,
+                "refresh_interval_hours": {k: round(v / 3600, 2) for k, v in percentiles(refresh_gaps).items()},
+                "expired_token_calls": self.expired_token_calls,
+            },
+            "absence": {
+                "polls": self.polls,
+                "transitions": dict(self.transitions),
+            },
+            "mismatches": dict(mismatches),
+        }
+
+
+def add_accounts(main, sim, count, start, rng):
+    """
+    Contas extras com tokens que vencem em instantes espalhados. A principal
+    ganha refresh token sem expiração conhecida (renovada já no boot).
+    """
+    with main.app.app_context():
+        user = main.User.query.filter_by(ml_user_id=str(main.ML_USER_ID)).first()
+        user.refresh_token = f"TG-sim-{main.ML_USER_ID}-0"
+        user.token_expires_at = None
+        for i in range(count):
+            account = str(EXTRA_ACCOUNT_BASE + i)
+            remaining = rng.uniform(600, sim.args.token_ttl)
+            main.db.session.add(main.User(
+                ml_user_id=account,
+                access_token=sim.issue_token(account, remaining),
+                refresh_token=f"TG-sim-{account}-0",
+                token_expires_at=datetime.fromtimestamp(start + remaining, timezone.utc).replace(tzinfo=None),
+            ))
+        main.db.session.commit()
+    main.credential_registry.invalidate()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Simulação do bot em tempo virtual")
+    parser.add_argument('--days', type=float, default=7, help="dias virtuais")
+    parser.add_argument('--start', help="início local (São Paulo), ex.: 2026-03-02T00:00; padrão: próxima segunda")
+    parser.add_argument('--accounts', type=int, default=1, help="contas (a principal mais extras)")
+    parser.add_argument('--rate', type=float, default=12, help="perguntas por hora por conta no pico")
+    parser.add_argument('--hit-ratio', type=float, default=0.6, help="fração que casa com alguma regra")
+    parser.add_argument('--manual-after', type=float, default=4 * 3600, help="segundos até o vendedor responder à mão")
+    parser.add_argument('--token-ttl', type=int, default=21600, help="validade dos tokens emitidos (segundos)")
+    parser.add_argument('--refresh-failure-rate', type=float, default=0.0, help="fração de renovações que falham")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help="grava o relatório JSON neste arquivo")
+    args = parser.parse_args()
+
+    data_dir = _prepare_environment(args.log_level)
+    rng = random.Random(args.seed)
+    random.seed(args.seed)  # jitter do agendador de renovações
+    # Os logs do bot (stdout da thread de escrita) não se misturam com o JSON
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        import main
+        tz = main.SAO_PAULO_TZ
+        start_dt = datetime.fromisoformat(args.start).replace(tzinfo=tz) if args.start else next_monday(tz)
+        start = start_dt.timestamp()
+        end = start + args.days * 86400
+        clock = main.set_clock(main.SimulatedClock(start))
+        main.initialize_database()
+        main.create_default_data()
+
+        accounts = [str(main.ML_USER_ID)] + [str(EXTRA_ACCOUNT_BASE + i) for i in range(args.accounts - 1)]
+        sim = SimulatedML(main, args, rng, accounts, start, end)
+        sim.issue_token(accounts[0], args.token_ttl)
+        sim.tokens[main.ML_ACCESS_TOKEN] = (accounts[0], start + args.token_ttl)
+        add_accounts(main, sim, args.accounts - 1, start, rng)
+        with main.app.app_context():
+            sim.windows = AbsenceWindows(main.AbsenceConfig.query.filter_by(is_active=True).all())
+        sim.window_state = sim.windows.active(start_dt)
+
+        main.fetch_unanswered_questions_with_token = sim.fetch
+        main.answer_question_ml_with_token = sim.answer
+        main.AutoTokenRefresh.process_refresh_token_internal = lambda inst: sim.refresh(inst)
+
+        wall = time.perf_counter()
+        main.start_background_tasks()
+        clock.run_until(end, after_event=main.db_writer.flush)
+        wall = time.perf_counter() - wall
+        main.db_writer.flush()
+        main.log_writer.flush()
+
+    virtual = end - start
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != 'output'},
+        "time": {
+            "start": start_dt.isoformat(),
+            "end": datetime.fromtimestamp(end, tz).isoformat(),
+            "virtual_seconds": round(virtual, 1),
+            "wall_seconds": round(wall, 3),
+            "speedup": round(virtual / wall, 1) if wall else None,
+            "events": clock.events_run,
+            "event_errors": clock.errors,
+        },
+        **sim.report(),
+        "app": {
+            "sla": main.sla_stats.snapshot().get('all'),
+            "token_scheduler": main.token_scheduler.status(),
+        },
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    return 1 if report["mismatches"] or report["tokens"]["expired_token_calls"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GERADOR DE TEMPESTADE DE WEBHOOKS
+Dispara notificações 'questions' contra o bot em execução, numa taxa fixa
+(carga em malha aberta), com duplicatas e reentregas como o ML faz. Cada
+notificação aponta para uma pergunta criada antes no servidor falso
+(tools/fake_ml_server.py), que também registra quando ela foi respondida.
+
+Preparação:
+    python tools/fake_ml_server.py --port 8081 --latency lognormal:40,0.5
+    ML_API_BASE_URL=http://127.0.0.1:8081 python main.py
+
+Uso:
+    python tools/webhook_storm.py --rate 50 --duration 60 --concurrency 32 \\
+        --duplicate-ratio 0.1 --redelivery-ratio 0.05 --output storm.json
+
+Relatório (JSON): latência do ACK (p50/p95/p99), erros por tipo, vazão atingida,
+latência ponta a ponta (criação da pergunta -> resposta recebida pelo servidor
+falso), e picos de threads, workers de webhook e memória lidos de /metrics.
+"""
+
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+import requests
+
+_local = threading.local()
+METRIC_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?\s+(\S+)$')
+
+
+def session():
+    """Uma sessão HTTP (keep-alive) por thread"""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentiles(values, quantiles=(0.5, 0.95, 0.99)):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    result = {f"p{int(q * 100)}": round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2) for q in quantiles}
+    result["max"] = round(ordered[-1], 2)
+    result["avg"] = round(sum(ordered) / len(ordered), 2)
+    return result
+
+
+class Storm:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.ack_ms = []
+        self.errors = {}
+        self.sent = 0
+        self.fired = 0
+        self.acked = 0
+        self.behind_schedule = 0
+        self.question_ids = []
+        self.redeliveries = []  # (instante, notificação)
+        self.peaks = {}
+        self.stop = threading.Event()
+        self.pool = None
+
+    def count_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def plan(self):
+        """Sorteia conta e tipo da próxima notificação na thread de agendamento (reprodutível com --seed)"""
+        user_id = self.rng.choice(self.args.users)
+        roll = self.rng.random()
+        if roll < self.args.duplicate_ratio:
+            kind = 'duplicate'
+        elif roll < self.args.duplicate_ratio + self.args.redelivery_ratio:
+            kind = 'redelivery'
+        else:
+            kind = 'single'
+        return user_id, kind
+
+    def create_question(self, user_id):
+        r = session().post(f"{self.args.fake_ml}/_admin/questions",
+                           json={"user_id": user_id, "notify": False}, timeout=10)
+        r.raise_for_status()
+        question = r.json()
+        with self.lock:
+            self.question_ids.append(question['id'])
+        return question
+
+    def notification(self, question, attempts=1):
+        now = datetime.now(timezone.utc).isoformat()
+        return {
+            "_id": f"storm-{question['id']}-{attempts}",
+            "resource": f"/questions/{question['id']}",
+            "user_id": question['seller_id'],
+            "topic": "questions",
+            "application_id": 5510376630479325,
+            "attempts": attempts,
+            "sent": now,
+            "received": now,
+        }
+
+    def post_webhook(self, payload):
+        start = time.perf_counter()
+        try:
+            r = session().post(self.args.app + '/api/ml/webhook', json=payload, timeout=self.args.timeout)
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.sent += 1
+                if r.status_code == 200:
+                    self.acked += 1
+                    self.ack_ms.append(elapsed)
+            if r.status_code != 200:
+                self.count_error(f"http_{r.status_code}")
+        except requests.Timeout:
+            with self.lock:
+                self.sent += 1
+            self.count_error('timeout')
+        except requests.ConnectionError:
+            with self.lock:
+                self.sent += 1
+            self.count_error('connection')
+
+    def fire(self, user_id, kind):
+        """Uma notificação nova (e às vezes uma duplicata simultânea ou uma reentrega futura)"""
+        try:
+            question = self.create_question(user_id)
+        except Exception:
+            self.count_error('fake_ml_create')
+            return
+        payload = self.notification(question)
+        if kind == 'duplicate':
+            # Duplicata em outra thread do pool, em paralelo com a original
+            self.pool.submit(self.post_webhook, payload)
+        self.post_webhook(payload)
+        if kind == 'redelivery':
+            with self.lock:
+                self.redeliveries.append((time.monotonic() + self.args.redelivery_delay,
+                                          self.notification(question, attempts=2)))
+
+    def due_redeliveries(self):
+        now = time.monotonic()
+        with self.lock:
+            due = [payload for at, payload in self.redeliveries if at <= now]
+            self.redeliveries = [(at, payload) for at, payload in self.redeliveries if at > now]
+        return due
+
+    def scrape_metrics(self):
+        """Guarda os picos de threads, workers de webhook e memória do bot"""
+        while not self.stop.is_set():
+            try:
+                text = session().get(self.args.app + '/metrics', timeout=5).text
+                threads = 0
+                values = {}
+                for line in text.splitlines():
+                    match = METRIC_LINE.match(line)
+                    if not match:
+                        continue
+                    name, _, value = match.groups()
+                    if name == 'botml_threads':
+                        threads += float(value)
+                    elif name in ('botml_process_resident_memory_bytes', 'botml_webhook_workers_active',
+                                  'botml_db_writer_queue_depth'):
+                        values[name] = float(value)
+                values['botml_threads'] = threads
+                with self.lock:
+                    for name, value in values.items():
+                        self.peaks[name] = max(self.peaks.get(name, 0), value)
+            except Exception:
+                pass
+            self.stop.wait(self.args.scrape_interval)
+
+    def fake_requests(self):
+        try:
+            return session().get(f"{self.args.fake_ml}/_admin/stats", timeout=10).json().get('requests', {})
+        except Exception:
+            return {}
+
+    def run(self):
+        args = self.args
+        interval = 1.0 / args.rate
+        self.fake_before = self.fake_requests()  # o servidor falso pode ter servido rodadas anteriores
+        scraper = threading.Thread(target=self.scrape_metrics, daemon=True)
+        scraper.start()
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            self.pool = pool
+            fires = []
+            next_at = started
+            total = int(args.rate * args.duration)
+            for _ in range(total):
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                elif delay < -interval:
+                    self.behind_schedule += 1
+                fires.append(pool.submit(self.fire, *self.plan()))
+                self.fired += 1
+                for payload in self.due_redeliveries():
+                    pool.submit(self.post_webhook, payload)
+                next_at += interval
+            send_seconds = time.monotonic() - started
+            # Disparos em andamento ainda podem agendar duplicatas e reentregas no pool
+            wait(fires)
+            # Reentregas que ainda estavam agendadas
+            while True:
+                with self.lock:
+                    pending = len(self.redeliveries)
+                if not pending:
+                    break
+                for payload in self.due_redeliveries():
+                    pool.submit(self.post_webhook, payload)
+                time.sleep(0.05)
+        answered = self.wait_answers()
+        self.stop.set()
+        scraper.join(timeout=args.scrape_interval + 5)
+        return self.report(send_seconds, answered)
+
+    def wait_answers(self):
+        """Espera até --drain segundos pelas respostas e devolve {id: (criada, respondida)}"""
+        deadline = time.monotonic() + self.args.drain
+        timings = {}
+        while True:
+            timings = {}
+            ids = list(self.question_ids)
+            for i in range(0, len(ids), 500):
+                chunk = ','.join(str(x) for x in ids[i:i + 500])
+                r = session().get(f"{self.args.fake_ml}/_admin/questions", params={"ids": chunk}, timeout=30)
+                timings.update(r.json().get('questions', {}))
+            unanswered = sum(1 for created, answered in timings.values() if answered is None)
+            if not unanswered or time.monotonic() >= deadline:
+                return timings
+            time.sleep(1)
+
+    def report(self, send_seconds, timings):
+        e2e_ms = [(answered - created) * 1000 for created, answered in timings.values() if answered is not None]
+        requests_by_route = {
+            key: count - self.fake_before.get(key, 0)
+            for key, count in self.fake_requests().items() if count - self.fake_before.get(key, 0)
+        }
+        return {
+            "config": {key: value for key, value in vars(self.args).items() if key != 'output'},
+            "notifications": {
+                "fired": self.fired,
+                "sent": self.sent,
+                "acked": self.acked,
+                "achieved_rate": round(self.fired / send_seconds, 2) if send_seconds else 0,
+                "behind_schedule": self.behind_schedule,
+                "errors": self.errors,
+                "error_rate": round(1 - self.acked / self.sent, 4) if self.sent else 0,
+            },
+            "ack_latency_ms": percentiles(self.ack_ms),
+            "questions": {
+                "created": len(timings),
+                "answered": len(e2e_ms),
+                "unanswered": len(timings) - len(e2e_ms),
+                # Respostas repetidas (duplicata que escapou da deduplicação) recebem 400 do servidor falso
+                "duplicate_answer_attempts": requests_by_route.get('answer 400', 0),
+            },
+            "end_to_end_ms": percentiles(e2e_ms),
+            "app_peaks": {
+                "threads": self.peaks.get('botml_threads'),
+                "webhook_workers_active": self.peaks.get('botml_webhook_workers_active'),
+                "db_writer_queue_depth": self.peaks.get('botml_db_writer_queue_depth'),
+                "resident_memory_mb": round(self.peaks['botml_process_resident_memory_bytes'] / 2 ** 20, 1)
+                if 'botml_process_resident_memory_bytes' in self.peaks else None,
+            },
+            "fake_ml_requests": requests_by_route,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempestade de webhooks contra o bot")
+    parser.add_argument('--app', default='http://127.0.0.1:5000', help="URL base do bot")
+    parser.add_argument('--fake-ml', default='http://127.0.0.1:8081', help="URL do tools/fake_ml_server.py")
+    parser.add_argument('--users', default='180617463', type=lambda v: [u.strip() for u in v.split(',') if u.strip()])
+    parser.add_argument('--rate', type=float, default=20, help="notificações novas por segundo")
+    parser.add_argument('--duration', type=float, default=30, help="segundos de envio")
+    parser.add_argument('--concurrency', type=int, default=16, help="conexões simultâneas")
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help="fração enviada duas vezes ao mesmo tempo")
+    parser.add_argument('--redelivery-ratio', type=float, default=0.05, help="fração reentregue depois")
+    parser.add_argument('--redelivery-delay', type=float, default=5, help="segundos até a reentrega")
+    parser.add_argument('--timeout', type=float, default=10, help="timeout do POST do webhook")
+    parser.add_argument('--drain', type=float, default=30, help="segundos esperando as respostas no final")
+    parser.add_argument('--scrape-interval', type=float, default=1.0, help="intervalo de leitura do /metrics")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', help="grava o relatório JSON neste arquivo")
+    args = parser.parse_args()
+
+    print(f"🌩️ {args.rate}/s por {args.duration}s contra {args.app} (concorrência {args.concurrency})", file=sys.stderr)
+    report = Storm(args).run()
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+
+
+if __name__ == '__main__':
+    main()